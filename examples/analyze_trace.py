@@ -0,0 +1,40 @@
+"""Analyze a trace recorded with NRF24RecordingSpi/NRF24RecordingGpio and print how the SPI bus
+time is spent, including traffic that could have been avoided. Does not need any hardware.
+Usage: python analyze_trace.py trace.bin [spi_speed_hz] [transfer_overhead_us]
+"""
+
+import collections
+import sys
+
+from nrf24 import *
+
+
+def print_trace_analysis(path, spi_speed_hz, transfer_overhead):
+    analysis = analyze_trace(read_trace(path), spi_speed_hz, transfer_overhead)
+
+    print("%d transfers, %.3f ms estimated bus time" % (
+            len(analysis.commands), 1000 * analysis.total_bus_time))
+    print("")
+    print(analysis.to_string())
+    print("")
+
+    # Which registers the avoidable traffic is about
+    avoidable = collections.Counter()
+    for command in analysis.commands:
+        if command.category != TRAFFIC_USEFUL:
+            register = find_register(command.argument) if command.argument is not None else None
+            avoidable[(command.category, command.name,
+                       register.NAME if register is not None else "")] += 1
+    if avoidable:
+        print("Most common avoidable commands:")
+        for (category, name, register_name), count in avoidable.most_common(10):
+            print("  %6d  %-24s %-12s %s" % (count, category, name, register_name))
+
+
+if __name__ == "__main__":
+    if not 2 <= len(sys.argv) <= 4:
+        print(__doc__)
+        sys.exit(1)
+    print_trace_analysis(sys.argv[1],
+                         float(sys.argv[2]) if len(sys.argv) >= 3 else 10*1000*1000,
+                         float(sys.argv[3]) * 1e-6 if len(sys.argv) >= 4 else 0.0)
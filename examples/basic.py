@@ -32,17 +32,16 @@ def test_basic():
         device_tx.set(PWR_UP(1))
         
         try:
-            # Need to wait Tpd2stby until we are in Standby-I mode
-            time.sleep(0.01)
-            
+            # Waits Tpd2stby until we are in Standby-I mode and then
+            # 130 microseconds until the RX device is in RX mode
             device_rx.chip_enable_high()
+            device_rx.wait_for_mode_transition()
             
-            # After 130 microseconds the RX device is in RX mode
-            time.sleep(0.000130)
-            
-            # Set payload and go to TX mode
+            # Set payload, wait Tpd2stby until the TX device is in Standby-I
+            # mode and go to TX mode
             data_to_send = range(32)
             device_tx.write_tx_payload(data_to_send)
+            device_tx.wait_for_mode_transition()
             device_tx.chip_enable_high()
             
             start_time = time.time()
@@ -0,0 +1,258 @@
+"""A software stand-in for two or more nRF24L01+ chips, to run the benchmarks and try out code
+without hardware. EmulatedRadio implements xfer2() (registers, FIFOs and the commands used by
+nrf24) and EmulatedGpio implements CE and IRQ. Packets are sent instantly to the other radios
+in the same EmulatedAir, so measurements show the time spent in Python and not on air.
+Example:
+    air = EmulatedAir(loss_rate=0.01)
+    radio_tx, radio_rx = EmulatedRadio(air), EmulatedRadio(air)
+    device_tx = NRF24Device(radio_tx, EmulatedGpio(radio_tx))
+    device_rx = NRF24Device(radio_rx, EmulatedGpio(radio_rx))
+"""
+
+import collections
+import random
+import threading
+
+
+_RESET_VALUES = {0x00: 0x08, 0x01: 0x3F, 0x02: 0x03, 0x03: 0x03, 0x04: 0x03, 0x05: 0x02, 0x06: 0x0E}
+_RESET_ADDRESSES = {0x0A: [0xE7] * 5, 0x0B: [0xC2] * 5, 0x10: [0xE7] * 5}
+_RESET_PIPE_ADDRESSES = {0x0C: 0xC3, 0x0D: 0xC4, 0x0E: 0xC5, 0x0F: 0xC6}
+
+
+class EmulatedAir(object):
+    """The radios which can hear each other. Each packet (and each ACK) is lost with
+    probability loss_rate."""
+
+    def __init__(self, loss_rate=0.0, seed=None):
+        self.loss_rate = loss_rate
+        self.radios = []
+        self.lock = threading.RLock()
+        self._random = random.Random(seed)
+        self._callbacks = collections.deque()
+        self._callbacks_condition = threading.Condition()
+        self._callback_thread = None
+
+    def call_later(self, callback):
+        """Call callback on another thread, like RPi.GPIO calls edge detection callbacks,
+        so that IRQ callbacks can't deadlock with threads doing SPI transfers."""
+        with self._callbacks_condition:
+            if self._callback_thread is None:
+                self._callback_thread = threading.Thread(target=self._run_callbacks)
+                self._callback_thread.daemon = True
+                self._callback_thread.start()
+            self._callbacks.append(callback)
+            self._callbacks_condition.notify()
+
+    def _run_callbacks(self):
+        while True:
+            with self._callbacks_condition:
+                while not self._callbacks:
+                    self._callbacks_condition.wait()
+                callback = self._callbacks.popleft()
+            callback()
+
+    def is_lost(self):
+        return self.loss_rate > 0 and self._random.random() < self.loss_rate
+
+    def transmit(self, sender, payload):
+        """Send payload from sender. Return None if nobody received it, otherwise the receiving
+        radio and pipe."""
+        address = sender.get_address(0x10)
+        for radio in self.radios:
+            if radio is sender or not radio.is_in_rx_mode() or radio.registers[0x05] != sender.registers[0x05]:
+                continue
+            pipe = radio.get_pipe(address)
+            if pipe is None:
+                continue
+            if self.is_lost() or not radio.receive(pipe, payload):
+                return None
+            return radio, pipe
+        return None
+
+
+class EmulatedRadio(object):
+    "One emulated nRF24L01+, use it as the spi object of NRF24Device."
+
+    def __init__(self, air):
+        self.air = air
+        air.radios.append(self)
+        self.reset()
+        self.chip_enable = 0
+        self.irq_callback = None
+
+    def reset(self):
+        self.registers = [0] * 0x20
+        for address, value in _RESET_VALUES.items():
+            self.registers[address] = value
+        for address, value in _RESET_PIPE_ADDRESSES.items():
+            self.registers[address] = value
+        self.addresses = dict((address, list(value)) for address, value in _RESET_ADDRESSES.items())
+        self.flags = 0
+        self.rx_fifo = []   # (pipe, payload)
+        self.tx_fifo = []   # (payload, ack)
+        self.ack_payloads = []  # (pipe, payload)
+
+    def get_address_width(self):
+        return (self.registers[0x03] & 0x03) + 2
+
+    def get_address(self, register):
+        width = self.get_address_width()
+        if register in self.addresses:
+            return self.addresses[register][:width]
+        return [self.registers[register]] + self.addresses[0x0B][1:width]
+
+    def get_pipe(self, address):
+        for pipe in range(6):
+            if self.registers[0x02] & (1 << pipe) and self.get_address(0x0A + pipe) == address:
+                return pipe
+        return None
+
+    def is_powered_up(self):
+        return self.registers[0x00] & 0x02
+
+    def is_in_rx_mode(self):
+        return self.chip_enable and self.is_powered_up() and self.registers[0x00] & 0x01
+
+    def is_in_tx_mode(self):
+        return self.chip_enable and self.is_powered_up() and not self.registers[0x00] & 0x01
+
+    def is_dynamic_payload(self, pipe):
+        return self.registers[0x1D] & 0x04 and self.registers[0x1C] & (1 << pipe)
+
+    def get_tx_fifo_size(self):
+        # ACK payloads are kept in the TX FIFO
+        return len(self.tx_fifo) + len(self.ack_payloads)
+
+    def get_status(self):
+        pipe = self.rx_fifo[0][0] if self.rx_fifo else 7
+        return self.flags | (pipe << 1) | (1 if self.get_tx_fifo_size() >= 3 else 0)
+
+    def get_fifo_status(self):
+        tx_fifo_size = self.get_tx_fifo_size()
+        return ((0x20 if tx_fifo_size >= 3 else 0) | (0x10 if not tx_fifo_size else 0) |
+                (0x02 if len(self.rx_fifo) >= 3 else 0) | (0x01 if not self.rx_fifo else 0))
+
+    def set_flags(self, flags):
+        was_active = self.is_irq_active()
+        self.flags |= flags
+        if not was_active and self.is_irq_active() and self.irq_callback is not None:
+            self.air.call_later(self.irq_callback)
+
+    def is_irq_active(self):
+        # The MASK_* bits in CONFIG are in the same positions as the flags in STATUS
+        return bool(self.flags & ~self.registers[0x00] & 0x70)
+
+    def receive(self, pipe, payload):
+        "Called by EmulatedAir. Return False if the RX FIFO was full."
+        if len(self.rx_fifo) >= 3:
+            return False
+        if not self.is_dynamic_payload(pipe):
+            size = self.registers[0x11 + pipe]
+            if size != len(payload):
+                return False
+        self.rx_fifo.append((pipe, list(payload)))
+        self.set_flags(0x40)
+        return True
+
+    def _transmit_fifo(self):
+        "Send packets from the TX FIFO until it is empty or a packet is not ACKed."
+        while self.tx_fifo and self.is_in_tx_mode() and not self.flags & 0x10:
+            payload, ack = self.tx_fifo[0]
+            ack = ack and self.registers[0x01] & 0x01
+            attempts = 1 + (self.registers[0x04] & 0x0F if ack else 0)
+            result = None
+            for attempt in range(attempts):
+                # A receiver which got the packet but whose ACK was lost drops the retransmission
+                if result is None:
+                    result = self.air.transmit(self, payload)
+                if not ack or result is not None and not self.air.is_lost():
+                    break
+            else:
+                self.set_flags(0x10)  # MAX_RT, the packet stays in the TX FIFO
+                return
+            self.tx_fifo.pop(0)
+            if ack and result is not None:
+                self._receive_ack_payload(*result)
+            self.set_flags(0x20)
+
+    def _receive_ack_payload(self, receiver, pipe):
+        for i, (ack_pipe, ack_payload) in enumerate(receiver.ack_payloads):
+            if ack_pipe == pipe:
+                del receiver.ack_payloads[i]
+                receiver.set_flags(0x20)
+                self.receive(0, ack_payload)
+                return
+
+    def xfer2(self, data):
+        with self.air.lock:
+            return self._xfer2(list(data))
+
+    def _xfer2(self, data):
+        command = data[0]
+        status = self.get_status()
+        size = len(data) - 1
+        response = [status] + [0] * size
+        if command < 0x20:
+            if command in self.addresses:
+                value = self.addresses[command][:size]
+            elif command == 0x07:
+                value = [status] * size
+            elif command == 0x17:
+                value = [self.get_fifo_status()] * size
+            else:
+                value = [self.registers[command]] * size
+            response[1:1 + len(value)] = value
+        elif command < 0x40:
+            address = command & 0x1F
+            if address in self.addresses:
+                self.addresses[address] = data[1:] + self.addresses[address][size:]
+            elif address == 0x07:
+                self.flags &= ~(data[1] & 0x70)
+                self._transmit_fifo()
+            elif address != 0x17:
+                self.registers[address] = data[1]
+                self._transmit_fifo()
+        elif command == 0x61:
+            if self.rx_fifo:
+                pipe, payload = self.rx_fifo.pop(0)
+                payload = payload[:size]
+                response[1:1 + len(payload)] = payload
+        elif command == 0x60:
+            response[1] = len(self.rx_fifo[0][1]) if self.rx_fifo else 0
+        elif command in (0xA0, 0xB0):
+            if self.get_tx_fifo_size() < 3:
+                self.tx_fifo.append((data[1:], command == 0xA0))
+                self._transmit_fifo()
+        elif 0xA8 <= command <= 0xAD:
+            if self.get_tx_fifo_size() < 3:
+                self.ack_payloads.append((command & 0x07, data[1:]))
+        elif command == 0xE1:
+            self.tx_fifo = []
+            self.ack_payloads = []
+        elif command == 0xE2:
+            self.rx_fifo = []
+        return response
+
+    def set_chip_enable(self, level):
+        with self.air.lock:
+            self.chip_enable = level
+            self._transmit_fifo()
+
+
+class EmulatedGpio(object):
+    "CE and IRQ of an EmulatedRadio, use it as the gpio object of NRF24Device."
+
+    def __init__(self, radio):
+        self.radio = radio
+
+    def chip_enable_high(self):
+        self.radio.set_chip_enable(1)
+
+    def chip_enable_low(self):
+        self.radio.set_chip_enable(0)
+
+    def set_falling_edge_irq(self, callback):
+        self.radio.irq_callback = callback
+
+    def remove_falling_edge_irq(self):
+        self.radio.irq_callback = None
@@ -0,0 +1,59 @@
+"""Measure how long it takes to import nrf24 and how much memory the import adds.
+Each case is run in a fresh Python process a number of times. Does not need any hardware.
+"""
+
+import os
+import subprocess
+import sys
+
+
+NUM_RUNS = 20
+
+# Each case is run in a new process and must print the import time in seconds and how much
+# the resident set size grew during the import in kilobytes (-1 without /proc/self/statm).
+# The max RSS of the process would mostly be the size of the interpreter itself.
+_CASE_TEMPLATE = """
+import os, time
+_timer = getattr(time, "perf_counter", time.time)
+def _rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (IOError, OSError):
+        return None
+_rss_before = _rss_kb()
+_start = _timer()
+%s
+_elapsed = _timer() - _start
+_rss_after = _rss_kb()
+print("%%r %%r" %% (_elapsed, -1 if _rss_before is None else _rss_after - _rss_before))
+"""
+
+CASES = [
+    ("python only", "pass"),
+    ("import nrf24", "import nrf24"),
+    ("import nrf24, use 3 fields", "import nrf24\nnrf24.PWR_UP, nrf24.PRIM_RX, nrf24.RX_DR"),
+    ("from nrf24 import *", "from nrf24 import *"),
+    ("from nrf24 import *, all docstrings",
+            "import nrf24\nfrom nrf24 import *\n[c.__doc__ for c in vars(nrf24).values() if isinstance(c, type)]"),
+]
+
+
+def run_case(code):
+    module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+    output = subprocess.check_output([sys.executable, "-c", _CASE_TEMPLATE % code], cwd=module_dir)
+    elapsed, rss_delta = output.split()
+    return float(elapsed), int(rss_delta)
+
+
+def import_benchmark():
+    print("%-40s %12s %12s" % ("", "import (ms)", "+RSS (kB)"))
+    for name, code in CASES:
+        results = [run_case(code) for i in range(NUM_RUNS)]
+        times = sorted(elapsed for elapsed, rss_delta in results)
+        rss_deltas = sorted(rss_delta for elapsed, rss_delta in results)
+        print("%-40s %12.2f %12d" % (name, 1000 * times[len(times) // 2], rss_deltas[len(rss_deltas) // 2]))
+
+
+if __name__ == "__main__":
+    import_benchmark()
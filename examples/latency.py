@@ -0,0 +1,266 @@
+"""Measure the round trip time of a request and its reply between the two devices in
+config.py (or the emulated radios in emulator.py with --emulate), and how long each
+stage of it takes. One device sends pings and the other one, on a thread of its own,
+answers them. Prints percentiles and a histogram of the round trip time.
+
+Two ways to reply can be measured:
+  ack     The reply comes back in the ACK payload, which the responder loads in advance.
+  switch  The responder switches to TX mode to send the reply, and the pinger switches to
+          RX mode to receive it, which is what you have to do without ACK payloads.
+
+With --poll, STATUS is polled instead of waiting for the IRQ pin. There is a pause of
+--interval seconds between pings, to give the responder time to read the previous one.
+
+The pinger and the responder are threads in one process and share the GIL. The poll loops
+yield, and the switch interval is lowered to SWITCH_INTERVAL while running, so they take
+turns quickly, but each handover still adds to the measured times. Python 2 has no switch
+interval and doesn't hand the GIL over fairly, so there polling can look milliseconds slower
+than it is. Run the two sides on two machines for numbers without this effect.
+
+Examples:
+    python latency.py --mode ack --iterations 5000
+    python latency.py --emulate --mode switch --poll
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+from config import *
+from nrf24 import *
+
+from throughput_matrix import open_devices
+
+
+ADDRESS = [0b11100111, 0b00110001, 0b11010111, 0b01011010, 0b00101100]
+CHANNEL = 25
+REPLY_TIMEOUT = 0.05
+SWITCH_INTERVAL = 200e-6
+
+STAGES = {
+    "ack": ["spi write", "ce pulse", "irq wake", "payload read"],
+    "switch": ["spi write", "ce pulse", "irq wake", "to rx", "reply wait", "payload read", "to tx"],
+}
+
+ALL_FLAGS = (1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)
+
+
+def configure(device, data_rate):
+    device.chip_enable_low()
+    device.reset_to_default()
+    device.flush_tx_fifo()
+    device.flush_rx_fifo()
+    device.set(EN_CRC(1) | CRCO(1))
+    device.set(ENAA_P0(1), ERX_P0(1), ERX_P1(0))
+    device.set(ARC(3) | ARD(1))
+    device.set(RF_CH(CHANNEL))
+    device.set({250*1000: RF_DR_LOW(1) | RF_DR_HIGH(0),
+                1000*1000: RF_DR_LOW(0) | RF_DR_HIGH(0),
+                2000*1000: RF_DR_LOW(0) | RF_DR_HIGH(1)}[data_rate])
+    device.set(EN_DPL(1) | EN_ACK_PAY(1), DPL_P0(1))
+    device.set(REG_RX_ADDR_P0(ADDRESS), REG_TX_ADDR(ADDRESS))
+
+
+def wait_for_flags(device, poll, timeout):
+    "Wait for RX_DR, TX_DS or MAX_RT, and return STATUS."
+    if poll:
+        end = time.time() + timeout
+        while True:
+            status = device.get_status()
+            if status & ALL_FLAGS or time.time() > end:
+                return status
+            # Let the other thread run, or it may not get the GIL until the switch interval
+            time.sleep(0)
+    device.wait_for_irq_low(timeout)
+    return device.get_status()
+
+
+class Responder(object):
+    "Answers pings on its own thread until stop() is called."
+
+    def __init__(self, device, mode, poll):
+        self.device = device
+        self.mode = mode
+        self.poll = poll
+        self.num_replies = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self.device.set(PWR_UP(1) | PRIM_RX(1))
+        if self.mode == "ack":
+            self._fill_ack_payloads()
+        self.device.chip_enable_high()
+        self.device.wait_for_mode_transition()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+        self.device.chip_enable_low()
+
+    def _fill_ack_payloads(self):
+        # Keep the ACK payload FIFO full, so there is always a reply ready
+        while not self.device.get(TX_FULL_):
+            self.device.write_ack_payload(0, [self.num_replies & 0xFF] * 4)
+            self.num_replies += 1
+
+    def _run(self):
+        device = self.device
+        while not self._stopped:
+            status = wait_for_flags(device, self.poll, 0.1)
+            device.set(REG_STATUS(ALL_FLAGS))
+            # Clearing RX_DR doesn't empty the RX FIFO, so read everything in it
+            while RX_P_NO.get(status) <= 5:
+                result = device.read_dynamic_payload()
+                if result is not None:
+                    if self.mode == "ack":
+                        self._fill_ack_payloads()
+                    else:
+                        self._reply(result[1])
+                status = device.get_status()
+
+    def _reply(self, payload):
+        device = self.device
+        device.chip_enable_low()
+        device.set(PRIM_RX(0))
+        device.write_tx_payload(payload)
+        # The pinger may not be in RX mode yet, so keep trying until it is or we time out
+        end = time.time() + REPLY_TIMEOUT
+        while True:
+            device.pulse_chip_enable()
+            status = wait_for_flags(device, self.poll, REPLY_TIMEOUT)
+            if not MAX_RT.get(status) or time.time() > end:
+                break
+            device.set(REG_STATUS(1 << MAX_RT.START_BIT))
+        if not TX_DS.get(status):
+            device.flush_tx_fifo()
+        device.set(REG_STATUS(ALL_FLAGS), PRIM_RX(1))
+        device.chip_enable_high()
+        self.num_replies += 1
+
+
+def ping(device, mode, poll, sequence, timer):
+    """Send one ping and wait for the reply. Return a list with the time in nanoseconds of each
+    stage in STAGES[mode], or None if there was no reply."""
+    payload = [sequence & 0xFF, (sequence >> 8) & 0xFF] + [0] * 30
+    times = [timer.now_ns()]
+    device.write_tx_payload(payload)
+    times.append(timer.now_ns())
+    device.pulse_chip_enable()
+    times.append(timer.now_ns())
+    status = wait_for_flags(device, poll, REPLY_TIMEOUT)
+    times.append(timer.now_ns())
+    if not TX_DS.get(status):
+        device.flush_tx_fifo()
+        device.set(REG_STATUS(ALL_FLAGS))
+        return None
+
+    if mode == "switch":
+        device.set(REG_STATUS(ALL_FLAGS), PRIM_RX(1))
+        device.chip_enable_high()
+        times.append(timer.now_ns())
+        status = wait_for_flags(device, poll, REPLY_TIMEOUT)
+        times.append(timer.now_ns())
+    result = device.read_dynamic_payload() if RX_DR.get(status) else None
+    device.set(REG_STATUS(ALL_FLAGS))
+    times.append(timer.now_ns())
+    if mode == "switch":
+        device.chip_enable_low()
+        device.set(PRIM_RX(0))
+        times.append(timer.now_ns())
+        if result is None or result[1][:2] != payload[:2]:
+            return None
+    elif result is None:
+        return None
+    return [end - start for start, end in zip(times, times[1:])]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def print_histogram(values_ns, num_buckets=20, width=50):
+    "Print a histogram with logarithmic buckets."
+    low, high = min(values_ns), max(values_ns)
+    ratio = (float(high) / max(low, 1)) ** (1.0 / num_buckets) if high > low else 2.0
+    counts = [0] * num_buckets
+    for value in values_ns:
+        bucket = 0
+        limit = low * ratio
+        while value > limit and bucket < num_buckets - 1:
+            bucket += 1
+            limit *= ratio
+        counts[bucket] += 1
+    most = max(counts)
+    limit = low
+    for count in counts:
+        limit *= ratio
+        print("  <= %9.1f us %7d %s" % (limit / 1000.0, count, "#" * int(round(width * count / float(most)))))
+
+
+def print_results(mode, results, num_lost):
+    print("%d round trips, %d without reply" % (len(results), num_lost))
+    if not results:
+        return
+    columns = [("round trip", sorted(sum(result) for result in results))]
+    for i, stage in enumerate(STAGES[mode]):
+        columns.append((stage, sorted(result[i] for result in results)))
+    print("%-14s %9s %9s %9s %9s %9s %9s   (us)" % ("", "mean", "p50", "p90", "p99", "p99.9", "max"))
+    for name, values in columns:
+        print("%-14s %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f" % (
+                name, sum(values) / 1000.0 / len(values),
+                percentile(values, 0.5) / 1000.0, percentile(values, 0.9) / 1000.0,
+                percentile(values, 0.99) / 1000.0, percentile(values, 0.999) / 1000.0,
+                values[-1] / 1000.0))
+    print("Round trip histogram:")
+    print_histogram(columns[0][1])
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Round trip latency between two devices.")
+    parser.add_argument("--mode", choices=sorted(STAGES), default="ack")
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--data-rate", type=int, default=2000*1000, choices=[250*1000, 1000*1000, 2000*1000])
+    parser.add_argument("--poll", action="store_true", help="Poll STATUS instead of waiting for IRQ")
+    parser.add_argument("--interval", type=float, default=0.001, help="Seconds between pings")
+    parser.add_argument("--emulate", action="store_true", help="Use emulated radios")
+    parser.add_argument("--loss-rate", type=float, default=0.0, help="Packet loss when emulating")
+    options = parser.parse_args(args)
+
+    device_ping, device_pong, cleanup = open_devices(options.emulate, options.loss_rate)
+    if hasattr(sys, "setswitchinterval"):
+        old_switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(SWITCH_INTERVAL)
+    try:
+        for device in (device_ping, device_pong):
+            configure(device, options.data_rate)
+        responder = Responder(device_pong, options.mode, options.poll)
+        responder.start()
+        device_ping.set(PWR_UP(1) | PRIM_RX(0))
+
+        timer = NRF24Timer()
+        results = []
+        num_lost = 0
+        try:
+            for sequence in range(options.iterations):
+                time.sleep(options.interval)
+                result = ping(device_ping, options.mode, options.poll, sequence, timer)
+                if result is None:
+                    num_lost += 1
+                else:
+                    results.append(result)
+        finally:
+            responder.stop()
+        print_results(options.mode, results, num_lost)
+    finally:
+        if hasattr(sys, "setswitchinterval"):
+            sys.setswitchinterval(old_switch_interval)
+        cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
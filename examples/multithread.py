@@ -50,13 +50,10 @@ def test_multithread():
                 with condition_variable:
                     # Set payload and go to TX mode
                     device_tx.write_tx_payload([i])
+                    # The device waits the 4 microseconds (Tpece2csn) required from
+                    # CE high to the next SPI command by itself.
                     device_tx.chip_enable_high()
         
-                # This is probably too small to even care about in a Python program,
-                # but the datasheet says minimum wait of 4 microseconds (Tpece2csn)
-                # after going CE high to going CSN low (i.e. sending SPI commands).
-                time.sleep(4e-6)
-        
                 with condition_variable:
                     # Should use wait_for_irq_low_cancellable() even though we will
                     # never cancel it since it uses GPIO internally and it should thus
@@ -81,15 +78,10 @@ def test_multithread():
 
         def rx_thread():
             with condition_variable:
-                # Need to wait Tpd2stby until we are in Standby-I mode
-                time.sleep(0.01)
-                
+                # Wait Tpd2stby until we are in Standby-I mode and Tstby2a until
+                # we are in RX mode
                 device_rx.chip_enable_high()
-
-                # This is probably too small to even care about in a Python program,
-                # but the datasheet says minimum wait of 4 microseconds (Tpece2csn)
-                # after going CE high to going CSN low (i.e. sending SPI commands).
-                time.sleep(4e-6)
+                device_rx.wait_for_mode_transition()
 
             with condition_variable:
                 for i in range(15):
@@ -52,7 +52,17 @@ def test_throughput():
         device_tx.reset_to_default()
 
         TRANSMISSION_SPEED_MBPS = 2 # 0.250 or 1 or 2
-        PACKET_TRANSMISSION_TIME = (1+3+32)*8/(TRANSMISSION_SPEED_MBPS*1000*1000)
+        link_config = NRF24LinkConfig(data_rate=int(TRANSMISSION_SPEED_MBPS*1000*1000),
+                                      address_width=3, crc_bytes=0, payload_size=32,
+                                      auto_ack=False)
+        PACKET_TRANSMISSION_TIME = link_config.get_time_on_air()
+
+        # All times in the loop below are in nanoseconds from timer.now_ns(), since
+        # time.time() is too coarse for the microsecond delays required.
+        timer = NRF24Timer()
+        T_PECE2CSN_NS = int(T_PECE2CSN * 1e9)
+        MAX_TIME_IN_TX_NS = int((T_TX_MAX - PACKET_TRANSMISSION_TIME) * 1e9)
+        PACKET_TRANSMISSION_TIME_NS = int(PACKET_TRANSMISSION_TIME * 1e9)
 
 
         for device in (device_rx, device_tx):
@@ -100,14 +110,10 @@ def test_throughput():
         device_rx.set(PWR_UP(1) | PRIM_RX(1))
         device_tx.set(PWR_UP(1) | PRIM_RX(0))
         
-        # Must wait for a while for the oscillator to startup (depends on the crystal you use)
-        time.sleep(0.01)
-
-        # Both devices are now in mode Standby-I. Take RX device to RX mode
+        # Take RX device to RX mode. This waits for the oscillator to startup (Tpd2stby)
+        # and then the required 130 microseconds (Tstby2a) before we are in RX mode.
         device_rx.chip_enable_high()
-        
-        # Required waiting time 130 microseconds before we are in RX mode
-        time.sleep(0.000130)
+        device_rx.wait_for_mode_transition()
         
         # According to the datasheet, we can't be in TX mode for longer than about 4 ms, otherwise
         # the frequency can drift off making it impossible to receive whatever is sent or something
@@ -130,14 +136,14 @@ def test_throughput():
         while True:
             
             # Can't touch tx device spi bus until 4 microseconds has passed since we set CE = 1
-            if time.time() - last_enter_tx > 0.000004:
+            if timer.now_ns() - last_enter_tx > T_PECE2CSN_NS:
 
                 # Can't be in TX mode longer than 4 ms and it takes some time to transfer a packet.
-                if in_tx_mode and time.time() - last_enter_tx > 0.004 - PACKET_TRANSMISSION_TIME:
+                if in_tx_mode and timer.now_ns() - last_enter_tx > MAX_TIME_IN_TX_NS:
                     device_tx.set(TX_DS(1))  # Clear Data Sent bit by writing 1 to it
                     in_tx_mode = False
                     device_tx.chip_enable_low()
-                    last_exit_tx = time.time()
+                    last_exit_tx = timer.now_ns()
 
                 # Read from FIFO_STATUS register. Note the underscore in TX_FULL_ . It's needed because
                 # of a naming conflict - TX_FULL is also present in the STATUS register.
@@ -152,10 +158,10 @@ def test_throughput():
                 if (need_to_enter_tx_mode and
                         not in_tx_mode and (
                             device_tx.get(TX_DS) == 1 or
-                            time.time() - last_exit_tx > PACKET_TRANSMISSION_TIME)):
+                            timer.now_ns() - last_exit_tx > PACKET_TRANSMISSION_TIME_NS)):
                     in_tx_mode = True
                     device_tx.chip_enable_high()
-                    last_enter_tx = time.time()
+                    last_enter_tx = timer.now_ns()
         
                 
             rx_full, rx_empty = device_rx.get(RX_FULL, RX_EMPTY)
@@ -176,7 +182,7 @@ def test_throughput():
             # it passed 2 seconds since last try to send in which case something is wrong.
             if (num_packets_sent == num_packets_to_send and
                     rx_empty and
-                    time.time() - last_enter_tx > 0.000004 and
+                    timer.now_ns() - last_enter_tx > T_PECE2CSN_NS and
                     device_tx.get(TX_EMPTY)):
                 break
 
@@ -200,6 +206,9 @@ def test_throughput():
                     32*num_packets_received / transmission_time,
                     (1+3+32)*8*num_packets_received / transmission_time))
         
+        print("Theoretical maximum %.0f packets per second with the TX FIFO kept full" %
+                link_config.get_packets_per_second(streaming=True))
+
         if num_rx_full_encountered > 0:
             print("Encountered a full RX FIFO %d times in the loop, " % num_rx_full_encountered +
                     "meaning packets could have been dropped.")
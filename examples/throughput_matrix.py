@@ -0,0 +1,333 @@
+"""Measure throughput for every combination of a number of settings, e.g. to choose the
+settings to use or to find out if a change made things slower. Streams packets from one
+device to another like throughput.py, for each configuration, and prints a table with the
+results. They can also be saved as CSV and JSON, and compared to an earlier JSON file.
+
+Runs on the hardware described in config.py, or on the emulated radios in emulator.py
+with --emulate (which measures only the time spent in Python, since packets are sent
+instantly).
+
+Examples:
+    python throughput_matrix.py --json baseline.json
+    python throughput_matrix.py --data-rate 2000000 --crc 0,2 --baseline baseline.json
+    python throughput_matrix.py --emulate --loss-rate 0.05 --csv results.csv
+"""
+
+import argparse
+import collections
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+from config import *
+from nrf24 import *
+
+
+Settings = collections.namedtuple("Settings",
+        "data_rate crc_bytes address_width payload_size auto_ack arc dynamic_payload")
+
+DEFAULT_SETTINGS = Settings(data_rate=[250*1000, 1000*1000, 2000*1000],
+                            crc_bytes=[0, 1, 2],
+                            address_width=[3, 5],
+                            payload_size=[8, 32],
+                            auto_ack=[0, 1],
+                            arc=[0, 3],
+                            dynamic_payload=[0, 1])
+
+RESULT_FIELDS = list(Settings._fields) + [
+        "packets_sent", "packets_received", "duplicates", "corrupt", "max_rt", "loss",
+        "elapsed", "packets_per_second", "goodput", "cpu_time", "cpu_time_per_packet",
+        "model_packets_per_second"]
+
+ADDRESS = [0b11100111, 0b00110001, 0b11010111, 0b01011010, 0b00101100]
+CHANNEL = 25
+
+# Give up on a configuration if nothing happens for this long
+STALL_TIMEOUT = 2.0
+
+
+def get_settings_matrix(settings):
+    """Return all combinations of the lists of values in settings, leaving out the ones that
+    are not valid (auto ACK needs CRC, dynamic payload length needs auto ACK) or would give
+    the same result (ARC without auto ACK)."""
+    matrix = []
+    for values in itertools.product(*settings):
+        s = Settings(*values)
+        if s.auto_ack and s.crc_bytes == 0:
+            continue
+        if s.dynamic_payload and not s.auto_ack:
+            continue
+        if not s.auto_ack and s.arc != min(settings.arc):
+            continue
+        matrix.append(s if s.auto_ack else s._replace(arc=0))
+    return matrix
+
+
+def get_link_config(settings):
+    return NRF24LinkConfig(data_rate=settings.data_rate, address_width=settings.address_width,
+                           crc_bytes=settings.crc_bytes, payload_size=settings.payload_size,
+                           dynamic_payload=bool(settings.dynamic_payload),
+                           auto_ack=bool(settings.auto_ack), arc=settings.arc)
+
+
+def open_devices(emulate, loss_rate=0.0):
+    "Return (device_tx, device_rx, cleanup) for the hardware in config.py or emulated radios."
+    if emulate:
+        from emulator import EmulatedAir, EmulatedGpio, EmulatedRadio
+        air = EmulatedAir(loss_rate=loss_rate, seed=0)
+        radio_tx, radio_rx = EmulatedRadio(air), EmulatedRadio(air)
+        return (NRF24Device(radio_tx, EmulatedGpio(radio_tx)),
+                NRF24Device(radio_rx, EmulatedGpio(radio_rx)),
+                lambda: None)
+
+    import RPi.GPIO as GPIO
+    import spidev
+
+    DEVICE_RX = 0
+    DEVICE_TX = 1
+
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(True)
+    GPIO.setup(CHIP0_CE, GPIO.OUT)
+    GPIO.setup(CHIP1_CE, GPIO.OUT)
+    GPIO.setup(CHIP0_IRQ, GPIO.IN)
+    GPIO.setup(CHIP1_IRQ, GPIO.IN)
+
+    devices = []
+    for chip_select in (DEVICE_TX, DEVICE_RX):
+        spi = spidev.SpiDev()
+        spi.open(0, chip_select)
+        spi.max_speed_hz = 10*1000*1000
+        devices.append(NRF24Device(spi, NRF24Gpio(CE[chip_select], IRQ[chip_select])))
+    return devices[0], devices[1], GPIO.cleanup
+
+
+def configure(device, settings, link_config):
+    device.chip_enable_low()
+    device.reset_to_default()
+    device.flush_tx_fifo()
+    device.flush_rx_fifo()
+
+    # EN_CRC is forced high if auto ACK is enabled
+    device.set(EN_CRC(int(settings.crc_bytes > 0)) | CRCO(int(settings.crc_bytes == 2)))
+    device.set(ENAA_P0(settings.auto_ack) | ENAA_P1(0) | ENAA_P2(0) | ENAA_P3(0) | ENAA_P4(0) | ENAA_P5(0))
+    device.set(ERX_P0(1) | ERX_P1(0) | ERX_P2(0) | ERX_P3(0) | ERX_P4(0) | ERX_P5(0))
+    device.set(AW(settings.address_width - 2))
+
+    # Shortest retransmit delay that gives time for the ACK
+    min_ard = link_config.get_min_ard() or 4000e-6
+    device.set(ARC(settings.arc) | ARD(max(0, min(15, int(round(min_ard / 250e-6)) - 1))))
+    device.set(RF_CH(CHANNEL))
+    rf_dr = {250*1000: RF_DR_LOW(1) | RF_DR_HIGH(0),
+             1000*1000: RF_DR_LOW(0) | RF_DR_HIGH(0),
+             2000*1000: RF_DR_LOW(0) | RF_DR_HIGH(1)}[settings.data_rate]
+    device.set(rf_dr)
+
+    device.set(EN_DPL(settings.dynamic_payload))
+    device.set(DPL_P0(settings.dynamic_payload))
+    device.set(RX_PW_P0(0 if settings.dynamic_payload else settings.payload_size))
+
+    address = ADDRESS[:settings.address_width]
+    device.set(REG_RX_ADDR_P0(address), REG_TX_ADDR(address))
+
+
+def make_packet(sequence, payload_size):
+    data = [sequence & 0xFF, (sequence >> 8) & 0xFF, (sequence >> 16) & 0xFF, (sequence >> 24) & 0xFF]
+    # Fill the rest with a pattern, to detect corrupt packets when CRC is off
+    return data + [(sequence + i) & 0xFF for i in range(payload_size - 4)]
+
+
+def get_sequence(packet, payload_size):
+    if len(packet) != payload_size:
+        return None
+    sequence = packet[0] | (packet[1] << 8) | (packet[2] << 16) | (packet[3] << 24)
+    if packet != make_packet(sequence, payload_size):
+        return None
+    return sequence
+
+
+def get_cpu_time():
+    if hasattr(time, "process_time"):
+        return time.process_time()
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_configuration(device_tx, device_rx, settings, num_packets):
+    "Stream num_packets packets with the settings and return a dict with the results."
+    assert settings.payload_size >= 4, "Payloads need 4 bytes for the sequence number"
+    link_config = get_link_config(settings)
+    for device in (device_tx, device_rx):
+        configure(device, settings, link_config)
+    device_rx.set(PWR_UP(1) | PRIM_RX(1))
+    device_tx.set(PWR_UP(1) | PRIM_RX(0))
+    device_rx.chip_enable_high()
+    device_rx.wait_for_mode_transition()
+
+    timer = NRF24Timer()
+    # Can't stay in TX mode longer than T_TX_MAX, so leave it regularly
+    max_time_in_tx_ns = int((T_TX_MAX - link_config.get_time_on_air()) * 1e9)
+    received = collections.Counter()
+    num_sent = num_corrupt = num_max_rt = 0
+    start_ns = last_progress_ns = last_received_ns = timer.now_ns()
+    start_cpu_time = get_cpu_time()
+
+    device_tx.chip_enable_high()
+    enter_tx_ns = timer.now_ns()
+    while True:
+        now = timer.now_ns()
+        status = device_tx.get_status()
+        if MAX_RT.get(status):
+            # The packet was not ACKed after ARC retransmits. Drop it and go on.
+            num_max_rt += 1
+            device_tx.flush_tx_fifo()
+            device_tx.set(REG_STATUS(1 << MAX_RT.START_BIT))
+        elif num_sent < num_packets and not TX_FULL.get(status):
+            device_tx.write_tx_payload(make_packet(num_sent, settings.payload_size))
+            num_sent += 1
+            last_progress_ns = now
+
+        if now - enter_tx_ns > max_time_in_tx_ns:
+            device_tx.chip_enable_low()
+            device_tx.chip_enable_high()
+            enter_tx_ns = timer.now_ns()
+
+        while RX_P_NO.get(device_rx.get_status()) <= 5:
+            if settings.dynamic_payload:
+                result = device_rx.read_dynamic_payload()
+                packet = result[1] if result is not None else []
+            else:
+                status, packet = device_rx.read_rx_payload(settings.payload_size)
+            sequence = get_sequence(packet, settings.payload_size)
+            if sequence is None or sequence >= num_packets:
+                num_corrupt += 1
+            else:
+                received[sequence] += 1
+            last_received_ns = last_progress_ns = timer.now_ns()
+
+        if num_sent == num_packets and device_tx.get(TX_EMPTY) and device_rx.get(RX_EMPTY):
+            break
+        if timer.now_ns() - last_progress_ns > STALL_TIMEOUT * 1e9:
+            break
+
+    cpu_time = get_cpu_time() - start_cpu_time
+    device_tx.chip_enable_low()
+    device_rx.chip_enable_low()
+    device_tx.set(PWR_UP(0))
+    device_rx.set(PWR_UP(0))
+
+    num_received = len(received)
+    elapsed = max(last_received_ns - start_ns, 1) / 1e9
+    result = settings._asdict()
+    result.update(
+        packets_sent=num_sent,
+        packets_received=num_received,
+        duplicates=sum(received.values()) - num_received,
+        corrupt=num_corrupt,
+        max_rt=num_max_rt,
+        loss=1.0 - float(num_received) / max(num_sent, 1),
+        elapsed=elapsed,
+        packets_per_second=num_received / elapsed,
+        goodput=8.0 * settings.payload_size * num_received / elapsed,
+        cpu_time=cpu_time,
+        cpu_time_per_packet=cpu_time / max(num_sent, 1),
+        model_packets_per_second=link_config.get_packets_per_second(streaming=True))
+    return result
+
+
+def print_results(results, baseline=None, tolerance=0.1):
+    """Print a table with the results and, if a baseline is given, the change in packets per
+    second. Return the number of configurations more than tolerance slower than the baseline."""
+    baseline_by_settings = {}
+    for result in baseline or []:
+        baseline_by_settings[Settings(*[result[name] for name in Settings._fields])] = result
+
+    print("%8s %3s %2s %4s %3s %3s %3s %10s %10s %6s %5s %8s %8s %s" % (
+            "rate", "crc", "aw", "size", "aa", "arc", "dpl", "packets/s", "kbit/s", "loss",
+            "dups", "cpu us", "model/s", "vs baseline" if baseline is not None else ""))
+    num_regressions = 0
+    for result in results:
+        settings = Settings(*[result[name] for name in Settings._fields])
+        comparison = ""
+        old = baseline_by_settings.get(settings)
+        if old is not None and old["packets_per_second"] > 0:
+            change = result["packets_per_second"] / old["packets_per_second"] - 1
+            comparison = "%+.1f %%" % (100 * change)
+            if change < -tolerance:
+                comparison += " REGRESSION"
+                num_regressions += 1
+        elif baseline is not None:
+            comparison = "(new)"
+        print("%8d %3d %2d %4d %3d %3d %3d %10.0f %10.1f %5.1f%% %5d %8.1f %8.0f %s" % (
+                settings.data_rate, settings.crc_bytes, settings.address_width,
+                settings.payload_size, settings.auto_ack, settings.arc, settings.dynamic_payload,
+                result["packets_per_second"], result["goodput"] / 1000, 100 * result["loss"],
+                result["duplicates"], 1e6 * result["cpu_time_per_packet"],
+                result["model_packets_per_second"], comparison))
+    return num_regressions
+
+
+def write_csv(path, results):
+    with open(path, "w") as f:
+        writer = csv.DictWriter(f, RESULT_FIELDS)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+
+def write_json(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+def parse_ints(text):
+    return [int(value) for value in text.split(",")]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Throughput for a matrix of settings.")
+    for name in Settings._fields:
+        parser.add_argument("--" + name.replace("_", "-"), type=parse_ints,
+                default=getattr(DEFAULT_SETTINGS, name),
+                help="Comma separated values (default %s)" % ",".join(
+                        str(value) for value in getattr(DEFAULT_SETTINGS, name)))
+    parser.add_argument("--packets", type=int, default=500, help="Packets per configuration")
+    parser.add_argument("--emulate", action="store_true", help="Use emulated radios")
+    parser.add_argument("--loss-rate", type=float, default=0.0, help="Packet loss when emulating")
+    parser.add_argument("--csv", help="Write the results to this CSV file")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+            help="Slowdown compared to the baseline counted as a regression (default 0.1)")
+    options = parser.parse_args(args)
+
+    settings = Settings(*[getattr(options, name) for name in Settings._fields])
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    device_tx, device_rx, cleanup = open_devices(options.emulate, options.loss_rate)
+    results = []
+    try:
+        for configuration in get_settings_matrix(settings):
+            results.append(run_configuration(device_tx, device_rx, configuration, options.packets))
+    finally:
+        cleanup()
+
+    num_regressions = print_results(results, baseline, options.tolerance)
+    if options.csv:
+        write_csv(options.csv, results)
+    if options.json:
+        write_json(options.json, results)
+    if num_regressions:
+        print("%d configurations are slower than the baseline" % num_regressions)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -48,13 +48,23 @@ You can also read many fields and registers at the same time, e.g.
 
     a, b, c, d = device.get(TX_FULL, RX_EMPTY, REG_RX_ADDR_P5, RF_CH)
 
+The chip sends STATUS as the first byte of every SPI transfer, so the
+latest value is always available as device.last_status. If a slightly
+old value is good enough you can avoid a transfer with max_age (in
+seconds), e.g.
+
+    rx_dr, tx_ds = device.get(RX_DR, TX_DS, max_age=100e-6)
+
 To write registers and fields you use the set() function, like this:
 
     device.set(RF_CH(40), REG_RX_ADDR_P0([0x6b, 0x6b, 0x6b, 0x6b, 0x6b]))
 
 
 To write and read the actual packet payload use the functions
-write_tx_payload() and read_rx_payload().
+write_tx_payload() and read_rx_payload(). read_rx_packet() also tells
+when a packet arrived: it returns an NRF24RxPacket with the pipe and
+payload, the time of the IRQ edge, the time it was read and the number
+of packets in the RX FIFO at the time.
 
 
 Thread Safety
@@ -77,6 +87,79 @@ Pi, but I suggest you do protect all calls into this module and
 all other code using GPIO or SPI with a single mutex of some kind if
 you use many threads.
 
+NRF24ThreadSafeDevice lets several threads share one NRF24Device
+without a mutex. A thread of its own does all the SPI transfers, and
+the other threads queue requests and get an NRF24Future back:
+
+    shared = NRF24ThreadSafeDevice(device)
+    shared.start()
+    status = shared.write_tx_payload(payload).result()
+    rx_dr = shared.get(RX_DR).result()
+
+
+Timing
+------
+
+The nRF24L01+ requires a number of short delays, e.g. CE must be high
+for at least 10 microseconds (T_HCE) to send a packet and it takes 130
+microseconds (T_STBY2A) to go from Standby-I to TX or RX mode. 
+time.sleep() is far too inaccurate for that, so the module contains 
+the class NRF24Timer, which sleeps until a deadline by combining 
+time.sleep() with busy-waiting. NRF24Device uses it to keep track of 
+the delays itself:
+
+    device.set(PWR_UP(1))
+    device.pulse_chip_enable()          # Waits for Tpd2stby and Thce
+    device.chip_enable_high()
+    device.wait_for_mode_transition()   # Waits for Tstby2a
+
+Run NRF24Timer().self_test() to see how accurate it is on your system.
+
+
+Faster SPI
+----------
+
+py-spidev converts every transfer from and to Python lists. The class
+NRF24SpiDev talks to /dev/spidevX.Y with ioctl() directly, reusing
+preallocated buffers, and can do several transfers in one system call:
+
+    device = NRF24Device(spi=NRF24SpiDev(0, 0), gpio=NRF24Gpio(17, 22))
+
+
+Recording and Replaying
+-----------------------
+
+Wrap the spi and gpio objects in NRF24RecordingSpi and NRF24RecordingGpio
+to record all SPI transfers, CE changes and IRQ edges to a file:
+
+    writer = NRF24TraceWriter("trace.bin")
+    device = NRF24Device(NRF24RecordingSpi(spi, writer),
+                         NRF24RecordingGpio(gpio, writer))
+
+The trace can later be replayed without any hardware, to reproduce
+a problem or to benchmark your code:
+
+    replay = NRF24TraceReplay(read_trace("trace.bin"))
+    device = NRF24Device(replay.spi, replay.gpio)
+
+
+Sending Files
+-------------
+
+Run as a program, the module sends a file from one Raspberry Pi to
+another. Start the receiver first:
+
+    python -m nrf24 recv-file received.bin --profile reliable
+    python -m nrf24 send-file data.bin --profile reliable
+
+The profiles in TRANSFER_PROFILES (fast, reliable and long-range, or
+a JSON file with the same keys) set data rate, CRC, retransmits, power
+and channel. Files are sent with NRF24ArqSender, or with --no-ack as
+frames with forward error correction which can be sent --repeat times.
+The receiver checks the SHA-256 of the file before writing it. Both
+sides print throughput and statistics while running. send_file() and
+receive_file() do the same from Python.
+
 
 Performance
 -----------
@@ -147,10 +230,7 @@ Example 2: send a 1 byte packet containing 42.
     device.reset_to_default()
     device.set(PWR_UP(1))
     device.write_tx_payload([42])
-    time.sleep(0.01)
-    device.chip_enable_high()
-    time.sleep(0.001)
-    device.chip_enable_low()
+    device.pulse_chip_enable()
 """
 
 # Use this Python code to copy the above comment into README.md:
@@ -158,6 +238,8 @@ Example 2: send a 1 byte packet containing 42.
 
 import collections
 import copy
+import os
+import struct
 import sys
 import threading
 import time
@@ -173,6 +255,16 @@ except:
 
 
 _SPI_NOP = 0xFF
+_SPI_R_RX_PL_WID = 0b01100000
+
+# R_RX_PAYLOAD reading 32 bytes
+_READ_32_BYTES = [0b01100001] + [0] * 32
+
+try:
+    _INTEGER_TYPES = (int, long)
+except NameError:
+    # Python 3
+    _INTEGER_TYPES = (int,)
 
 
 _RegisterFieldInfo = collections.namedtuple("_RegisterFieldInfo", "name start_bit num_bits reset_value rw description")
@@ -413,25 +505,32 @@ Set RX_ADDR_P0 equal to this address to handle automatic acknowledge if this is
 ]
 
 
-def _verify_registers():
-    "Quick check for some inconsitencies in REGISTERS"
-    register_addresses = set()
-    register_names = set()
+# Indexes into _REGISTERS, filled in by _index_registers()
+_REGISTERS_BY_NAME = {}     # e.g. "STATUS" -> _RegisterInfo
+_REGISTERS_BY_ADDRESS = {}  # e.g. 0x07 -> _RegisterInfo
+_FIELDS_BY_NAME = {}        # e.g. "TX_DS" -> (_RegisterInfo, _RegisterFieldInfo), not including "Reserved"
+
+
+def _index_registers():
+    "Fill in the _REGISTERS_BY_* and _FIELDS_BY_NAME indexes and check for some inconsistencies in _REGISTERS"
     for register in _REGISTERS:
-        assert register.name not in register_names
-        register_names.add(register.name)
+        assert register.name not in _REGISTERS_BY_NAME
+        _REGISTERS_BY_NAME[register.name] = register
         
-        assert register.address not in register_addresses
-        register_addresses.add(register.address)
+        assert register.address not in _REGISTERS_BY_ADDRESS
+        _REGISTERS_BY_ADDRESS[register.address] = register
         
         bits = set()
         for field in register.fields:
             for bit in range(field.start_bit, field.start_bit + field.num_bits):
                 assert bit not in bits, "Bit %d in %s overlaps" % (bit, field.name)
                 bits.add(bit)
+            if field.name != "Reserved":
+                assert field.name not in _FIELDS_BY_NAME, "%s already defined" % field.name
+                _FIELDS_BY_NAME[field.name] = (register, field)
         assert bits == set(range(0, 8)) or bits == set(), "Bits in %s:%s is not 0:7 or empty but %r" % (register.name, field.name, bits)
 
-_verify_registers()
+_index_registers()
 
 
 
@@ -453,66 +552,76 @@ class _RegisterFieldSet(object):
     """Represents the value of several fields in one register. Created with the | operator,
     similar to how to OR integers together. 
     Example: PWR_UP(1) | PRIM_RX(1)
+    Field sets are immutable and hashable (two sets setting the same bits to the same
+    values are equal), and the mask and value to write are computed when they are created.
     """
-    
+
+    __slots__ = ("fields", "_address", "_mask", "_value")
+
     def __init__(self, field_or_fieldset=None):
         if field_or_fieldset is None:
-            self.fields = []
+            fields = ()
         elif isinstance(field_or_fieldset, _RegisterField):
-            self.fields = [field_or_fieldset]
+            fields = (field_or_fieldset,)
         else:
             assert isinstance(field_or_fieldset, _RegisterFieldSet)
-            self.fields = copy.copy(field_or_fieldset.fields)
+            fields = field_or_fieldset.fields
+        self._freeze(fields)
+
+    def _freeze(self, fields):
+        "Check fields (a tuple) and set the attributes, which can't be changed after this."
+        address = None
+        mask = 0
+        value = 0
+        for f in fields:
+            assert address is None or f.REGISTER_ADDRESS == address, (
+                "%s and %s are in different registers" % (f.REGISTER_NAME, fields[0].REGISTER_NAME))
+            m = _get_mask(f)
+            assert mask & m == 0, "%s already included" % f.FIELD_NAME
+            address = f.REGISTER_ADDRESS
+            mask |= m
+            value |= f.get_unshifted_value()
+        assert 0 <= mask <= 0xFF and (value & mask) == value
+        object.__setattr__(self, "fields", fields)
+        object.__setattr__(self, "_address", address)
+        object.__setattr__(self, "_mask", mask)
+        object.__setattr__(self, "_value", value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%r is immutable" % self)
+
+    def __reduce__(self):
+        return (_make_field_set, (self.fields,))
 
     def get_register_address(self):
         assert len(self.fields) >= 1
-        address = self.fields[0].REGISTER_ADDRESS
-        return address
+        return self._address
     
     def get_register_name(self):
         assert len(self.fields) >= 1
-        address = self.fields[0].REGISTER_NAME
-        return address
+        return self.fields[0].REGISTER_NAME
 
     def get_mask(self):
-        mask = 0
-        for f in self.fields:
-            m = _get_mask(f)
-            assert mask & m == 0
-            mask |= m
-        assert 0 <= mask <= 0xFF
-        return mask
+        return self._mask
 
     def get_value(self):
-        value = 0
-        for f in self.fields:
-            v = f.get_unshifted_value()
-            assert 0 <= value <= 0xFF
-            value |= v
-        assert (value & self.get_mask()) == value
-        return value
+        return self._value
         
     def get_num_fields(self):
         return len(self.fields)
 
-    def __ior__(self, other):
-        if isinstance(other, _RegisterField):
-            assert self.fields == [] or other.REGISTER_ADDRESS == self.get_register_address(), (
-                "%s and %s are in different registers" % (
-                        other.REGISTER_NAME, self.get_register_name()))
-            assert all(other.FIELD_NAME != f.FIELD_NAME for f in self.fields), (
-                "%s already included" % other.FIELD_NAME)
-            self.fields.append(other)
-        else:
-            assert isinstance(other, _RegisterFieldSet)
-            for f in other.fields:
-                self |= f
-        return self
-
     def __or__(self, other):
-        r = _RegisterFieldSet(self)
-        r |= other
-        return r
+        return _combine_fields(self, other)
+
+    def __eq__(self, other):
+        return (isinstance(other, _RegisterFieldSet) and
+                (self._address, self._mask, self._value) == (other._address, other._mask, other._value))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._address, self._mask, self._value))
 
     def __str__(self):
         return repr(self)
@@ -521,26 +630,70 @@ class _RegisterFieldSet(object):
         return " | ".join(repr(f) for f in self.fields) or "_RegisterFieldSet()"
 
 
+# Results of | on fields and field sets. Since both are immutable the same result can be
+# reused, so configuring a device with the same fields over and over doesn't allocate anything.
+_COMBINED_FIELDS = {}
+_MAX_COMBINED_FIELDS = 4096
+
+
+def _combine_fields(a, b):
+    "Return a | b where a and b are fields or field sets."
+    key = (a, b)
+    result = _COMBINED_FIELDS.get(key)
+    if result is None:
+        assert isinstance(b, (_RegisterField, _RegisterFieldSet)), "Can't combine %r with %r" % (a, b)
+        other_fields = (b,) if isinstance(b, _RegisterField) else b.fields
+        fields = ((a,) if isinstance(a, _RegisterField) else a.fields) + other_fields
+        result = _make_field_set(fields)
+        if len(_COMBINED_FIELDS) >= _MAX_COMBINED_FIELDS:
+            _COMBINED_FIELDS.clear()
+        _COMBINED_FIELDS[key] = result
+    return result
+
+
+def _make_field_set(fields):
+    field_set = _RegisterFieldSet.__new__(_RegisterFieldSet)
+    field_set._freeze(tuple(fields))
+    return field_set
+
+
 class _RegisterField(object):
     """One subclass of this class will be created for each field in each variable and added
     to this Python module to be used directly in code. E.g. PWR_UP will be a subclass and it 
     will contain information about the PWR_UP field, like bit position, description etc.
+    Instances are immutable and interned, i.e. PWR_UP(1) always returns the same object.
     """
 
-    def __init__(self, value=None):
-        assert value is None or "W" in self.RW, (
-                "Can't write to register %s:%s" % (self.REGISTER_NAME, self.FIELD_NAME))
-        assert value is None or 0 <= value <= self.get_max_value(), (
-                "%d is out of range for register %s:%s" % (value, self.REGISTER_NAME, self.FIELD_NAME))
-        self.value = value
+    __slots__ = ("value", "_unshifted_value")
+
+    def __new__(cls, value=None):
+        try:
+            return cls._INSTANCES[value]
+        except KeyError:
+            pass
+        assert value is None or "W" in cls.RW, (
+                "Can't write to register %s:%s" % (cls.REGISTER_NAME, cls.FIELD_NAME))
+        assert value is None or 0 <= value <= cls.get_max_value(), (
+                "%d is out of range for register %s:%s" % (value, cls.REGISTER_NAME, cls.FIELD_NAME))
+        self = object.__new__(cls)
+        object.__setattr__(self, "value", value)
+        if value is not None:
+            unshifted_value = value << cls.START_BIT
+            assert unshifted_value & _get_mask(cls) == unshifted_value, "%r, mask %r" % (self, _get_mask(cls))
+            object.__setattr__(self, "_unshifted_value", unshifted_value)
+        return cls._INSTANCES.setdefault(value, self)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%r is immutable" % self)
+
+    def __reduce__(self):
+        return (type(self), (self.value,))
 
     def get_unshifted_value(self):
         """Returns the value not shifted down to lowest bits. 
         Example: RX_P_NO(7).get_unshifted_value() == 14 # because RX_P_NO starts at bit 1.
         """
-        value = self.value << self.START_BIT
-        assert value & _get_mask(self) == value, "%r, mask %r" % (self, _get_mask(self))
-        return value
+        return self._unshifted_value
 
     @classmethod
     def get_max_value(cls):
@@ -558,7 +711,7 @@ class _RegisterField(object):
         return ((x >> cls.START_BIT) & _get_unshifted_mask(cls))
 
     def __or__(self, other):
-        return _RegisterFieldSet(self) | other
+        return _combine_fields(self, other)
 
     def __str__(self):
         return repr(self)
@@ -566,6 +719,25 @@ class _RegisterField(object):
     def __repr__(self):
         return "%s(%d)" % (self.FIELD_NAME, self.value)
 
+    @classmethod
+    def _build_docstring(cls):
+        docstring = "%s (bit %s) in register %s (address 0x%02X).\n" % (
+                cls.FIELD_NAME,
+                ("%d" % cls.START_BIT) if cls.NUM_BITS == 1 else "%d:%d" % (cls.START_BIT, cls.START_BIT+cls.NUM_BITS-1),
+                cls.REGISTER_NAME,
+                cls.REGISTER_ADDRESS)
+                
+        if cls.RW == "R/W":
+            docstring += "Readable and writable. "
+        else:
+            assert cls.RW == "R"
+            docstring += "Read only. "
+
+        docstring += "Reset value %d.\n" % cls.RESET_VALUE
+        docstring += "Nordic Semiconductor documentation:\n"
+        docstring += cls.DESCRIPTION
+        return docstring
+
     # Define thse static constants in subclasses:
     # REGISTER_NAME - e.g. "STATUS"
     # REGISTER_ADDRESS - e.g. 0x07
@@ -599,6 +771,17 @@ class _Register(object):
     def __repr__(self):
         return "%s(%d)" % (self.NAME, self.value)
 
+    @classmethod
+    def _build_docstring(cls):
+        docstring = "Register %s at address 0x%02X. Size %s.\n" % (cls.NAME[len("REG_"):], cls.ADDRESS,
+                        ("%d byte" % cls.MIN_SIZE) if cls.MIN_SIZE==cls.MAX_SIZE else
+                        ("%d-%d bytes" % (cls.MIN_SIZE, cls.MAX_SIZE)))
+        if len(cls.FIELDS) > 0:
+            docstring += "Fields: %s\n" % ", ".join(f.FIELD_NAME for f in cls.FIELDS)
+        docstring += "Nordic Semiconductor documentation:\n"
+        docstring += cls.DESCRIPTION
+        return docstring
+
     # Define these static constants in subclasses
     # NAME - e.g. "STATUS"
     # ADDRESS - e.g. 0x07
@@ -609,27 +792,22 @@ class _Register(object):
 
 
 
+class _LazyDocstring(object):
+    """Used as __doc__ in the register and field classes so that the (rather long)
+    docstrings are only built when someone actually reads them, e.g. in help()."""
+
+    def __get__(self, obj, cls):
+        return cls._build_docstring()
+
+
+_LAZY_DOCSTRING = _LazyDocstring()
+
+
 def _create_field_class(register_name, register_address, field_name, start_bit, num_bits,
                         reset_value, rw, description):
     assert 0 <= start_bit <= 7
     assert 1 <= start_bit+num_bits <= 8
     assert rw in ("R", "W", "R/W"), rw
-    
-    docstring = "%s (bit %s) in register %s (address 0x%02X).\n" % (
-            field_name,
-            ("%d" % start_bit) if num_bits == 1 else "%d:%d" % (start_bit, start_bit+num_bits-1),
-            register_name,
-            register_address)
-            
-    if rw == "R/W":
-        docstring += "Readable and writable. "
-    else:
-        assert rw == "R"
-        docstring += "Read only. "
-
-    docstring += "Reset value %d.\n" % reset_value
-    docstring += "Nordic Semiconductor documentation:\n"
-    docstring += description
 
     return type(
             field_name,
@@ -643,25 +821,19 @@ def _create_field_class(register_name, register_address, field_name, start_bit,
                 RESET_VALUE=reset_value,
                 RW=rw,
                 DESCRIPTION=description,
-                __doc__=docstring
+                _INSTANCES={},
+                __slots__=(),
+                __doc__=_LAZY_DOCSTRING
             )
         )
 
 
-def _create_register_class(real_register_name, python_register_name, address,
+def _create_register_class(python_register_name, address,
                             min_size, max_size, fields, description):
     assert 1 <= min_size <= max_size
     assert all(issubclass(f, _RegisterField) for f in fields), repr(fields)
     assert 0 <= address <= 0x1F, "Address must be less than 0x1F, not %r" % address
 
-    docstring = "Register %s at address 0x%02X. Size %s.\n" % (real_register_name, address,
-                    ("%d byte" % min_size) if min_size==max_size else
-                    ("%d-%d bytes" % (min_size, max_size)))
-    if len(fields) > 0:
-        docstring += "Fields: %s\n" % ", ".join(f.FIELD_NAME for f in fields)
-    docstring += "Nordic Semiconductor documentation:\n"
-    docstring += description
-
     return type(
             python_register_name,
             (_Register,),
@@ -672,57 +844,163 @@ def _create_register_class(real_register_name, python_register_name, address,
                 MAX_SIZE=max_size,
                 FIELDS=fields,
                 DESCRIPTION=description,
-                __doc__=docstring))
+                __doc__=_LAZY_DOCSTRING))
 
 
 def _create_module_variables():
-    """Adds all the register and field subclasses and assigns them to variables 
-    in this Python module. e.g. PWR_UP, TX_FULL, REG_STATUS etc.
-    """
-    
-    module = sys.modules[__name__]
+    """Create all the register and field subclasses and assign them to variables in this
+    Python module, e.g. PWR_UP, TX_FULL, REG_STATUS etc. Their docstrings are only built
+    when read (see _LazyDocstring), which is what took most of the time."""
+    module_variables = globals()
     for register in _REGISTERS:
         fields = []
         for field in register.fields:
-            assert not hasattr(module, field.name), "%s already defined" % field.name
-
             if field.name != "Reserved":
+                assert field.name not in module_variables, "%s already defined" % field.name
                 class_ = _create_field_class(register.name,
-                                            register.address,
-                                            field.name,
-                                            field.start_bit,
-                                            field.num_bits,
-                                            field.reset_value,
-                                            field.rw,
-                                            field.description)
-                setattr(module, field.name, class_)
+                                             register.address,
+                                             field.name,
+                                             field.start_bit,
+                                             field.num_bits,
+                                             field.reset_value,
+                                             field.rw,
+                                             field.description)
+                module_variables[field.name] = class_
                 fields.append(class_)
 
         python_register_name = "REG_" + register.name
-        assert not hasattr(module, python_register_name)
-        r = _create_register_class(register.name,
-                                    python_register_name,
-                                    register.address,
-                                    register.min_size,
-                                    register.max_size,
-                                    tuple(fields),
-                                    register.description)
-        setattr(module, python_register_name, r)
-
+        assert python_register_name not in module_variables
+        module_variables[python_register_name] = _create_register_class(python_register_name,
+                                                                         register.address,
+                                                                         register.min_size,
+                                                                         register.max_size,
+                                                                         tuple(fields),
+                                                                         register.description)
 
 
 _create_module_variables()
 
 
+def find_register(name_or_address):
+    """Return the register subclass with the given name (with or without the REG_ prefix)
+    or address, or None if there is no such register.
+    Example: find_register(0x07) is find_register("STATUS") is REG_STATUS
+    """
+    if isinstance(name_or_address, str):
+        name = name_or_address[len("REG_"):] if name_or_address.startswith("REG_") else name_or_address
+        register = _REGISTERS_BY_NAME.get(name)
+    else:
+        register = _REGISTERS_BY_ADDRESS.get(name_or_address)
+    if register is None:
+        return None
+    return globals()["REG_" + register.name]
+
+
+def find_field(name):
+    """Return the field subclass with the given name, or None if there is no such field.
+    Example: find_field("PWR_UP") is PWR_UP
+    """
+    if name not in _FIELDS_BY_NAME:
+        return None
+    return globals()[name]
+
+
+def _import_numpy():
+    # Imported on demand, since numpy is optional and takes a long time to import.
+    import numpy
+    return numpy
+
+
+def decode_register_values(register, values, structured=False):
+    """Decode many values of a one byte register at once, e.g. STATUS bytes logged
+    from every SPI transaction. register is a register subclass (e.g. REG_STATUS), its
+    name or its address. values is anything numpy can convert to an array of uint8.
+    Returns a dict with field names as keys and numpy uint8 arrays (of the same shape as
+    values) as values, or a numpy structured array with one field per register field if
+    structured is True. Requires numpy.
+    Example:
+        fields = decode_register_values(REG_STATUS, [0x0E, 0x40, 0x2E])
+        fields["RX_DR"]     # array([0, 1, 0], dtype=uint8)
+        fields["RX_P_NO"]   # array([7, 0, 7], dtype=uint8)
+    """
+    numpy = _import_numpy()
+    if not (isinstance(register, type) and issubclass(register, _Register)):
+        register_class = find_register(register)
+        assert register_class is not None, "No register %r" % (register,)
+        register = register_class
+    assert register.MIN_SIZE == register.MAX_SIZE == 1, (
+            "Can only decode one byte registers, not %s" % register.NAME)
+
+    values = numpy.asarray(values)
+    assert values.size == 0 or 0 <= values.min() and values.max() <= 255, "Values must be 0-255"
+    values = values.astype(numpy.uint8, copy=False)
+
+    decoded = collections.OrderedDict()
+    for field in register.FIELDS:
+        decoded[field.FIELD_NAME] = (values >> field.START_BIT) & _get_unshifted_mask(field)
+
+    if not structured:
+        return decoded
+
+    result = numpy.empty(values.shape, dtype=[(name, numpy.uint8) for name in decoded])
+    for name, field_values in decoded.items():
+        result[name] = field_values
+    return result
+
+
+def get_rx_pipe_transitions(status_values):
+    """Find where RX_P_NO changes in a sequence of STATUS values. Returns a tuple
+    (indices, old_pipes, new_pipes) of numpy arrays, where indices are the positions in
+    status_values where RX_P_NO changed from old_pipes to new_pipes. Requires numpy.
+    Example:
+        get_rx_pipe_transitions([0x0E, 0x02, 0x02, 0x0E])
+        # (array([1, 3]), array([7, 1], dtype=uint8), array([1, 7], dtype=uint8))
+    """
+    numpy = _import_numpy()
+    rx_p_no = decode_register_values(REG_STATUS, status_values)["RX_P_NO"]
+    indices = numpy.flatnonzero(rx_p_no[1:] != rx_p_no[:-1]) + 1
+    return indices, rx_p_no[indices - 1], rx_p_no[indices]
+
+
+def get_fifo_duty_cycles(fifo_status_values, timestamps=None):
+    """Return a dict with the fraction of time each of the FIFO_STATUS flags TX_FULL_, 
+    TX_EMPTY, RX_FULL and RX_EMPTY was set, given a sequence of FIFO_STATUS values. If
+    timestamps (one per value, in any unit) is given, each value is weighted by the time
+    until the next one, otherwise all values have the same weight. Requires numpy.
+    Example:
+        get_fifo_duty_cycles([0x11, 0x11, 0x13, 0x12])["RX_FULL"]  # 0.5
+    """
+    numpy = _import_numpy()
+    fields = decode_register_values(REG_FIFO_STATUS, fifo_status_values)
+    if timestamps is None:
+        weights = None
+    else:
+        timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+        assert timestamps.shape == fields["RX_EMPTY"].shape, "Need one timestamp per value"
+        # The last value has no known duration, so it gets no weight
+        weights = numpy.append(numpy.diff(timestamps), 0.0)
+
+    result = {}
+    for name in ("TX_FULL_", "TX_EMPTY", "RX_FULL", "RX_EMPTY"):
+        if fields[name].size == 0 or weights is not None and weights.sum() <= 0:
+            result[name] = 0.0
+        else:
+            result[name] = float(numpy.average(fields[name], weights=weights))
+    return result
+
+
 def _to_bytes(value):
-    if isinstance(value, (int, long)):
+    if isinstance(value, _INTEGER_TYPES):
         assert 0 <= value <= 255, "Value must be between 0 and 255 (inclusive), not %r" % value
         result = [value]
     elif isinstance(value, str):
         result = [ord(c) for c in value]
+    elif isinstance(value, (bytes, bytearray)):
+        # E.g. from NRF24PayloadSchema.encode()
+        result = list(bytearray(value))
     else:
-        assert isinstance(value, list), "Value must be an int, a string, or a list, not %r" % value
-        assert all(isinstance(v, (int, long)) for v in value), "Value must only contain integers, not %r" % value
+        assert isinstance(value, list), "Value must be an int, a string, bytes or a list, not %r" % value
+        assert all(isinstance(v, _INTEGER_TYPES) for v in value), "Value must only contain integers, not %r" % value
         assert all(0 <= v <= 255 for v in value), "Value must contain integers between 0 and 255, not %r" % value
         result = copy.copy(value)
 
@@ -768,6 +1046,300 @@ def _assert_valid_register_and_size(address, size):
 
 
 
+# Timing requirements from the nRF24L01+ product specification, in seconds.
+T_HCE = 10e-6       # Minimum CE high time to send one packet (Thce)
+T_PECE2CSN = 4e-6   # Delay from CE positive edge to CSN low (Tpece2csn)
+T_STBY2A = 130e-6   # Settling time from Standby to TX or RX mode (Tstby2a)
+T_PD2STBY = 4.5e-3  # Power Down to Standby (Tpd2stby), worst case crystal (1.5 ms for Ls < 30 mH)
+T_TX_MAX = 4e-3     # Never stay in TX mode for longer than this at a time
+
+
+if hasattr(time, "perf_counter_ns"):
+    _perf_counter_ns = time.perf_counter_ns
+elif hasattr(time, "perf_counter"):
+    def _perf_counter_ns():
+        return int(time.perf_counter() * 1e9)
+else:
+    def _perf_counter_ns():
+        return int(time.time() * 1e9)
+
+
+NRF24TimerJitter = collections.namedtuple("NRF24TimerJitter", "delay mean median p99 max")
+
+
+# Longest time NRF24Timer.calibrate() with the default arguments is expected to take
+_TIMER_CALIBRATION_TIME_NS = 10*1000*1000
+
+
+class NRF24Timer(object):
+    """Sleeps with sub-millisecond accuracy. time.sleep() typically overshoots by 50-100
+    microseconds on a Raspberry Pi, which is longer than most of the delays the nRF24L01+
+    requires. This class uses time.sleep() until spin_threshold before the deadline and
+    then busy-waits on time.perf_counter_ns() (or the best clock available) for the rest.
+    Times and deadlines are ints in nanoseconds as returned by now_ns().
+    Example:
+        timer = NRF24Timer()
+        deadline = timer.deadline(T_STBY2A)
+        ... # Do other things
+        timer.sleep_until(deadline)
+    """
+
+    now_ns = staticmethod(_perf_counter_ns)
+
+    def __init__(self, spin_threshold=None):
+        """spin_threshold is the time in seconds before a deadline when we stop calling
+        time.sleep() and start busy-waiting. If None, it's calibrated during the first wait long
+        enough to absorb the calibration, shorter waits before that only busy-wait.
+        """
+        self._spin_threshold_ns = None if spin_threshold is None else int(spin_threshold * 1e9)
+
+    def deadline(self, seconds, start_ns=None):
+        "Return the time in nanoseconds seconds after start_ns (or now if start_ns is None)."
+        if start_ns is None:
+            start_ns = _perf_counter_ns()
+        return start_ns + int(seconds * 1e9 + 0.5)
+
+    def calibrate(self, num_samples=20, sleep_time=100e-6):
+        """Measure how much time.sleep() overshoots and set the spin threshold to twice the
+        90th percentile of that. Return the new spin threshold in seconds."""
+        sleep_time_ns = int(sleep_time * 1e9)
+        overshoots = []
+        for i in range(num_samples):
+            start = _perf_counter_ns()
+            time.sleep(sleep_time)
+            overshoots.append(max(0, _perf_counter_ns() - start - sleep_time_ns))
+        overshoots.sort()
+        self._spin_threshold_ns = 2 * overshoots[(len(overshoots) * 9) // 10]
+        return self._spin_threshold_ns / 1e9
+
+    def get_spin_threshold(self):
+        "Return the spin threshold in seconds, calibrating it first if needed."
+        if self._spin_threshold_ns is None:
+            self.calibrate()
+        return self._spin_threshold_ns / 1e9
+
+    def sleep_until(self, deadline_ns):
+        "Return when now_ns() >= deadline_ns. Returns immediately if the deadline has passed."
+        remaining = deadline_ns - _perf_counter_ns()
+        if remaining <= 0:
+            return
+        if self._spin_threshold_ns is None:
+            if remaining < _TIMER_CALIBRATION_TIME_NS:
+                # Calibrating would make us late, e.g. for the microseconds of T_PECE2CSN
+                while _perf_counter_ns() < deadline_ns:
+                    pass
+                return
+            self.calibrate()
+            remaining = deadline_ns - _perf_counter_ns()
+        if remaining > self._spin_threshold_ns:
+            time.sleep((remaining - self._spin_threshold_ns) / 1e9)
+        while _perf_counter_ns() < deadline_ns:
+            pass
+
+    def sleep(self, seconds):
+        "Like time.sleep() but more accurate."
+        self.sleep_until(self.deadline(seconds))
+
+    def self_test(self, delays=(T_PECE2CSN, T_HCE, T_STBY2A, 1e-3, T_TX_MAX), num_samples=100):
+        """Sleep for each of delays num_samples times and return a list of NRF24TimerJitter,
+        one for each delay, describing how late sleep() returned (mean, median, 99th
+        percentile and max, all in seconds). Example:
+            for jitter in NRF24Timer().self_test():
+                print("%6.0f us: median %.1f us, max %.1f us late" % (
+                        jitter.delay*1e6, jitter.median*1e6, jitter.max*1e6))
+        """
+        result = []
+        for delay in delays:
+            lateness = []
+            for i in range(num_samples):
+                deadline = self.deadline(delay)
+                self.sleep_until(deadline)
+                lateness.append(_perf_counter_ns() - deadline)
+            lateness.sort()
+            result.append(NRF24TimerJitter(
+                    delay,
+                    sum(lateness) / len(lateness) / 1e9,
+                    lateness[len(lateness) // 2] / 1e9,
+                    lateness[min(len(lateness) - 1, (len(lateness) * 99) // 100)] / 1e9,
+                    lateness[-1] / 1e9))
+        return result
+
+
+# Used by all NRF24Device objects which are not given another timer
+_default_timer = NRF24Timer()
+
+
+# Time from the end of a transmission until IRQ is asserted (Tirq), per data rate in bits/s
+_T_IRQ = {250*1000: 8.2e-6, 1000*1000: 8.2e-6, 2000*1000: 6.0e-6}
+
+# The shortest ARD which leaves room for an ACK with a payload of at most the given number of
+# bytes, per data rate, from section 7.4.2 of the product specification. (ard, max_ack_payload)
+_MIN_ARD_FOR_ACK_PAYLOAD = {
+    2000*1000: [(250e-6, 15), (500e-6, 32)],
+    1000*1000: [(250e-6, 5), (500e-6, 32)],
+    250*1000: [(500e-6, 0), (750e-6, 8), (1000e-6, 16), (1250e-6, 24), (1500e-6, 32)],
+}
+
+
+class NRF24LinkConfig(object):
+    """Describes a radio configuration and computes its timing: time on air, ACK turnaround,
+    retransmit delays and the expected packets/s and goodput for a given loss rate. Use it to
+    choose a configuration, or to compare a measured throughput with the theoretical maximum.
+    Create it with the parameters you plan to use, or with from_device() to use the current
+    configuration of a device. All times are in seconds and rates in bits/s.
+    Example:
+        config = NRF24LinkConfig(data_rate=2000*1000, address_width=3, crc_bytes=0,
+                                 auto_ack=False)
+        print(config.to_string(loss_rate=0.01))
+    """
+
+    def __init__(self, data_rate=2000*1000, address_width=5, crc_bytes=1, payload_size=32,
+                 dynamic_payload=False, auto_ack=True, ack_payload_size=0, ard=250e-6, arc=3,
+                 spi_speed_hz=10*1000*1000, host_overhead=0.0):
+        """The defaults are the reset values of the chip. ack_payload_size is the size of the
+        payloads sent with ACKs (0 for none). ard is the auto retransmit delay (250e-6 to
+        4000e-6) and arc the max number of retransmits. spi_speed_hz is used to compute the time
+        to upload payloads and host_overhead is the time your program spends per packet.
+        """
+        assert data_rate in _T_IRQ, "Data rate must be one of %r, not %r" % (sorted(_T_IRQ), data_rate)
+        assert 3 <= address_width <= 5, "Invalid address width %r" % address_width
+        assert crc_bytes in (0, 1, 2), "Invalid number of CRC bytes %r" % crc_bytes
+        assert 1 <= payload_size <= 32, "Invalid payload size %r" % payload_size
+        assert 0 <= ack_payload_size <= 32, "Invalid ACK payload size %r" % ack_payload_size
+        assert 0 <= arc <= 15, "Invalid ARC %r" % arc
+        self.data_rate = data_rate
+        self.address_width = address_width
+        # CRC is forced on by the chip when auto ACK is enabled
+        self.crc_bytes = max(crc_bytes, 1) if auto_ack else crc_bytes
+        self.payload_size = payload_size
+        self.dynamic_payload = dynamic_payload
+        self.auto_ack = auto_ack
+        self.ack_payload_size = ack_payload_size if auto_ack else 0
+        self.ard = ard
+        self.arc = arc if auto_ack else 0
+        self.spi_speed_hz = spi_speed_hz
+        self.host_overhead = host_overhead
+
+    @classmethod
+    def from_device(cls, device, pipe=0, payload_size=None, ack_payload_size=0, **kwargs):
+        """Read the current configuration from an NRF24Device. pipe decides which of the
+        ENAA_Px, DPL_Px and RX_PW_Px fields to use. payload_size defaults to RX_PW_Px.
+        Other keyword arguments are passed on to the constructor."""
+        assert 0 <= pipe <= 5, "Invalid pipe %r" % pipe
+        rf_dr_low, rf_dr_high, aw, en_crc, crco, ard, arc, en_dpl, en_ack_pay, en_aa, dynpd, rx_pw = device.get(
+                RF_DR_LOW, RF_DR_HIGH, AW, EN_CRC, CRCO,
+                ARD, ARC, EN_DPL, EN_ACK_PAY, REG_EN_AA,
+                REG_DYNPD, find_field("RX_PW_P%d" % pipe))
+        auto_ack = bool(en_aa & (1 << pipe))
+        return cls(data_rate=250*1000 if rf_dr_low else (2000*1000 if rf_dr_high else 1000*1000),
+                   address_width=aw + 2,
+                   crc_bytes=(crco + 1) if en_crc or auto_ack else 0,
+                   payload_size=payload_size or rx_pw or 32,
+                   dynamic_payload=bool(en_dpl and dynpd & (1 << pipe)),
+                   auto_ack=auto_ack,
+                   ack_payload_size=ack_payload_size if en_ack_pay else 0,
+                   ard=(ard + 1) * 250e-6,
+                   arc=arc,
+                   **kwargs)
+
+    def _get_packet_bits(self, payload_size):
+        # Preamble, address, payload and CRC, plus the 9 bit packet control field which is only
+        # left out in the nRF2401 compatible mode without auto ACK and dynamic payload length
+        bits = 8 * (1 + self.address_width + payload_size + self.crc_bytes)
+        if self.auto_ack or self.dynamic_payload:
+            bits += 9
+        return bits
+
+    def get_time_on_air(self):
+        "Time to transmit one packet (Toa)."
+        return float(self._get_packet_bits(self.payload_size)) / self.data_rate
+
+    def get_ack_time_on_air(self):
+        "Time to transmit one ACK packet, including any ACK payload (Tack)."
+        if not self.auto_ack:
+            return 0.0
+        return float(self._get_packet_bits(self.ack_payload_size)) / self.data_rate
+
+    def get_upload_time(self):
+        "Time to write one payload to the TX FIFO over SPI (Tul)."
+        return 8.0 * (1 + self.payload_size) / self.spi_speed_hz
+
+    def get_ack_turnaround_time(self):
+        "Time from the end of a transmission until the ACK has been received and IRQ asserted."
+        if not self.auto_ack:
+            return 0.0
+        return T_STBY2A + self.get_ack_time_on_air() + _T_IRQ[self.data_rate]
+
+    def get_min_ard(self):
+        """The shortest ARD that works with the ACK payload size according to the product
+        specification, or None if no ARD is long enough."""
+        for ard, max_ack_payload in _MIN_ARD_FOR_ACK_PAYLOAD[self.data_rate]:
+            if self.ack_payload_size <= max_ack_payload:
+                return ard
+        return None
+
+    def is_ard_sufficient(self):
+        "Return True if ARD is long enough to receive the ACK (with payload) before retransmitting."
+        min_ard = self.get_min_ard()
+        return not self.auto_ack or min_ard is not None and self.ard >= min_ard - 1e-9
+
+    def get_packet_time(self, loss_rate=0.0, streaming=False):
+        """The expected time to send one packet, including retransmits, if each transmission is
+        lost with probability loss_rate. With auto ACK, packets are sent one at a time (stop and
+        wait). Without auto ACK and with streaming True, CE is kept high and the TX FIFO is kept
+        full, so the settling time is only paid once and uploads overlap with transmissions."""
+        assert 0.0 <= loss_rate < 1.0, "Invalid loss rate %r" % loss_rate
+        host_time = self.get_upload_time() + self.host_overhead
+        time_on_air = self.get_time_on_air()
+        if not self.auto_ack:
+            air_time = time_on_air + _T_IRQ[self.data_rate]
+            if streaming:
+                return max(air_time, host_time)
+            return host_time + T_STBY2A + air_time
+
+        # Each transmission lost costs Toa + ARD, the last successful one Toa + ACK turnaround
+        num_attempts = self.arc + 1
+        expected_num_failures = sum(loss_rate ** k for k in range(1, num_attempts + 1))
+        success_rate = 1.0 - loss_rate ** num_attempts
+        return (host_time + T_STBY2A +
+                expected_num_failures * (time_on_air + self.ard) +
+                success_rate * (time_on_air + self.get_ack_turnaround_time()))
+
+    def get_delivery_rate(self, loss_rate=0.0):
+        "The fraction of packets delivered, after any retransmits."
+        if not self.auto_ack:
+            return 1.0 - loss_rate
+        return 1.0 - loss_rate ** (self.arc + 1)
+
+    def get_packets_per_second(self, loss_rate=0.0, streaming=False):
+        "Expected number of packets sent (including lost ones) per second."
+        return 1.0 / self.get_packet_time(loss_rate, streaming)
+
+    def get_goodput(self, loss_rate=0.0, streaming=False):
+        "Expected number of payload bits per second delivered to the receiver."
+        return (8.0 * self.payload_size * self.get_delivery_rate(loss_rate) /
+                self.get_packet_time(loss_rate, streaming))
+
+    def to_string(self, loss_rate=0.0, streaming=False):
+        "Return a table with the timing of this configuration, useful for printing."
+        min_ard = self.get_min_ard()
+        table = [
+            ("Time on air:", "  %.1f us" % (1e6 * self.get_time_on_air())),
+            ("ACK time on air:", "  %.1f us" % (1e6 * self.get_ack_time_on_air())),
+            ("ACK turnaround:", "  %.1f us" % (1e6 * self.get_ack_turnaround_time())),
+            ("Upload time:", "  %.1f us" % (1e6 * self.get_upload_time())),
+            ("ARD:", "  %.0f us (min %s)%s" % (
+                    1e6 * self.ard,
+                    "none" if min_ard is None else "%.0f us" % (1e6 * min_ard),
+                    "" if self.is_ard_sufficient() else ", TOO SHORT")),
+            ("Packet time:", "  %.1f us" % (1e6 * self.get_packet_time(loss_rate, streaming))),
+            ("Packets/s:", "  %.0f" % self.get_packets_per_second(loss_rate, streaming)),
+            ("Goodput:", "  %.0f kbit/s" % (self.get_goodput(loss_rate, streaming) / 1000)),
+        ]
+        return _tabulate(table)
+
+
+
 class CancelFailedException(Exception):
     """Raised when trying to cancel a wait for an irq when no thread is waiting."""
     pass
@@ -806,6 +1378,619 @@ class NRF24Gpio(object):
         GPIO.remove_event_detect(self.irq_pin)
 
 
+# struct spi_ioc_transfer from linux/spi/spidev.h: tx_buf, rx_buf, len, speed_hz, delay_usecs,
+# bits_per_word, cs_change, tx_nbits, rx_nbits, word_delay_usecs and padding.
+_SPI_IOC_TRANSFER = struct.Struct("=QQIIHBBBBBB")
+_SPI_IOC_LEN_OFFSET = 16
+_SPI_IOC_CS_CHANGE_OFFSET = 27
+# Longest transfer NRF24Device does, a command byte followed by a 32 byte payload
+_SPI_MAX_TRANSFER_SIZE = 33
+
+
+def _spi_ioc_write(number, size):
+    "The _IOW('k', number, size) ioctl request number used by spidev."
+    return (1 << 30) | (size << 16) | (ord("k") << 8) | number
+
+
+SPI_IOC_WR_MODE = _spi_ioc_write(1, 1)
+SPI_IOC_WR_BITS_PER_WORD = _spi_ioc_write(3, 1)
+SPI_IOC_WR_MAX_SPEED_HZ = _spi_ioc_write(4, 4)
+
+
+def SPI_IOC_MESSAGE(num_transfers):
+    "The ioctl request number to do num_transfers transfers in one SPI message."
+    return _spi_ioc_write(0, num_transfers * _SPI_IOC_TRANSFER.size)
+
+
+class NRF24SpiDev(object):
+    """An spi object for NRF24Device talking directly to the Linux spidev driver with ioctl()
+    instead of going through py-spidev. The transfer structs and the buffers are allocated once
+    and reused for every transfer, so the only per transfer work is copying the data in and out.
+    Implements xfer2_batch() to do several transfers (with CSN high in between) in one ioctl().
+    The ioctl and fd arguments are for testing, see NRF24FakeSpiIoctl.
+    Example:
+        spi = NRF24SpiDev(0, 0, max_speed_hz=10*1000*1000)
+        device = NRF24Device(spi=spi, gpio=NRF24Gpio(chip_enable_pin=17, irq_pin=22))
+    """
+
+    def __init__(self, bus=0, chip_select=0, max_speed_hz=10*1000*1000, max_transfers=4,
+                 ioctl=None, fd=None):
+        """Opens /dev/spidev<bus>.<chip_select> unless fd is given. max_transfers is the max number
+        of transfers in one call to xfer2_batch(). ioctl defaults to fcntl.ioctl."""
+        import ctypes
+        if ioctl is None:
+            import fcntl
+            ioctl = fcntl.ioctl
+        self._ioctl = ioctl
+        if fd is None:
+            self._fd = os.open("/dev/spidev%d.%d" % (bus, chip_select), os.O_RDWR)
+            self._close_fd = True
+        else:
+            self._fd = fd
+            self._close_fd = False
+        self.max_speed_hz = int(max_speed_hz)
+        self.max_transfers = max_transfers
+
+        self._ioctl(self._fd, SPI_IOC_WR_MODE, struct.pack("=B", 0))
+        self._ioctl(self._fd, SPI_IOC_WR_BITS_PER_WORD, struct.pack("=B", 8))
+        self._ioctl(self._fd, SPI_IOC_WR_MAX_SPEED_HZ, struct.pack("=I", self.max_speed_hz))
+
+        # One tx and one rx buffer per transfer. ctypes arrays sharing memory with the bytearrays
+        # give us their addresses, and keep the bytearrays from ever being reallocated.
+        buffer_size = max_transfers * _SPI_MAX_TRANSFER_SIZE
+        self._tx = bytearray(buffer_size)
+        self._rx = bytearray(buffer_size)
+        self._tx_array = (ctypes.c_char * buffer_size).from_buffer(self._tx)
+        self._rx_array = (ctypes.c_char * buffer_size).from_buffer(self._rx)
+        self._rx_view = memoryview(self._rx)
+        tx_address = ctypes.addressof(self._tx_array)
+        rx_address = ctypes.addressof(self._rx_array)
+        self._messages = bytearray(max_transfers * _SPI_IOC_TRANSFER.size)
+        for i in range(max_transfers):
+            offset = i * _SPI_MAX_TRANSFER_SIZE
+            _SPI_IOC_TRANSFER.pack_into(self._messages, i * _SPI_IOC_TRANSFER.size,
+                    tx_address + offset, rx_address + offset, 0, self.max_speed_hz, 0, 8,
+                    0, 0, 0, 0, 0)
+        self._requests = [None] + [SPI_IOC_MESSAGE(n) for n in range(1, max_transfers + 1)]
+
+    def close(self):
+        "Close the spidev file if it was opened by the constructor."
+        if self._close_fd and self._fd is not None:
+            os.close(self._fd)
+        self._fd = None
+
+    def _transfer(self, transfers):
+        "Do the transfers (sequences of ints, bytes or bytearrays) and return their sizes."
+        num_transfers = len(transfers)
+        assert 0 < num_transfers <= self.max_transfers, "Too many transfers for max_transfers"
+        sizes = []
+        for i, data in enumerate(transfers):
+            size = len(data)
+            assert 0 < size <= _SPI_MAX_TRANSFER_SIZE
+            offset = i * _SPI_MAX_TRANSFER_SIZE
+            self._tx[offset:offset + size] = data if isinstance(data, bytearray) else bytearray(data)
+            message_offset = i * _SPI_IOC_TRANSFER.size
+            struct.pack_into("=I", self._messages, message_offset + _SPI_IOC_LEN_OFFSET, size)
+            # cs_change on all but the last transfer makes CSN go high in between
+            self._messages[message_offset + _SPI_IOC_CS_CHANGE_OFFSET] = int(i < num_transfers - 1)
+            sizes.append(size)
+        self._ioctl(self._fd, self._requests[num_transfers], self._messages)
+        return sizes
+
+    def xfer2(self, data):
+        "Same as SpiDev.xfer2(), returns a list with the bytes read."
+        size = self._transfer((data,))[0]
+        return list(self._rx[:size])
+
+    def xfer2_batch(self, transfers):
+        "Do several transfers in one SPI message and return a list with the bytes read by each."
+        sizes = self._transfer(transfers)
+        return [list(self._rx[i * _SPI_MAX_TRANSFER_SIZE:i * _SPI_MAX_TRANSFER_SIZE + size])
+                for i, size in enumerate(sizes)]
+
+    def xfer2_view(self, data):
+        """Same as xfer2() but returns a memoryview of the internal receive buffer instead of
+        a new list. The view is only valid until the next transfer."""
+        size = self._transfer((data,))[0]
+        return self._rx_view[:size]
+
+    def xfer2_batch_view(self, transfers):
+        """Same as xfer2_batch() but returns memoryviews of the internal receive buffer, which
+        are only valid until the next transfer."""
+        sizes = self._transfer(transfers)
+        return [self._rx_view[i * _SPI_MAX_TRANSFER_SIZE:i * _SPI_MAX_TRANSFER_SIZE + size]
+                for i, size in enumerate(sizes)]
+
+
+class NRF24FakeSpiIoctl(object):
+    """A stand-in for fcntl.ioctl to test NRF24SpiDev without spidev. It carries out
+    SPI_IOC_MESSAGE requests by reading the transfer structs and buffers from memory and
+    passing each transfer to spi.xfer2(), e.g. a NRF24TraceReplay's spi. Other requests are
+    recorded in the list requests as (request, bytes of argument).
+    Example:
+        spi = NRF24SpiDev(ioctl=NRF24FakeSpiIoctl(replay.spi), fd=-1)
+    """
+
+    def __init__(self, spi):
+        self._spi = spi
+        self.requests = []
+
+    def __call__(self, fd, request, arg):
+        import ctypes
+        message_request = SPI_IOC_MESSAGE(0)
+        size = (request >> 16) & 0x3FFF
+        if request & ~(0x3FFF << 16) != message_request:
+            self.requests.append((request, bytes(arg)))
+            return 0
+        for i in range(size // _SPI_IOC_TRANSFER.size):
+            tx_address, rx_address, length = _SPI_IOC_TRANSFER.unpack_from(
+                    arg, i * _SPI_IOC_TRANSFER.size)[:3]
+            request_data = list(bytearray(ctypes.string_at(tx_address, length)))
+            response = bytes(bytearray(self._spi.xfer2(request_data)))
+            ctypes.memmove(rx_address, response, length)
+        return 0
+
+
+
+# Trace files written by NRF24TraceWriter start with _TRACE_MAGIC followed by records,
+# each one a _TRACE_RECORD header followed by the data (2*length bytes for transfers,
+# request followed by response, and length bytes for the other kinds).
+_TRACE_MAGIC = b"NRF24TR1"
+_TRACE_RECORD = struct.Struct("<BQB")
+
+TRACE_XFER = 1          # An SPI transfer
+TRACE_CHIP_ENABLE = 2   # CE set high or low
+TRACE_IRQ = 3           # Falling edge on the IRQ pin
+
+# One event in a trace file. kind is TRACE_XFER, TRACE_CHIP_ENABLE or TRACE_IRQ and time_ns is
+# from NRF24Timer.now_ns(). For TRACE_XFER request and response are the lists of bytes sent to
+# and returned by xfer2(). For TRACE_CHIP_ENABLE request is the new level of CE (0 or 1) and
+# response is None. For TRACE_IRQ both are None.
+NRF24TraceEvent = collections.namedtuple("NRF24TraceEvent", "kind time_ns request response")
+
+
+class TraceMismatchException(Exception):
+    """Raised when replaying a trace and the device does something else than what's in the trace."""
+    pass
+
+
+class NRF24TraceWriter(object):
+    """Appends events to a trace file, which can be read with read_trace(). Usually you don't
+    use this class directly but through NRF24RecordingSpi and NRF24RecordingGpio."""
+
+    def __init__(self, file_or_path, timer=None):
+        """file_or_path is a file opened in binary append mode or the path to such a file.
+        If the file is empty the header is written first."""
+        if isinstance(file_or_path, str):
+            self._file = open(file_or_path, "ab")
+            self._close_file = True
+        else:
+            self._file = file_or_path
+            self._close_file = False
+        self._timer = timer if timer is not None else _default_timer
+        self._lock = threading.Lock()  # IRQ edges are recorded on another thread
+        self._file.seek(0, 2)
+        if self._file.tell() == 0:
+            self._file.write(_TRACE_MAGIC)
+
+    def write_xfer(self, request, response, time_ns=None):
+        assert len(request) == len(response) <= 255
+        self._write(TRACE_XFER, time_ns, len(request), bytearray(request) + bytearray(response))
+
+    def write_chip_enable(self, level, time_ns=None):
+        self._write(TRACE_CHIP_ENABLE, time_ns, 1, bytearray([1 if level else 0]))
+
+    def write_irq(self, time_ns=None):
+        self._write(TRACE_IRQ, time_ns, 0, bytearray())
+
+    def _write(self, kind, time_ns, length, data):
+        if time_ns is None:
+            time_ns = self._timer.now_ns()
+        with self._lock:
+            self._file.write(_TRACE_RECORD.pack(kind, time_ns, length))
+            self._file.write(bytes(data))
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        "Flush, and close the file if it was opened by this object."
+        self.flush()
+        if self._close_file:
+            self._file.close()
+
+
+def read_trace(file_or_path):
+    """Return a generator of NRF24TraceEvent with the events in a trace file."""
+    if isinstance(file_or_path, str):
+        with open(file_or_path, "rb") as f:
+            for event in read_trace(f):
+                yield event
+        return
+
+    f = file_or_path
+    magic = f.read(len(_TRACE_MAGIC))
+    assert magic == _TRACE_MAGIC, "Not a trace file (or unsupported version)"
+    while True:
+        header = f.read(_TRACE_RECORD.size)
+        if len(header) < _TRACE_RECORD.size:
+            # A truncated record at the end means the recording process died while writing it
+            return
+        kind, time_ns, length = _TRACE_RECORD.unpack(header)
+        data = bytearray(f.read(2 * length if kind == TRACE_XFER else length))
+        if kind == TRACE_XFER:
+            if len(data) < 2 * length:
+                return
+            yield NRF24TraceEvent(kind, time_ns, list(data[:length]), list(data[length:]))
+        elif kind == TRACE_CHIP_ENABLE:
+            if len(data) < 1:
+                return
+            yield NRF24TraceEvent(kind, time_ns, data[0], None)
+        else:
+            assert kind == TRACE_IRQ, "Unknown record kind %r in trace" % kind
+            yield NRF24TraceEvent(kind, time_ns, None, None)
+
+
+class NRF24RecordingSpi(object):
+    """Wraps the spi object given to NRF24Device and records every transfer with a
+    NRF24TraceWriter. Example, recording everything a device does to trace.bin:
+        writer = NRF24TraceWriter("trace.bin")
+        device = NRF24Device(NRF24RecordingSpi(spi, writer), NRF24RecordingGpio(gpio, writer))
+    """
+
+    def __init__(self, spi, writer):
+        self._spi = spi
+        self._writer = writer
+        if hasattr(spi, "xfer2_batch"):
+            self.xfer2_batch = self._xfer2_batch
+
+    def xfer2(self, data):
+        request = list(data)
+        response = self._spi.xfer2(data)
+        self._writer.write_xfer(request, response)
+        return response
+
+    def _xfer2_batch(self, transfers):
+        requests = [list(data) for data in transfers]
+        responses = self._spi.xfer2_batch(transfers)
+        for request, response in zip(requests, responses):
+            self._writer.write_xfer(request, response)
+        return responses
+
+
+class NRF24RecordingGpio(object):
+    """Wraps the gpio object given to NRF24Device and records changes of CE and falling edges on
+    IRQ with a NRF24TraceWriter. See NRF24RecordingSpi for an example."""
+
+    def __init__(self, gpio, writer):
+        self._gpio = gpio
+        self._writer = writer
+
+    def chip_enable_high(self):
+        self._gpio.chip_enable_high()
+        self._writer.write_chip_enable(1)
+
+    def chip_enable_low(self):
+        self._gpio.chip_enable_low()
+        self._writer.write_chip_enable(0)
+
+    def set_falling_edge_irq(self, callback):
+        def on_falling_edge_irq():
+            self._writer.write_irq()
+            callback()
+        self._gpio.set_falling_edge_irq(on_falling_edge_irq)
+
+    def remove_falling_edge_irq(self):
+        self._gpio.remove_falling_edge_irq()
+
+
+class NRF24TraceReplay(object):
+    """Plays back a recorded trace to an NRF24Device, without any hardware, to reproduce
+    exactly what happened when it was recorded. Use the attributes spi and gpio as the
+    spi and gpio objects given to NRF24Device. Each transfer returns the recorded response.
+    If strict is True, a TraceMismatchException is raised as soon as the device does
+    something else than what is in the trace. If strict is False, requests and CE changes
+    are not compared, which is useful to benchmark a new version of your code or this module
+    against recorded traffic, as long as it uses the SPI bus in roughly the same way.
+    IRQ edges in the trace call the callback given to set_falling_edge_irq() on another
+    thread, like RPi.GPIO does, once all events before them have been replayed.
+    Set batch to True if the trace was recorded with an spi object which has xfer2_batch()
+    (see NRF24Device), so that the device combines transfers the same way when replaying.
+    Example:
+        replay = NRF24TraceReplay(read_trace("trace.bin"))
+        device = NRF24Device(replay.spi, replay.gpio)
+        ... # Run the same code as when recording
+    """
+
+    def __init__(self, events, strict=True, batch=False):
+        self._events = list(events)
+        self._position = 0
+        self._strict = strict
+        self._irq_callback = None
+        self._irq_threads = []
+        self.spi = _ReplayBatchSpi(self) if batch else _ReplaySpi(self)
+        self.gpio = _ReplayGpio(self)
+
+    def is_finished(self):
+        "Return True if all events in the trace have been replayed."
+        return self._position >= len(self._events)
+
+    def join_irq_threads(self):
+        "Wait for all threads calling IRQ callbacks to finish."
+        for thread in self._irq_threads:
+            thread.join()
+        self._irq_threads = []
+
+    def _next_event(self, kind):
+        if self._strict:
+            self._fire_irqs()
+        while True:
+            if self._position >= len(self._events):
+                raise TraceMismatchException("End of trace reached")
+            event = self._events[self._position]
+            self._position += 1
+            if event.kind == kind:
+                break
+            if self._strict:
+                raise TraceMismatchException("Expected %r in trace but found %r" % (kind, event))
+        self._fire_irqs()
+        return event
+
+    def _fire_irqs(self):
+        while (self._position < len(self._events) and
+                self._events[self._position].kind == TRACE_IRQ):
+            self._position += 1
+            if self._irq_callback is not None:
+                thread = threading.Thread(target=self._irq_callback)
+                thread.daemon = True
+                thread.start()
+                self._irq_threads.append(thread)
+
+    def _xfer2(self, data):
+        event = self._next_event(TRACE_XFER)
+        if self._strict and list(data) != event.request:
+            raise TraceMismatchException("Transfer %r does not match %r in trace" % (
+                    list(data), event.request))
+        response = list(event.response[:len(data)])
+        return response + [0] * (len(data) - len(response))
+
+    def _chip_enable(self, level):
+        event = self._next_event(TRACE_CHIP_ENABLE)
+        if self._strict and level != event.request:
+            raise TraceMismatchException("CE set to %d but %d in trace" % (level, event.request))
+
+
+class _ReplaySpi(object):
+    def __init__(self, replay):
+        self._replay = replay
+
+    def xfer2(self, data):
+        return self._replay._xfer2(data)
+
+
+class _ReplayBatchSpi(_ReplaySpi):
+    def xfer2_batch(self, transfers):
+        return [self._replay._xfer2(data) for data in transfers]
+
+
+class _ReplayGpio(object):
+    def __init__(self, replay):
+        self._replay = replay
+
+    def chip_enable_high(self):
+        self._replay._chip_enable(1)
+
+    def chip_enable_low(self):
+        self._replay._chip_enable(0)
+
+    def set_falling_edge_irq(self, callback):
+        self._replay._irq_callback = callback
+
+    def remove_falling_edge_irq(self):
+        self._replay._irq_callback = None
+
+
+def replay_trace_into(events, spi, gpio=None, timer=None, realtime=False):
+    """Send the recorded transfers and CE changes to another spi and gpio object, e.g. a
+    software stand-in or real hardware, and return a list of (event, response) for each
+    transfer where the response differed from the recorded one. IRQ events are ignored.
+    If realtime is True the events are sent with the same timing as when recorded, 
+    otherwise as fast as possible.
+    """
+    timer = timer if timer is not None else _default_timer
+    mismatches = []
+    start_ns = None
+    for event in events:
+        if realtime:
+            if start_ns is None:
+                start_ns = timer.now_ns() - event.time_ns
+            timer.sleep_until(start_ns + event.time_ns)
+        if event.kind == TRACE_XFER:
+            response = list(spi.xfer2(list(event.request)))
+            if response != event.response:
+                mismatches.append((event, response))
+        elif event.kind == TRACE_CHIP_ENABLE and gpio is not None:
+            if event.request:
+                gpio.chip_enable_high()
+            else:
+                gpio.chip_enable_low()
+    return mismatches
+
+
+# Names of the SPI commands with a fixed command byte. See _decode_spi_command() for the rest.
+_SPI_COMMAND_NAMES = {
+    0x50: "ACTIVATE",
+    0x60: "R_RX_PL_WID",
+    0x61: "R_RX_PAYLOAD",
+    0xA0: "W_TX_PAYLOAD",
+    0xB0: "W_TX_PAYLOAD_NOACK",
+    0xE1: "FLUSH_TX",
+    0xE2: "FLUSH_RX",
+    0xE3: "REUSE_TX_PL",
+    _SPI_NOP: "NOP",
+}
+
+# Registers whose value can change without being written to over SPI
+_VOLATILE_REGISTER_ADDRESSES = frozenset([0x07, 0x08, 0x09, 0x17])  # STATUS, OBSERVE_TX, RPD, FIFO_STATUS
+
+
+def _decode_spi_command(command):
+    """Return (name, argument) for an SPI command byte, where argument is the register
+    address for R_REGISTER and W_REGISTER, the pipe for W_ACK_PAYLOAD and None otherwise."""
+    if command < 0x20:
+        return "R_REGISTER", command
+    elif command < 0x40:
+        return "W_REGISTER", command & 0x1F
+    elif 0xA8 <= command <= 0xAD:
+        return "W_ACK_PAYLOAD", command & 0x07
+    else:
+        return _SPI_COMMAND_NAMES.get(command, "UNKNOWN_0x%02X" % command), None
+
+
+# One decoded SPI transfer. name is the command, e.g. "R_REGISTER", and argument the register
+# address or pipe (see _decode_spi_command()). data is the bytes read or written after the
+# command byte and status the STATUS register clocked out with it. fields is an OrderedDict
+# with field names and values if a register with fields was read or written, otherwise None.
+# category is one of the TRAFFIC_* constants.
+NRF24SpiCommand = collections.namedtuple("NRF24SpiCommand",
+        "time_ns name argument data status fields num_bytes category")
+
+
+TRAFFIC_USEFUL = "useful"
+TRAFFIC_REDUNDANT_READ = "redundant read"       # Read of a register which can't have changed
+TRAFFIC_RMW_READ = "read-modify-write read"     # Read just to change some fields, a shadow copy would avoid it
+TRAFFIC_IDENTICAL_WRITE = "identical write"     # Write of the value the register already has
+TRAFFIC_IDLE_POLL = "idle poll"                 # Poll of STATUS, FIFO_STATUS etc. where nothing changed
+
+_TRAFFIC_CATEGORIES = (TRAFFIC_USEFUL, TRAFFIC_REDUNDANT_READ, TRAFFIC_RMW_READ,
+                       TRAFFIC_IDENTICAL_WRITE, TRAFFIC_IDLE_POLL)
+
+
+class NRF24TraceAnalysis(object):
+    """Result of analyze_trace(). commands is a list of NRF24SpiCommand, one for each SPI
+    transfer, and categories a dict with the TRAFFIC_* constants as keys and dicts with
+    "count", "num_bytes", "bus_time" (in seconds) and "share" (of the total bus time) as values."""
+
+    def __init__(self, commands, categories, total_bus_time):
+        self.commands = commands
+        self.categories = categories
+        self.total_bus_time = total_bus_time
+
+    def to_string(self):
+        "Return a table with the categories, useful for printing."
+        table = [("Category", "  Transfers", "  Bytes", "  Bus time (ms)", "  Share")]
+        for category in _TRAFFIC_CATEGORIES:
+            info = self.categories[category]
+            table.append((category,
+                          "  %d" % info["count"],
+                          "  %d" % info["num_bytes"],
+                          "  %.3f" % (info["bus_time"] * 1000),
+                          "  %.1f %%" % (100 * info["share"])))
+        return _tabulate(table)
+
+    def __str__(self):
+        return self.to_string()
+
+
+def _decode_fields(address, value):
+    register = find_register(address)
+    if register is None or not register.FIELDS or not isinstance(value, _INTEGER_TYPES):
+        return None
+    return collections.OrderedDict((f.FIELD_NAME, f.get(value)) for f in register.FIELDS)
+
+
+def analyze_trace(events, spi_speed_hz=10*1000*1000, transfer_overhead=0.0):
+    """Decode the SPI transfers in a trace (e.g. from read_trace()) into commands, register
+    and field values, and find traffic that could have been avoided: reads of registers that
+    can't have changed since they were last read or written, reads done only to modify some
+    fields of a register (which a shadow copy of the register would avoid), writes of values
+    the register already has, and polling of STATUS, FIFO_STATUS etc. where nothing changed.
+    Each transfer is assumed to take transfer_overhead seconds plus 8 bits per byte at
+    spi_speed_hz. Returns an NRF24TraceAnalysis.
+    Example:
+        print(analyze_trace(read_trace("trace.bin")))
+    """
+    # Transfers only, in order, as (event, name, argument, data, value)
+    transfers = []
+    for event in events:
+        if event.kind != TRACE_XFER:
+            continue
+        name, argument = _decode_spi_command(event.request[0])
+        if name == "R_REGISTER" or name == "R_RX_PAYLOAD" or name == "R_RX_PL_WID":
+            data = event.response[1:]
+        else:
+            data = event.request[1:]
+        if name in ("R_REGISTER", "W_REGISTER"):
+            value = data[0] if len(data) == 1 else tuple(data)
+        elif name == "NOP":
+            # A NOP is the fastest way to read STATUS
+            name, argument, value = "R_REGISTER", 0x07, event.response[0]
+        else:
+            value = None
+        transfers.append((event, name, argument, data, value))
+
+    known_values = {}   # Register address -> last value read or written
+    commands = []
+    for i, (event, name, argument, data, value) in enumerate(transfers):
+        status = event.response[0]
+        category = TRAFFIC_USEFUL
+        if name == "R_REGISTER":
+            if argument in _VOLATILE_REGISTER_ADDRESSES:
+                previous_status = known_values.get(0x07)
+                if (known_values.get(argument) == value and
+                        (previous_status is None or previous_status == status)):
+                    category = TRAFFIC_IDLE_POLL
+            else:
+                next_transfer = transfers[i + 1] if i + 1 < len(transfers) else None
+                if (next_transfer is not None and next_transfer[1] == "W_REGISTER" and
+                        next_transfer[2] == argument):
+                    category = TRAFFIC_RMW_READ
+                elif argument in known_values and known_values[argument] == value:
+                    category = TRAFFIC_REDUNDANT_READ
+            known_values[argument] = value
+        elif name == "W_REGISTER":
+            if argument not in _VOLATILE_REGISTER_ADDRESSES:
+                if known_values.get(argument) == value:
+                    category = TRAFFIC_IDENTICAL_WRITE
+                known_values[argument] = value
+            else:
+                # E.g. writing 1 to RX_DR clears it, so we don't know the new value
+                known_values.pop(argument, None)
+        elif name in ("FLUSH_TX", "FLUSH_RX", "R_RX_PAYLOAD", "W_TX_PAYLOAD", "W_TX_PAYLOAD_NOACK"):
+            known_values.pop(0x17, None)
+        elif name == "ACTIVATE":
+            known_values.clear()
+
+        # Every command returns STATUS
+        known_values[0x07] = status
+
+        fields = _decode_fields(argument, value) if name in ("R_REGISTER", "W_REGISTER") else None
+        commands.append(NRF24SpiCommand(event.time_ns, name, argument, data, status, fields,
+                                        len(event.request), category))
+
+    categories = dict((category, {"count": 0, "num_bytes": 0, "bus_time": 0.0, "share": 0.0})
+                      for category in _TRAFFIC_CATEGORIES)
+    total_bus_time = 0.0
+    for command in commands:
+        bus_time = transfer_overhead + 8.0 * command.num_bytes / spi_speed_hz
+        info = categories[command.category]
+        info["count"] += 1
+        info["num_bytes"] += command.num_bytes
+        info["bus_time"] += bus_time
+        total_bus_time += bus_time
+    if total_bus_time > 0:
+        for info in categories.values():
+            info["share"] = info["bus_time"] / total_bus_time
+
+    return NRF24TraceAnalysis(commands, categories, total_bus_time)
+
+
+
+# A packet read by NRF24Device.read_rx_packet(). irq_ns and read_ns are NRF24Timer times in
+# nanoseconds, fifo_depth the number of packets in the RX FIFO when it was read, this one included.
+NRF24RxPacket = collections.namedtuple("NRF24RxPacket", "pipe payload irq_ns read_ns fifo_depth")
+
 
 class _WaitInfo(object):
     def __init__(self, condition_variable):
@@ -823,7 +2008,7 @@ class _WaitInfo(object):
 
 class NRF24Device(object):
 
-    def __init__(self, spi, gpio):
+    def __init__(self, spi, gpio, timer=None):
         """Create an object representing a connected nRF24L01+ chip.
         spi is an object having the method xfer2([list_of_ints]) which sends the
         list of (8 bit) ints onto the SPI bus and returns a similar list of the bytes
@@ -833,6 +2018,11 @@ class NRF24Device(object):
         chip_enable_low(), which sets the CE (chip enable) pin on the nRF24L01+. If
         you use the wait_for_irq*() methods on NRF24Device the gpio object also needs
         the methods set_falling_edge_irq() and remove_falling_edge_irq() methods.
+        If spi also has the method xfer2_batch([list_of_lists_of_ints]), which does several
+        transfers (with CSN going high in between) in one call and returns a list of the
+        responses, it's used to combine transfers, e.g. in read_dynamic_payload().
+        timer is an NRF24Timer used to keep the delays required by the datasheet, e.g.
+        in pulse_chip_enable() and wait_for_mode_transition(). A shared default is used if None.
         Example:
             import spidev
             import RPi.GPIO as GPIO
@@ -849,29 +2039,116 @@ class NRF24Device(object):
         """
         self._spi = spi
         self._gpio = gpio
+        self._timer = timer if timer is not None else _default_timer
         self._wait_info_cancellable = None
-    
+
+        # Deadlines (in NRF24Timer nanoseconds, 0 if passed) for the datasheet delays.
+        # No SPI transfers before _spi_ready_ns (Tpece2csn after CE high).
+        self._spi_ready_ns = 0
+        # In Standby-I at _standby_ready_ns (Tpd2stby after PWR_UP was set)
+        self._standby_ready_ns = 0
+        # In TX or RX mode at _mode_ready_ns (Tstby2a after CE high in Standby-I)
+        self._mode_ready_ns = 0
+        # Last known value of PWR_UP, None if unknown
+        self._powered_up = None
+
+        # Number of times read_dynamic_payload() found an invalid payload width and flushed the RX FIFO
+        self.num_corrupt_payloads = 0
+
+        # The chip sends STATUS as the first byte of every transfer. last_status is the latest
+        # one seen (None before the first transfer) and last_status_ns the NRF24Timer time it
+        # was seen, or None if the command itself may have changed STATUS afterwards.
+        self.last_status = None
+        self.last_status_ns = None
+
+        # NRF24Timer time of the last falling edge on IRQ, see note_irq_edge()
+        self.last_irq_ns = None
+
+    def _note_status(self, command, status):
+        self.last_status = status
+        # Reading registers, R_RX_PL_WID and NOP leave STATUS as it was when it was sent.
+        if command <= 0x1F or command == _SPI_R_RX_PL_WID or command == _SPI_NOP:
+            self.last_status_ns = self._timer.now_ns()
+        else:
+            self.last_status_ns = None
+
+    def _xfer2(self, data):
+        if self._spi_ready_ns:
+            self._timer.sleep_until(self._spi_ready_ns)
+            self._spi_ready_ns = 0
+        command = data[0]
+        response = self._spi.xfer2(data)
+        self._note_status(command, response[0])
+        return response
+
+    def _xfer2_batch(self, transfers):
+        if self._spi_ready_ns:
+            self._timer.sleep_until(self._spi_ready_ns)
+            self._spi_ready_ns = 0
+        command = transfers[-1][0]
+        responses = self._spi.xfer2_batch(transfers)
+        self._note_status(command, responses[-1][0])
+        return responses
+
+    def _get_cached_status(self, max_age):
+        "Return last_status if it's known to be at most max_age seconds old, otherwise None."
+        if max_age is None or self.last_status_ns is None:
+            return None
+        if self._timer.now_ns() - self.last_status_ns > max_age * 1e9:
+            return None
+        return self.last_status
+
+    def _note_config_value(self, config, written):
+        "Keep track of PWR_UP so we know when the chip reaches Standby-I after power up."
+        powered_up = bool(PWR_UP.get(config))
+        if written and powered_up and not self._powered_up:
+            self._standby_ready_ns = self._timer.deadline(T_PD2STBY)
+        self._powered_up = powered_up
+
     def chip_enable_high(self):
-        "Call chip_enable_high() on the gpio you supplied to the constructor."
+        """Call chip_enable_high() on the gpio you supplied to the constructor.
+        The next SPI transfer will wait until Tpece2csn (4 us) has passed, and
+        wait_for_mode_transition() waits for the Tstby2a (130 us) settling time."""
         self._gpio.chip_enable_high()
-    
+        now = self._timer.now_ns()
+        self._spi_ready_ns = now + int(T_PECE2CSN * 1e9)
+        self._mode_ready_ns = max(now, self._standby_ready_ns) + int(T_STBY2A * 1e9)
+
     def chip_enable_low(self):
         "Call chip_enable_low() on the gpio you supplied to the constructor."
         self._gpio.chip_enable_low()
-        
+        self._mode_ready_ns = 0
+
+    def pulse_chip_enable(self, duration=T_HCE):
+        """Set CE high for duration seconds and then low again, e.g. to send one packet
+        from the TX FIFO. If the chip is still powering up, CE is held high until duration
+        after it has reached Standby-I."""
+        self.chip_enable_high()
+        start = max(self._timer.now_ns(), self._standby_ready_ns)
+        self._timer.sleep_until(self._timer.deadline(duration, start))
+        self.chip_enable_low()
+
+    def wait_for_mode_transition(self):
+        """Sleep until the chip has finished the last mode transition started by this object,
+        i.e. Tpd2stby after set(PWR_UP(1)) and Tstby2a after chip_enable_high()."""
+        deadline = max(self._standby_ready_ns, self._mode_ready_ns)
+        if deadline:
+            self._timer.sleep_until(deadline)
+
+
     def flush_tx_fifo(self):
         "Clear the TX FIFO and return the STATUS register."
-        status = self._spi.xfer2([0b11100001])
+        status = self._xfer2([0b11100001])
         return status[0]
 
     def flush_rx_fifo(self):
         "Clear the RX FIFO and return the STATUS register."
-        status = self._spi.xfer2([0b11100010])
+        status = self._xfer2([0b11100010])
         return status[0]
 
     def _write_payload(self, command, data):
         assert 1 <= len(data) <= 32, "Invalid length of payload %r" % (data,)
-        status_and_junk = self._spi.xfer2([command] + _to_bytes(data))
+        status_and_junk = self._xfer2([command] + _to_bytes(data))
         status = status_and_junk[0]
         return status
     
@@ -894,7 +2171,7 @@ class NRF24Device(object):
     def read_rx_payload(self, num_bytes):
         "Returns STATUS register and num_bytes of data"
         assert 1 <= num_bytes <= 32, "Invalid num_bytes: %r" % (num_bytes,)
-        data = self._spi.xfer2([0b01100001] + [0] * num_bytes)
+        data = self._xfer2([0b01100001] + [0] * num_bytes)
         status = data[0]
         return status, data[1:]
     
@@ -903,10 +2180,79 @@ class NRF24Device(object):
         From nRF24L01+ product specification:
         "Read RX payload width for the top R_RX_PAYLOAD in the RX FIFO.
         Note: Flush RX FIFO if the read value is larger than 32 bytes." """
-        data = self._spi.xfer2([0b01100000, _SPI_NOP])
+        data = self._xfer2([0b01100000, _SPI_NOP])
         status, size = data[0], data[1]
         return status, size
 
+    def read_dynamic_payload(self):
+        """Read the first packet in the RX FIFO when using dynamic payload length, and return
+        (pipe, payload), or None if the RX FIFO is empty. This combines get_rx_payload_size()
+        and read_rx_payload(), in one call to the spi object if it has xfer2_batch() (reading
+        32 bytes and using as many as the width says). If the width is invalid (above 32) the
+        RX FIFO is flushed, as the product specification says, num_corrupt_payloads is
+        increased and None is returned."""
+        if hasattr(self._spi, "xfer2_batch"):
+            width_data, payload_data = self._xfer2_batch([[0b01100000, _SPI_NOP], _READ_32_BYTES])
+            status, width = width_data[0], width_data[1]
+        else:
+            status, width = self.get_rx_payload_size()
+            payload_data = None
+
+        pipe = (status >> 1) & 0b111  # RX_P_NO
+        if pipe > 5:
+            return None
+        if not 1 <= width <= 32:
+            self.flush_rx_fifo()
+            self.num_corrupt_payloads += 1
+            return None
+
+        if payload_data is None:
+            payload_data = self._xfer2([0b01100001] + [0] * width)
+        return pipe, list(payload_data[1:width + 1])
+
+    def read_rx_packet(self):
+        """Same as read_dynamic_payload() but return an NRF24RxPacket, which also has the time of
+        the last IRQ edge (last_irq_ns), the time the payload was read and the number of packets
+        in the RX FIFO at that time, or None if the RX FIFO is empty. It takes two more short
+        transfers, reading FIFO_STATUS before the payload and STATUS after it (all in one call
+        if the spi object has xfer2_batch()).
+        A packet which arrives while IRQ is already low doesn't make a new edge, so irq_ns of
+        the second and third packet of a burst is the edge of the first one.
+        Example:
+            packet = device.read_rx_packet()
+            queueing_delay_ns = packet.read_ns - packet.irq_ns
+        """
+        irq_ns = self.last_irq_ns
+        read_fifo_status = [REG_FIFO_STATUS.ADDRESS, _SPI_NOP]
+        if hasattr(self._spi, "xfer2_batch"):
+            fifo_data, width_data, payload_data, after_data = self._xfer2_batch(
+                    [read_fifo_status, [0b01100000, _SPI_NOP], _READ_32_BYTES, [_SPI_NOP]])
+            read_ns = self._timer.now_ns()
+            status, width = width_data[0], width_data[1]
+        else:
+            fifo_data = self._xfer2(read_fifo_status)
+            status, width = self.get_rx_payload_size()
+            payload_data = None
+
+        pipe = RX_P_NO.get(status)
+        if pipe > 5:
+            return None
+        if not 1 <= width <= 32:
+            self.flush_rx_fifo()
+            self.num_corrupt_payloads += 1
+            return None
+
+        if payload_data is None:
+            payload_data = self._xfer2([0b01100001] + [0] * width)
+            read_ns = self._timer.now_ns()
+            after_data = self._xfer2([_SPI_NOP])
+        if RX_FULL.get(fifo_data[1]):
+            fifo_depth = 3
+        else:
+            # RX_P_NO is 7 if this was the last packet
+            fifo_depth = 1 if RX_P_NO.get(after_data[0]) > 5 else 2
+        return NRF24RxPacket(pipe, list(payload_data[1:width + 1]), irq_ns, read_ns, fifo_depth)
+
     def reuse_tx_payload(self):
         """Resend the packet first in the TX FIFO. Return STATUS register.
         From nRF24L01+ product specification:
@@ -914,19 +2260,33 @@ class NRF24Device(object):
         Reuse last transmitted payload.
         TX payload reuse is active until W_TX_PAYLOAD or FLUSH TX is executed. TX payload reuse must not be activated or deacti- vated during package transmission."
         """
-        status_in_list = self._spi.xfer2([0b11100011])
+        status_in_list = self._xfer2([0b11100011])
         status = status_in_list[0]
         return status
 
-    def get(self, *fields_or_registers):
+    def get_status(self, max_age=None):
+        """Return the STATUS register. Uses a one byte NOP command, the fastest way to read it.
+        If max_age is given and STATUS was seen in a transfer at most max_age seconds ago
+        (see last_status), that value is returned without any transfer."""
+        status = self._get_cached_status(max_age)
+        if status is not None:
+            return status
+        return self._xfer2([_SPI_NOP])[0]
+
+    def get(self, *fields_or_registers, **kwargs):
         """Get register fields and 1 byte register. If you supply one parameter the function
         returns an int, if you supply 0 or >=2 parameters you will get a tuple with one int
         for each parameter.
+        The keyword argument max_age (in seconds) lets get() answer from last_status without
+        any transfer if only STATUS and its fields are asked for, see get_status().
         Examples:
         rx_full = device.get(RX_FULL)
         rx_full, arc_cnt, rx_addr_p5 = device.get(RX_FULL, ARC_CNT, REG_RX_ADDR_P5)
+        rx_dr, tx_ds = device.get(RX_DR, TX_DS, max_age=100e-6)
         """
-    
+        max_age = kwargs.pop("max_age", None)
+        assert not kwargs, "Unexpected keyword arguments %r" % list(kwargs)
+
         need_to_fetch_registers = set([REG_STATUS.ADDRESS])
         for r in fields_or_registers:
             if issubclass(r, _Register):
@@ -937,13 +2297,18 @@ class NRF24Device(object):
                 assert issubclass(r, _RegisterField)
                 need_to_fetch_registers.add(r.REGISTER_ADDRESS)
 
+        values = {}
         if need_to_fetch_registers != set([REG_STATUS.ADDRESS]):
             # Fetched implicitly when fetching another register
             need_to_fetch_registers.discard(REG_STATUS.ADDRESS)
-        
-        values = {}
+        else:
+            status = self._get_cached_status(max_age)
+            if status is not None:
+                values[REG_STATUS.ADDRESS] = status
+                need_to_fetch_registers.clear()
+
         for address in need_to_fetch_registers:
-            data = self._spi.xfer2([address, _SPI_NOP])
+            data = self._xfer2([address, _SPI_NOP])
             status, register_value = tuple(data)
             values[REG_STATUS.ADDRESS] = status
             values[address] = register_value
@@ -972,14 +2337,14 @@ class NRF24Device(object):
         _assert_valid_register_and_size(address, size)
 
         if address != REG_STATUS.ADDRESS:
-            data = self._spi.xfer2([address] + [_SPI_NOP] * size)
+            data = self._xfer2([address] + [_SPI_NOP] * size)
             status = data[0]
             if size == 1:
                 return status, data[1]
             else:
                 return status, data[1:]
         else:
-            status = self._spi.xfer2([_SPI_NOP])[0]
+            status = self._xfer2([_SPI_NOP])[0]
             return status, status
             
     
@@ -988,8 +2353,10 @@ class NRF24Device(object):
         """Set register at a specified address to value. Return STATUS register."""
         _assert_valid_register_and_size(address, len(value) if isinstance(value, list) else 1)
         
-        data = self._spi.xfer2([0b00100000 | address] + _to_bytes(value))
+        data = self._xfer2([0b00100000 | address] + _to_bytes(value))
         status = data[0]
+        if address == REG_CONFIG.ADDRESS:
+            self._note_config_value(value, written=True)
         return status
     
     
@@ -1012,15 +2379,20 @@ class NRF24Device(object):
         """Set register fields and return STATUS if you provided at least one argument. 
         It's probably easier if you just use the set() function."""
         
-        for rfs in register_fields:
-            r = (rfs if isinstance(rfs, _RegisterFieldSet) else _RegisterFieldSet(rfs))
-
-            register_address = r.get_register_address()
-            mask = r.get_mask()
-            value_to_write = r.get_value()
+        for r in register_fields:
+            if isinstance(r, _RegisterField):
+                register_address = r.REGISTER_ADDRESS
+                mask = _get_mask(r)
+                value_to_write = r.get_unshifted_value()
+            else:
+                register_address = r.get_register_address()
+                mask = r.get_mask()
+                value_to_write = r.get_value()
 
             if mask != 0xFF:
                 status, old_value = self.get_register(register_address, size=1)
+                if register_address == REG_CONFIG.ADDRESS:
+                    self._note_config_value(old_value, written=False)
                 value_to_write = value_to_write | (old_value & ~mask)
             
             status = self._set_register(register_address, value_to_write)
@@ -1049,16 +2421,20 @@ class NRF24Device(object):
                 assert r.ADDRESS not in registers, "Register %s specified twice" % r.NAME
                 registers[r.ADDRESS] = r
 
+        # Fields and field sets in the same register are combined (with |, which is cached)
         register_field_sets = {}
         for r in registers_and_register_fields:
             if not isinstance(r, _Register):
                 register_field = r if isinstance(r, _RegisterField) else r.fields[0]
+                address = register_field.REGISTER_ADDRESS
                 
-                assert register_field.REGISTER_ADDRESS not in registers, (
+                assert address not in registers, (
                         "Register %s and RegisterField %s can't be written simultaneously" % (
                                 register_field.REGISTER_NAME, register_field.FIELD_NAME))
-                rfs = register_field_sets.setdefault(register_field.REGISTER_ADDRESS, _RegisterFieldSet())
-                rfs |= r
+                if address in register_field_sets:
+                    register_field_sets[address] = register_field_sets[address] | r
+                else:
+                    register_field_sets[address] = r
 
         maybe_status_1 = self._set_registers(*registers.values())
         maybe_status_2 = self._set_fields(*register_field_sets.values())
@@ -1123,11 +2499,18 @@ class NRF24Device(object):
         return "Register %s at 0x%02x:\n" % (register.NAME, register.ADDRESS) + table_str
 
 
+    def note_irq_edge(self, time_ns=None):
+        """Record a falling edge on IRQ at time_ns (in NRF24Timer nanoseconds, now if None) in
+        last_irq_ns. The wait_for_irq*() methods do this themselves, call it from your IRQ
+        callback if you wait in some other way."""
+        self.last_irq_ns = self._timer.now_ns() if time_ns is None else time_ns
+
     def _internal_wait_for_irq_low(self, wait_info, timeout):
         start_time = time.time()
 
         def on_falling_edge_irq():
             # Called on another thread internal to gpio.
+            self.note_irq_edge()
             with wait_info.condition_variable:
                 if not wait_info.already_finished:
                     wait_info.condition_variable.notify_all()
@@ -1194,5 +2577,2612 @@ class NRF24Device(object):
         assert condition_variable == self._wait_info_cancellable.condition_variable
         self._wait_info_cancellable.cancelled = True
         condition_variable.notify_all()
-        
 
+
+
+OVERFLOW_DROP_OLDEST = "drop oldest"  # When a queue is full, remove the oldest payload to make room
+OVERFLOW_DROP_NEWEST = "drop newest"  # When a queue is full, drop the payload just received
+
+
+class _PipeRoute(object):
+    def __init__(self, maxlen, overflow, callback):
+        assert overflow in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST), "Invalid overflow %r" % overflow
+        self.queue = collections.deque()
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.callback = callback
+        self.num_received = 0
+        self.num_dropped = 0
+
+
+class NRF24RxRouter(object):
+    """Reads packets from the RX FIFO of an NRF24Device and sorts them by pipe into one bounded
+    queue (or callback) per pipe, so that a busy pipe doesn't delay the processing of the others.
+    The payload width of each pipe is read once (RX_PW_Px, or R_RX_PL_WID for each packet on
+    pipes with dynamic payload length) and cached, so call refresh_config() if you change it.
+    Packets with invalid width (above 32 bytes) are flushed as the product specification says,
+    and counted in num_corrupt.
+    Example:
+        router = NRF24RxRouter(device)
+        router.set_route(1, callback=lambda pipe, payload: handle_sensor(payload))
+        router.set_route(2, maxlen=100, overflow=OVERFLOW_DROP_NEWEST)
+        while True:
+            device.wait_for_irq_low()
+            router.poll()
+            payload = router.pop(2)
+            ...
+    """
+
+    def __init__(self, device, maxlen=32, overflow=OVERFLOW_DROP_OLDEST):
+        """maxlen and overflow are the defaults for pipes which you don't call set_route() for."""
+        self._device = device
+        self._routes = [_PipeRoute(maxlen, overflow, None) for pipe in range(6)]
+        self.num_corrupt = 0
+        self.refresh_config()
+
+    def refresh_config(self):
+        "Read the payload widths and dynamic payload length settings of all pipes again."
+        values = self._device.get(EN_DPL, REG_DYNPD,
+                                  *[find_field("RX_PW_P%d" % pipe) for pipe in range(6)])
+        en_dpl, dynpd, widths = values[0], values[1], values[2:]
+        # None means dynamic payload length
+        self._widths = [None if en_dpl and dynpd & (1 << pipe) else widths[pipe]
+                        for pipe in range(6)]
+
+    def set_route(self, pipe, maxlen=32, overflow=OVERFLOW_DROP_OLDEST, callback=None):
+        """Decide what to do with packets received on pipe. If callback is given it's called
+        as callback(pipe, payload) from poll(), otherwise payloads are put in a queue of at most
+        maxlen payloads, to be fetched with pop(). overflow decides what happens when it's full."""
+        assert 0 <= pipe <= 5, "Invalid pipe %r" % pipe
+        route = self._routes[pipe]
+        route.maxlen = maxlen
+        route.overflow = overflow
+        route.callback = callback
+
+    def poll(self, max_packets=None):
+        """Read packets from the RX FIFO until it's empty (or max_packets have been read) and
+        dispatch them. Clears RX_DR. Return the number of packets read. If max_packets stopped
+        it early, call poll() again before waiting for IRQ, since RX_DR is already cleared."""
+        device = self._device
+        num_packets = 0
+        status = device.get_status()
+        if RX_DR.get(status):
+            # Clear RX_DR (without touching TX_DS and MAX_RT) before reading, so that a packet
+            # which arrives while we read sets it and IRQ again
+            status = device.set(REG_STATUS(1 << RX_DR.START_BIT))
+        while max_packets is None or num_packets < max_packets:
+            pipe = RX_P_NO.get(status)
+            if pipe == 7:
+                # RX FIFO empty
+                break
+            width = self._widths[pipe] if pipe <= 5 else 0
+            if width is None:
+                result = device.read_dynamic_payload()
+                if result is None:
+                    # Invalid width, the RX FIFO has been flushed
+                    self.num_corrupt += 1
+                    status = device.get_status()
+                    continue
+                pipe, payload = result
+            elif 1 <= width <= 32:
+                status, payload = device.read_rx_payload(width)
+            else:
+                device.flush_rx_fifo()
+                self.num_corrupt += 1
+                status = device.get_status()
+                continue
+
+            num_packets += 1
+            self._dispatch(pipe, payload)
+            status = device.get_status()
+        return num_packets
+
+    def _dispatch(self, pipe, payload):
+        route = self._routes[pipe]
+        route.num_received += 1
+        if route.callback is not None:
+            route.callback(pipe, payload)
+        elif len(route.queue) < route.maxlen:
+            route.queue.append(payload)
+        elif route.overflow == OVERFLOW_DROP_OLDEST:
+            route.queue.popleft()
+            route.queue.append(payload)
+            route.num_dropped += 1
+        else:
+            route.num_dropped += 1
+
+    def pop(self, pipe):
+        """Return the oldest payload in the queue for pipe, or None if it's empty. May be called
+        from another thread than poll()."""
+        try:
+            return self._routes[pipe].queue.popleft()
+        except IndexError:
+            return None
+
+    def get_queue_size(self, pipe):
+        return len(self._routes[pipe].queue)
+
+    def get_stats(self, pipe):
+        """Return a dict with the number of packets received, dropped because the queue was
+        full and currently queued for pipe."""
+        route = self._routes[pipe]
+        return {"received": route.num_received,
+                "dropped": route.num_dropped,
+                "queued": len(route.queue)}
+
+
+def _percentile(sorted_values, fraction):
+    "Return the value at fraction (0.0-1.0) of the way into sorted_values, None if empty."
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class _PolledNode(object):
+    def __init__(self, node_id, address, poll_payload, callback, due_ns):
+        self.node_id = node_id
+        self.address = list(address)
+        self.poll_payload = poll_payload
+        self.callback = callback
+        self.due_ns = due_ns
+        self.num_polls = 0
+        self.num_replies = 0
+        self.num_failures = 0
+        self.consecutive_failures = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+
+def _get_tx_timeout_ns(device):
+    "Longest time sending a packet can take before TX_DS or MAX_RT, with some margin."
+    config = NRF24LinkConfig.from_device(device)
+    return int(1e9 * (T_STBY2A + 1e-3 +
+            (config.arc + 1) * (config.get_time_on_air() + config.ard)))
+
+
+class NRF24PollScheduler(object):
+    """Polls any number of nodes from a hub, for star networks with more nodes than the six
+    pipes that auto ACK supports. Each node is a PRX which always has its reply loaded as an
+    ACK payload (with write_ack_payload()) on pipe 0. The hub retargets TX_ADDR and RX_ADDR_P0
+    to one node at a time, sends it a poll packet and gets the reply with the ACK.
+    Each node is polled every poll_interval seconds, or as often as possible if there are too
+    many nodes for that, always polling the node which has waited the longest first. Nodes
+    which don't answer (MAX_RT) are backed off exponentially, up to max_backoff poll intervals
+    (or times the longest time a poll can take, if that is longer).
+    The latency of a node is the time from when it was due to be polled until the reply was
+    received, and is available through get_stats().
+    Example:
+        scheduler = NRF24PollScheduler(device, poll_interval=0.1)
+        scheduler.configure_hub()
+        for i, address in enumerate(node_addresses):
+            scheduler.add_node(i, address, callback=handle_reply)
+        scheduler.run()
+    """
+
+    def __init__(self, device, poll_interval=0.0, max_backoff=16, timer=None):
+        self._device = device
+        self._timer = timer if timer is not None else _default_timer
+        self._poll_interval_ns = int(poll_interval * 1e9)
+        self._max_backoff = max_backoff
+        self._nodes = collections.OrderedDict()
+        self._current_address = None
+        self._stopped = False
+
+        self._tx_timeout_ns = _get_tx_timeout_ns(device)
+
+    def configure_hub(self):
+        """Configure the device as a hub: PTX with auto ACK, dynamic payload length and ACK
+        payloads on pipe 0. The nodes need the same settings, except that they are PRX."""
+        self._device.set(EN_DPL(1) | EN_ACK_PAY(1),
+                         DPL_P0(1),
+                         ENAA_P0(1),
+                         ERX_P0(1),
+                         PRIM_RX(0) | PWR_UP(1))
+
+    def add_node(self, node_id, address, poll_payload=(0,), callback=None):
+        """Add a node to poll. address is a list of bytes (as many as SETUP_AW says),
+        poll_payload the payload sent to it and callback(node_id, payload) is called with
+        each reply."""
+        assert node_id not in self._nodes, "Node %r already added" % (node_id,)
+        self._nodes[node_id] = _PolledNode(node_id, address, list(poll_payload), callback,
+                                           self._timer.now_ns())
+
+    def remove_node(self, node_id):
+        del self._nodes[node_id]
+
+    def stop(self):
+        "Make run() return. May be called from another thread or a callback."
+        self._stopped = True
+
+    def run(self, duration=None):
+        "Poll nodes until stop() is called or duration seconds have passed."
+        self._stopped = False
+        end_ns = None if duration is None else self._timer.deadline(duration)
+        while not self._stopped and (end_ns is None or self._timer.now_ns() < end_ns):
+            if self.run_once() is None:
+                # Nothing due yet, sleep until something is
+                next_due_ns = min(node.due_ns for node in self._nodes.values()) if self._nodes else None
+                if next_due_ns is None:
+                    break
+                self._timer.sleep_until(next_due_ns if end_ns is None else min(next_due_ns, end_ns))
+
+    def run_once(self):
+        """Poll the node which has been due the longest, if any. Return its node_id, or None
+        if no node is due."""
+        if not self._nodes:
+            return None
+        node = min(self._nodes.values(), key=lambda n: n.due_ns)
+        now = self._timer.now_ns()
+        if node.due_ns > now:
+            return None
+        self._poll(node)
+        return node.node_id
+
+    def _poll(self, node):
+        device = self._device
+        if self._current_address != node.address:
+            device.set(REG_TX_ADDR(node.address), REG_RX_ADDR_P0(node.address))
+            self._current_address = node.address
+
+        node.num_polls += 1
+        device.write_tx_payload(node.poll_payload)
+        device.pulse_chip_enable()
+
+        timeout_ns = self._timer.now_ns() + self._tx_timeout_ns
+        while True:
+            status = device.get_status()
+            if TX_DS.get(status) or MAX_RT.get(status) or self._timer.now_ns() > timeout_ns:
+                break
+
+        now = self._timer.now_ns()
+        if TX_DS.get(status):
+            node.consecutive_failures = 0
+            if RX_DR.get(status):
+                result = device.read_dynamic_payload()
+                if result is not None:
+                    pipe, payload = result
+                    node.num_replies += 1
+                    node.latencies.append(now - node.due_ns)
+                    if node.callback is not None:
+                        node.callback(node.node_id, payload)
+            # Don't let a node which has been waiting a long time get several polls in a row
+            node.due_ns = max(node.due_ns + self._poll_interval_ns, now)
+        else:
+            # MAX_RT (or timeout). The packet stays in the TX FIFO, so remove it.
+            device.flush_tx_fifo()
+            node.num_failures += 1
+            node.consecutive_failures += 1
+            backoff = min(2 ** node.consecutive_failures, self._max_backoff)
+            # Back off even if polling as fast as possible, by at least the time of a failed poll
+            node.due_ns = now + backoff * max(self._poll_interval_ns, self._tx_timeout_ns)
+
+        # Clear RX_DR, TX_DS and MAX_RT by writing 1 to them
+        device.set(REG_STATUS((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+
+    def get_stats(self, node_id):
+        """Return a dict with the number of polls, replies and failures (MAX_RT) for a node, and
+        the median, 99th percentile and max latency in seconds (None if no replies)."""
+        node = self._nodes[node_id]
+        latencies = sorted(node.latencies)
+        return {"polls": node.num_polls,
+                "replies": node.num_replies,
+                "failures": node.num_failures,
+                "latency_median": None if not latencies else _percentile(latencies, 0.5) / 1e9,
+                "latency_p99": None if not latencies else _percentile(latencies, 0.99) / 1e9,
+                "latency_max": None if not latencies else latencies[-1] / 1e9}
+
+
+# The first byte of the address of each pipe in NRF24TreeNetwork. Pipes 1-5 share the other bytes.
+_TREE_PIPE_BYTES = (0x3C, 0x5A, 0x69, 0x96, 0xA5, 0xC3)
+_TREE_ADDRESS_PREFIX = (0xCC, 0xCE)
+_TREE_HEADER = struct.Struct("<HHBB")  # Destination, source, frame id, data size
+TREE_MAX_DATA_SIZE = 32 - _TREE_HEADER.size
+
+
+def _get_tree_level(node):
+    "Return the number of octal digits in node, i.e. its depth in the tree (0 for the root)."
+    level = 0
+    while node:
+        node >>= 3
+        level += 1
+    return level
+
+
+def is_valid_tree_node(node):
+    """Return True if node is a valid node address in NRF24TreeNetwork, i.e. 0 (the root)
+    or up to 4 octal digits 1-5, e.g. 0o3 (child 3 of the root) or 0o53 (child 5 of 0o3)."""
+    if not 0 <= node <= 0o5555:
+        return False
+    while node:
+        if not 1 <= node & 7 <= 5:
+            return False
+        node >>= 3
+    return True
+
+
+def get_tree_parent(node):
+    "Return the parent of node in NRF24TreeNetwork, None for the root."
+    if node == 0:
+        return None
+    return node & ((1 << (3 * (_get_tree_level(node) - 1))) - 1)
+
+
+def get_tree_pipe_address(node, pipe, address_width=5):
+    """Return the address (list of bytes, LSByte first) node listens on in pipe in
+    NRF24TreeNetwork. Pipe 0 is used for frames from the parent and pipes 1-5 for frames from
+    the children with that last digit. Pipes 1-5 only differ in the first byte, as required."""
+    assert is_valid_tree_node(node), "Invalid node %r" % node
+    address = [_TREE_PIPE_BYTES[pipe], node & 0xFF, node >> 8] + list(_TREE_ADDRESS_PREFIX)
+    return address[:address_width]
+
+
+def get_tree_next_hop(node, destination):
+    """Return (next_node, pipe) for forwarding a frame at node towards destination in
+    NRF24TreeNetwork, where pipe is the pipe of next_node to send to. Return None if
+    destination is node itself. Only needs the two addresses, no routing table."""
+    if destination == node:
+        return None
+    level = _get_tree_level(node)
+    mask = (1 << (3 * level)) - 1
+    if destination & mask == node and destination != node:
+        # destination is below us, send to our child on the way there, on its pipe 0
+        child = destination & ((mask << 3) | 7)
+        return child, 0
+    # Send to our parent, on the pipe with our last digit
+    return get_tree_parent(node), node >> (3 * (level - 1))
+
+
+class NRF24TreeNetwork(object):
+    """A multi-hop network where the nodes form a tree, rooted at node 0. Node addresses are
+    up to 4 octal digits 1-5 where the last (most significant) digit says which child of its
+    parent a node is, e.g. 0o213 is child 2 of 0o13, which is child 1 of 0o3, which is child 3
+    of the root. Each node has up to 5 children and listens on pipe 0 for its parent and on
+    pipe 1-5 for its children (see get_tree_pipe_address()). Frames to any node are forwarded
+    hop by hop using only the addresses (get_tree_next_hop()), with one bounded queue per next
+    hop and auto ACK on each hop.
+    Each frame carries up to TREE_MAX_DATA_SIZE bytes of data. Call update() often (e.g. when
+    IRQ goes low) on every node to receive, forward and send frames.
+    Example:
+        network = NRF24TreeNetwork(device, node=0o12)
+        network.begin()
+        network.send(0, [1, 2, 3])
+        while True:
+            network.update()
+            frame = network.receive()
+            if frame is not None:
+                source, data = frame
+                ...
+    """
+
+    def __init__(self, device, node, max_queue=16, max_local_queue=32, timer=None):
+        """timer is used for TX timeouts, by default the one of device."""
+        assert is_valid_tree_node(node), "Invalid node %r" % node
+        self._device = device
+        self._timer = timer if timer is not None else device._timer
+        self.node = node
+        self._max_queue = max_queue
+        self._tx_queues = collections.OrderedDict()  # (next node, pipe) -> deque of frames
+        self._rx_queue = collections.deque(maxlen=max_local_queue)
+        self._next_frame_id = 0
+        self._config = None
+        self._address_width = 5
+        self._tx_timeout_ns = None
+        self._current_tx_address = None
+        self.num_forwarded = 0
+        self.num_delivered = 0
+        self.num_dropped = 0
+        self.num_tx_failures = 0
+
+    def begin(self):
+        """Configure the device: pipe addresses, auto ACK and 32 byte payloads on all pipes,
+        and put it in RX mode. Other settings (channel, data rate etc.) must be the same on
+        all nodes and are left as they are."""
+        device = self._device
+        device.chip_enable_low()
+        self._address_width = device.get(AW) + 2
+        self._tx_timeout_ns = _get_tx_timeout_ns(device)
+        addresses = [get_tree_pipe_address(self.node, pipe, self._address_width) for pipe in range(6)]
+        device.set(REG_RX_ADDR_P0(addresses[0]),
+                   REG_RX_ADDR_P1(addresses[1]),
+                   REG_RX_ADDR_P2(addresses[2][0]),
+                   REG_RX_ADDR_P3(addresses[3][0]),
+                   REG_RX_ADDR_P4(addresses[4][0]),
+                   REG_RX_ADDR_P5(addresses[5][0]),
+                   REG_EN_AA(0x3F),
+                   REG_EN_RXADDR(0x3F),
+                   REG_DYNPD(0),
+                   *[find_register("RX_PW_P%d" % pipe)(32) for pipe in range(6)])
+        device.set(EN_DPL(0) | EN_ACK_PAY(0))
+        device.flush_rx_fifo()
+        device.flush_tx_fifo()
+        # Keep a copy of CONFIG, so switching between RX and TX doesn't need to read it
+        config = device.get(REG_CONFIG)
+        self._config = config | (1 << PWR_UP.START_BIT) | (1 << PRIM_RX.START_BIT)
+        device.set(REG_CONFIG(self._config))
+        device.chip_enable_high()
+
+    def send(self, destination, data):
+        """Queue data (up to TREE_MAX_DATA_SIZE bytes) to be sent to destination. Return False if
+        the queue for the next hop was full and the frame was dropped."""
+        assert 0 < len(data) <= TREE_MAX_DATA_SIZE, "Invalid data size %d" % len(data)
+        assert is_valid_tree_node(destination), "Invalid destination %r" % destination
+        data = _to_bytes(data)
+        frame = list(bytearray(_TREE_HEADER.pack(destination, self.node, self._next_frame_id, len(data))))
+        frame += data
+        self._next_frame_id = (self._next_frame_id + 1) & 0xFF
+        if destination == self.node:
+            self._deliver(frame)
+            return True
+        return self._enqueue(destination, frame)
+
+    def receive(self):
+        "Return (source, data) for the oldest frame received for this node, or None."
+        try:
+            return self._rx_queue.popleft()
+        except IndexError:
+            return None
+
+    def _enqueue(self, destination, frame):
+        hop = get_tree_next_hop(self.node, destination)
+        queue = self._tx_queues.get(hop)
+        if queue is None:
+            queue = self._tx_queues[hop] = collections.deque()
+        if len(queue) >= self._max_queue:
+            self.num_dropped += 1
+            return False
+        queue.append(frame)
+        return True
+
+    def _deliver(self, frame):
+        destination, source, frame_id, size = _TREE_HEADER.unpack_from(bytes(bytearray(frame)))
+        self.num_delivered += 1
+        self._rx_queue.append((source, frame[_TREE_HEADER.size:_TREE_HEADER.size + size]))
+
+    def update(self, max_frames=None):
+        """Receive frames, deliver the ones for this node and queue the rest for forwarding,
+        and then send queued frames (up to max_frames of them). Return the number of frames
+        received."""
+        device = self._device
+        num_received = 0
+        status = device.get_status()
+        if RX_DR.get(status):
+            # Clear RX_DR before reading, so that a frame which arrives meanwhile sets it again
+            status = device.set(REG_STATUS(1 << RX_DR.START_BIT))
+        while RX_P_NO.get(status) <= 5:
+            status, frame = device.read_rx_payload(32)
+            num_received += 1
+            destination = frame[0] | (frame[1] << 8)
+            if destination == self.node:
+                self._deliver(frame)
+            elif self._enqueue(destination, frame):
+                self.num_forwarded += 1
+            status = device.get_status()
+
+        num_sent = 0
+        for hop, queue in self._tx_queues.items():
+            while queue and (max_frames is None or num_sent < max_frames):
+                if not self._transmit(hop, queue[0]):
+                    # Try again at the next update, and don't block the other hops meanwhile
+                    self.num_tx_failures += 1
+                    break
+                queue.popleft()
+                num_sent += 1
+        return num_received
+
+    def _transmit(self, hop, frame):
+        "Send one frame to hop, switching to TX mode and back. Return True if it was ACKed."
+        device = self._device
+        next_node, pipe = hop
+        address = get_tree_pipe_address(next_node, pipe, self._address_width)
+
+        device.chip_enable_low()
+        device.set(REG_CONFIG(self._config & ~(1 << PRIM_RX.START_BIT)))
+        if address != self._current_tx_address:
+            device.set(REG_TX_ADDR(address))
+            self._current_tx_address = address
+        # The ACK comes to pipe 0 on the TX address
+        device.set(REG_RX_ADDR_P0(address))
+        device.write_tx_payload(frame + [0] * (32 - len(frame)))
+        device.pulse_chip_enable()
+
+        timeout_ns = self._timer.now_ns() + self._tx_timeout_ns
+        while True:
+            status = device.get_status()
+            if (status & ((1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)) or
+                    self._timer.now_ns() > timeout_ns):
+                break
+        ok = bool(TX_DS.get(status))
+        if not ok:
+            device.flush_tx_fifo()
+
+        device.set(REG_STATUS((1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)),
+                   REG_RX_ADDR_P0(get_tree_pipe_address(self.node, 0, self._address_width)),
+                   REG_CONFIG(self._config))
+        device.chip_enable_high()
+        return ok
+
+
+class NRF24AdaptiveReceiver(object):
+    """A receive loop that sleeps waiting for IRQ when packets are rare, and busy-polls STATUS
+    (with one byte NOP transfers) when they arrive so often that waking up on IRQ would limit
+    the rate. Packets are read and dispatched by an NRF24RxRouter.
+    It switches to polling when the average time between packets drops below the poll
+    threshold, and back to waiting for IRQ when no packet has arrived for idle_factor times the
+    average time between packets (but at least min_idle_time seconds). The poll threshold is
+    wake_factor times the average wake latency, the time from the IRQ edge until
+    wait_for_irq_low() has returned, which is measured in IRQ mode. Until the first wake up it
+    is 1 ms.
+    The time spent and packets received in each mode are available through get_stats().
+    Example:
+        router = NRF24RxRouter(device)
+        router.set_route(0, callback=handle_packet)
+        receiver = NRF24AdaptiveReceiver(device, router)
+        device.chip_enable_high()
+        receiver.run()
+    """
+
+    MODE_IRQ = "irq"
+    MODE_POLL = "poll"
+
+    def __init__(self, device, router, poll_threshold=None, idle_factor=10.0, min_idle_time=5e-3,
+                 irq_timeout=0.1, smoothing=0.1, timer=None, wake_factor=2.0):
+        """poll_threshold in seconds overrides the one derived from the wake latency.
+        irq_timeout is the max time in seconds to wait for IRQ before checking whether to stop.
+        smoothing is the weight of the newest sample in the moving averages."""
+        self._device = device
+        self._router = router
+        self._timer = timer if timer is not None else _default_timer
+        self._poll_threshold_ns = None if poll_threshold is None else int(poll_threshold * 1e9)
+        self._wake_factor = wake_factor
+        self._idle_factor = idle_factor
+        self._min_idle_ns = int(min_idle_time * 1e9)
+        self._irq_timeout = irq_timeout
+        self._smoothing = smoothing
+        self._stopped = False
+
+        self.mode = self.MODE_IRQ
+        self._mean_interarrival_ns = None
+        self._mean_wake_ns = None
+        self._last_packet_ns = None
+        self._time_in_mode_ns = {self.MODE_IRQ: 0, self.MODE_POLL: 0}
+        self._packets_in_mode = {self.MODE_IRQ: 0, self.MODE_POLL: 0}
+        self._num_mode_switches = 0
+
+    def stop(self):
+        "Make run() return (within irq_timeout). May be called from another thread or a callback."
+        self._stopped = True
+
+    def run(self, duration=None):
+        "Receive packets until stop() is called or duration seconds have passed."
+        self._stopped = False
+        end_ns = None if duration is None else self._timer.deadline(duration)
+        mode_start_ns = self._timer.now_ns()
+        while not self._stopped:
+            now = self._timer.now_ns()
+            if end_ns is not None and now >= end_ns:
+                break
+            mode = self.mode
+            if mode == self.MODE_IRQ:
+                timeout = self._irq_timeout
+                if end_ns is not None:
+                    timeout = max(0.0, min(timeout, (end_ns - now) / 1e9))
+                last_irq_ns = self._device.last_irq_ns
+                self._device.wait_for_irq_low(timeout)
+                if self._device.last_irq_ns != last_irq_ns:
+                    # Only an edge during this wait tells how long waking up took
+                    self._add_wake_latency(self._timer.now_ns() - self._device.last_irq_ns)
+                self._receive()
+            else:
+                # RX_P_NO is 7 when the RX FIFO is empty
+                if (self._device.get_status() >> 1) & 0b111 != 0b111:
+                    self._receive()
+                elif self._is_idle():
+                    self.mode = self.MODE_IRQ
+
+            if self.mode != mode:
+                now = self._timer.now_ns()
+                self._time_in_mode_ns[mode] += now - mode_start_ns
+                mode_start_ns = now
+                self._num_mode_switches += 1
+        self._time_in_mode_ns[self.mode] += self._timer.now_ns() - mode_start_ns
+
+    def _receive(self):
+        num_packets = self._router.poll()
+        if num_packets == 0:
+            return
+        now = self._timer.now_ns()
+        self._packets_in_mode[self.mode] += num_packets
+        if self._last_packet_ns is not None:
+            interarrival = (now - self._last_packet_ns) / num_packets
+            if self._mean_interarrival_ns is None:
+                self._mean_interarrival_ns = interarrival
+            else:
+                self._mean_interarrival_ns += self._smoothing * (interarrival - self._mean_interarrival_ns)
+        self._last_packet_ns = now
+        if (self.mode == self.MODE_IRQ and self._mean_interarrival_ns is not None and
+                self._mean_interarrival_ns < self._get_poll_threshold_ns()):
+            self.mode = self.MODE_POLL
+
+    def _add_wake_latency(self, wake_ns):
+        if self._mean_wake_ns is None:
+            self._mean_wake_ns = wake_ns
+        else:
+            self._mean_wake_ns += self._smoothing * (wake_ns - self._mean_wake_ns)
+
+    def _get_poll_threshold_ns(self):
+        if self._poll_threshold_ns is not None:
+            return self._poll_threshold_ns
+        if self._mean_wake_ns is None:
+            return 1000*1000
+        return self._wake_factor * self._mean_wake_ns
+
+    def _is_idle(self):
+        idle_ns = max(self._min_idle_ns, self._idle_factor * (self._mean_interarrival_ns or 0))
+        if self._timer.now_ns() - self._last_packet_ns <= idle_ns:
+            return False
+        # Forget the burst, so the next one has to prove itself before we start polling again
+        self._mean_interarrival_ns = None
+        self._last_packet_ns = None
+        return True
+
+    def get_stats(self):
+        """Return a dict with the time in seconds spent and the number of packets received in
+        each mode, the number of mode switches, the current average time between packets and
+        wake latency, and the poll threshold."""
+        return {"irq_time": self._time_in_mode_ns[self.MODE_IRQ] / 1e9,
+                "poll_time": self._time_in_mode_ns[self.MODE_POLL] / 1e9,
+                "irq_packets": self._packets_in_mode[self.MODE_IRQ],
+                "poll_packets": self._packets_in_mode[self.MODE_POLL],
+                "mode_switches": self._num_mode_switches,
+                "mean_interarrival": (None if self._mean_interarrival_ns is None else
+                                      self._mean_interarrival_ns / 1e9),
+                "wake_latency": None if self._mean_wake_ns is None else self._mean_wake_ns / 1e9,
+                "poll_threshold": self._get_poll_threshold_ns() / 1e9}
+
+
+# Frames in NRF24BondedSender/NRF24BondedReceiver: sequence number and data size, followed by
+# the data and padded to 32 bytes.
+_BOND_HEADER = struct.Struct("<HB")
+BOND_MAX_DATA_SIZE = 32 - _BOND_HEADER.size
+
+
+def _get_sequence_offset(sequence, base):
+    "How far sequence is ahead of base in 16 bit sequence numbers, negative if behind."
+    offset = (sequence - base) & 0xFFFF
+    return offset - 0x10000 if offset >= 0x8000 else offset
+
+
+class NRF24BondedSender(object):
+    """Sends one stream of data over several radios at once, e.g. on different channels, to get
+    more throughput than one radio can give. Frames are numbered and put in a common queue, and
+    each device has a thread which takes the next frame from the queue and sends it, so faster
+    radios send more frames. Frames which are not ACKed are put back first in the queue to be
+    sent by any radio (at most max_attempts times). A radio's loss rate is tracked with a moving
+    average, and a lossy radio waits (tx timeout * loss rate / (1 - loss rate)) before taking
+    the next frame, leaving more of them to the others.
+    Each device must be a powered up PTX with auto ACK, 32 byte (or dynamic) payloads and its
+    TX_ADDR and RX_ADDR_P0 set to its NRF24BondedReceiver device, and is only used by its thread
+    after start().
+    Example:
+        sender = NRF24BondedSender([device_a, device_b])
+        sender.start()
+        for chunk in chunks:
+            sender.send(chunk)
+        sender.flush()
+        sender.stop()
+    """
+
+    def __init__(self, devices, max_queue=64, max_attempts=4, loss_smoothing=0.05, timer=None):
+        """timer is used for the timeouts of send() and flush(), by default the one of the first
+        device. TX timeouts use the timer of each device."""
+        self._devices = list(devices)
+        self._timer = timer if timer is not None else self._devices[0]._timer
+        self._max_queue = max_queue
+        self._max_attempts = max_attempts
+        self._loss_smoothing = loss_smoothing
+        self._queue = collections.deque()  # [frame, attempts]
+        self._condition = threading.Condition()
+        self._num_in_flight = 0
+        self._next_sequence = 0
+        self._stopped = False
+        self._threads = []
+        self._tx_timeout_ns = [None] * len(self._devices)
+        self._num_sent = [0] * len(self._devices)
+        self._num_failures = [0] * len(self._devices)
+        self._loss_rates = [0.0] * len(self._devices)
+        self.num_dropped = 0
+
+    def start(self):
+        "Start one thread per device."
+        self._stopped = False
+        for index, device in enumerate(self._devices):
+            self._tx_timeout_ns[index] = _get_tx_timeout_ns(device)
+            # Calibrate now, or the loss backoff busy-waits and starves the other threads
+            device._timer.get_spin_threshold()
+            thread = threading.Thread(target=self._run, args=(index,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        "Stop the threads (after the frames being sent) and wait for them. Queued frames are kept."
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def send(self, data, timeout=None):
+        """Queue data (up to BOND_MAX_DATA_SIZE bytes) to be sent, waiting while the queue is full.
+        Return the sequence number of the frame, or None on timeout."""
+        assert 0 < len(data) <= BOND_MAX_DATA_SIZE, "Invalid data size %d" % len(data)
+        data = _to_bytes(data)
+        end_ns = None if timeout is None else self._timer.deadline(timeout)
+        with self._condition:
+            while len(self._queue) >= self._max_queue:
+                remaining = None if end_ns is None else (end_ns - self._timer.now_ns()) / 1e9
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            sequence = self._next_sequence
+            self._next_sequence = (sequence + 1) & 0xFFFF
+            frame = list(bytearray(_BOND_HEADER.pack(sequence, len(data)))) + data
+            self._queue.append([frame + [0] * (32 - len(frame)), 0])
+            self._condition.notify_all()
+        return sequence
+
+    def flush(self, timeout=None):
+        "Wait until all queued frames have been sent or dropped. Return False on timeout."
+        end_ns = None if timeout is None else self._timer.deadline(timeout)
+        with self._condition:
+            while self._queue or self._num_in_flight:
+                remaining = None if end_ns is None else (end_ns - self._timer.now_ns()) / 1e9
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _run(self, index):
+        device = self._devices[index]
+        while True:
+            loss_rate = min(self._loss_rates[index], 0.95)
+            if loss_rate and len(self._devices) > 1:
+                # Often well below a millisecond, where time.sleep() overshoots a lot
+                device._timer.sleep(self._tx_timeout_ns[index] / 1e9 * loss_rate / (1 - loss_rate))
+            with self._condition:
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                item = self._queue.popleft()
+                self._num_in_flight += 1
+                self._condition.notify_all()
+
+            ok = self._transmit(index, device, item[0])
+            loss = 0.0 if ok else 1.0
+            self._loss_rates[index] += self._loss_smoothing * (loss - self._loss_rates[index])
+
+            with self._condition:
+                self._num_in_flight -= 1
+                if ok:
+                    self._num_sent[index] += 1
+                else:
+                    self._num_failures[index] += 1
+                    item[1] += 1
+                    if item[1] < self._max_attempts:
+                        self._queue.appendleft(item)
+                    else:
+                        self.num_dropped += 1
+                self._condition.notify_all()
+
+    def _transmit(self, index, device, frame):
+        device.write_tx_payload(frame)
+        device.pulse_chip_enable()
+        timer = device._timer
+        timeout_ns = timer.now_ns() + self._tx_timeout_ns[index]
+        while True:
+            status = device.get_status()
+            if (status & ((1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)) or
+                    timer.now_ns() > timeout_ns):
+                break
+        ok = bool(TX_DS.get(status))
+        if not ok:
+            device.flush_tx_fifo()
+        device.set(REG_STATUS((1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+        return ok
+
+    def get_stats(self):
+        """Return a list with a dict for each device with the number of frames sent and failed
+        (not ACKed), and the current moving average of the loss rate."""
+        return [{"sent": self._num_sent[index],
+                 "failures": self._num_failures[index],
+                 "loss_rate": self._loss_rates[index]}
+                for index in range(len(self._devices))]
+
+
+class NRF24BondedReceiver(object):
+    """Receives a stream sent by NRF24BondedSender over several radios and puts the frames back
+    in order. Each device has a thread which reads frames, and frames that arrive early wait in
+    a reorder buffer for the missing ones, which are skipped (counted in num_lost) when more than
+    window frames are ahead of them or they have been missing for max_delay seconds.
+    Duplicates (a frame sent again because its ACK was lost) are dropped.
+    Each device must be a powered up PRX with auto ACK and 32 byte (or dynamic) payloads, with CE
+    high, and the IRQ pin connected (wait_for_irq_low() is used).
+    Example:
+        receiver = NRF24BondedReceiver([device_a, device_b])
+        receiver.start()
+        while True:
+            data = receiver.receive()
+    """
+
+    def __init__(self, devices, window=256, max_delay=0.1, irq_timeout=0.05, first_sequence=0,
+                 timer=None):
+        """timer is used for max_delay and the timeout of receive(), by default the one of the
+        first device."""
+        assert 0 < window < 0x8000
+        self._devices = list(devices)
+        self._timer = timer if timer is not None else self._devices[0]._timer
+        self._window = window
+        self._max_delay_ns = int(max_delay * 1e9)
+        self._irq_timeout = irq_timeout
+        self._condition = threading.Condition()
+        self._pending = {}  # sequence -> data
+        self._output = collections.deque()
+        self._next_sequence = first_sequence
+        self._gap_since = None  # When the oldest missing frame was first missed
+        self._stopped = False
+        self._threads = []
+        self._num_received = [0] * len(self._devices)
+        self.num_delivered = 0
+        self.num_lost = 0
+        self.num_duplicates = 0
+
+    def start(self):
+        "Start one thread per device."
+        self._stopped = False
+        for index, device in enumerate(self._devices):
+            thread = threading.Thread(target=self._run, args=(index,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        "Stop the threads (within irq_timeout) and wait for them."
+        self._stopped = True
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self, index):
+        device = self._devices[index]
+        while not self._stopped:
+            device.wait_for_irq_low(self._irq_timeout)
+            status = device.get_status()
+            if RX_DR.get(status):
+                # Clear RX_DR before reading, so that a frame which arrives meanwhile sets it
+                # and IRQ again
+                status = device.set(REG_STATUS(1 << RX_DR.START_BIT))
+            while RX_P_NO.get(status) <= 5:
+                status, frame = device.read_rx_payload(32)
+                self._num_received[index] += 1
+                self._add_frame(frame)
+                status = device.get_status()
+
+    def _add_frame(self, frame):
+        sequence, size = _BOND_HEADER.unpack_from(bytes(bytearray(frame[:_BOND_HEADER.size])))
+        data = frame[_BOND_HEADER.size:_BOND_HEADER.size + size]
+        with self._condition:
+            offset = _get_sequence_offset(sequence, self._next_sequence)
+            if offset < 0 or sequence in self._pending:
+                self.num_duplicates += 1
+                return
+            self._pending[sequence] = data
+            while offset >= self._window:
+                self._skip_missing()
+                offset -= 1
+            self._deliver_in_order()
+
+    def _skip_missing(self):
+        "Advance past the next frame, delivering it if it's there."
+        data = self._pending.pop(self._next_sequence, None)
+        if data is None:
+            self.num_lost += 1
+        else:
+            self._output.append(data)
+            self.num_delivered += 1
+        self._next_sequence = (self._next_sequence + 1) & 0xFFFF
+
+    def _deliver_in_order(self):
+        while self._next_sequence in self._pending:
+            self._skip_missing()
+        if not self._pending:
+            self._gap_since = None
+        elif self._gap_since is None:
+            self._gap_since = self._timer.now_ns()
+        self._condition.notify_all()
+
+    def _skip_gap(self):
+        "Give up on the missing frames before the oldest frame in the reorder buffer."
+        while self._next_sequence not in self._pending:
+            self._skip_missing()
+        self._gap_since = None
+        self._deliver_in_order()
+
+    def receive(self, timeout=None):
+        "Return the data of the next frame in order, waiting at most timeout seconds, or None."
+        end_ns = None if timeout is None else self._timer.deadline(timeout)
+        with self._condition:
+            while not self._output:
+                now = self._timer.now_ns()
+                if self._gap_since is not None and now - self._gap_since >= self._max_delay_ns:
+                    self._skip_gap()
+                    continue
+                waits = []
+                if end_ns is not None:
+                    if now >= end_ns:
+                        return None
+                    waits.append(end_ns - now)
+                if self._gap_since is not None:
+                    waits.append(self._gap_since + self._max_delay_ns - now)
+                self._condition.wait(min(waits) / 1e9 if waits else None)
+            return self._output.popleft()
+
+    def get_stats(self):
+        "Return a list with the number of frames received by each device, including duplicates."
+        return list(self._num_received)
+
+
+# Frames from NRF24FecEncoder: block id, index of the frame in the block (the data frames first,
+# then the parity frames) and number of data frames in the block, followed by one symbol.
+_FEC_HEADER = struct.Struct("<HBB")
+FEC_SYMBOL_SIZE = 32 - _FEC_HEADER.size
+
+_fec_tables = None
+
+
+def _get_fec_tables():
+    """Return (mul, inv), GF(2^8) (polynomial 0x11D) multiplication table as a 256x256 numpy array
+    and multiplicative inverses as a 256 array. Created on first use."""
+    global _fec_tables
+    if _fec_tables is None:
+        numpy = _import_numpy()
+        exp = numpy.zeros(510, dtype=numpy.uint8)
+        log = numpy.zeros(256, dtype=numpy.int32)
+        x = 1
+        for i in range(255):
+            exp[i] = x
+            log[x] = i
+            x <<= 1
+            if x & 0x100:
+                x ^= 0x11D
+        exp[255:] = exp[:255]
+        mul = exp[log[:, None] + log[None, :]]
+        mul[0, :] = 0
+        mul[:, 0] = 0
+        inv = numpy.zeros(256, dtype=numpy.uint8)
+        inv[1:] = exp[255 - log[1:]]
+        _fec_tables = mul, inv
+    return _fec_tables
+
+
+def _get_fec_coding_rows(indexes, num_data):
+    """Return the rows of the coding matrix for frames with the given indexes, as a numpy array.
+    Data frames have rows of the identity matrix, parity frame i has the row of a Cauchy matrix
+    1 / (i + j) for data frame j, so any num_data rows form an invertible matrix."""
+    numpy = _import_numpy()
+    mul, inv = _get_fec_tables()
+    indexes = numpy.asarray(indexes, dtype=numpy.uint8)
+    columns = numpy.arange(num_data, dtype=numpy.uint8)
+    rows = inv[indexes[:, None] ^ columns[None, :]]
+    is_data = indexes < num_data
+    rows[is_data] = (indexes[is_data, None] == columns[None, :])
+    return rows
+
+
+def _fec_multiply(matrix, symbols):
+    "Matrix product of matrix (r x k) and symbols (k x FEC_SYMBOL_SIZE) over GF(2^8)."
+    numpy = _import_numpy()
+    mul, inv = _get_fec_tables()
+    return numpy.bitwise_xor.reduce(mul[matrix[:, :, None], symbols[None, :, :]], axis=1)
+
+
+def _fec_invert(matrix):
+    "Invert a square matrix over GF(2^8) with Gauss-Jordan elimination."
+    numpy = _import_numpy()
+    mul, inv = _get_fec_tables()
+    size = len(matrix)
+    work = numpy.concatenate([matrix, numpy.eye(size, dtype=numpy.uint8)], axis=1)
+    for column in range(size):
+        pivot = column + numpy.flatnonzero(work[column:, column])[0]
+        if pivot != column:
+            work[[column, pivot]] = work[[pivot, column]]
+        work[column] = mul[inv[work[column, column]], work[column]]
+        factors = work[:, column].copy()
+        factors[column] = 0
+        work ^= mul[factors[:, None], work[column][None, :]]
+    return work[:, size:]
+
+
+class NRF24FecEncoder(object):
+    """Forward error correction for sending without ACKs (e.g. broadcasting to many receivers),
+    where lost packets can't be sent again. Data is split into blocks of up to num_data frames,
+    and num_parity parity frames are added to each block. A receiver (NRF24FecDecoder) can rebuild
+    the block from any num_data of the frames, so up to num_parity lost frames per block are
+    recovered. Each frame is 32 bytes with FEC_SYMBOL_SIZE bytes of data. It's a systematic
+    Reed-Solomon (Cauchy) erasure code over GF(2^8), so num_data + num_parity must be at most 255.
+    Requires numpy.
+    Example:
+        encoder = NRF24FecEncoder(num_data=16, num_parity=4)
+        for block_id, offset in enumerate(range(0, len(data), encoder.get_block_size())):
+            for frame in encoder.encode_block(block_id, data[offset:offset + encoder.get_block_size()]):
+                device.write_tx_payload_no_ack(frame)
+    """
+
+    def __init__(self, num_data=16, num_parity=4):
+        assert 0 < num_data and 0 <= num_parity and num_data + num_parity <= 255
+        self.num_data = num_data
+        self.num_parity = num_parity
+
+    def get_block_size(self):
+        "Max number of data bytes in a block."
+        return self.num_data * FEC_SYMBOL_SIZE
+
+    def encode_block(self, block_id, data):
+        """Return the frames (lists of 32 ints) for one block of data, at most get_block_size()
+        bytes, as data frames followed by parity frames. A short block has fewer data frames,
+        and the last one is padded with zeros. block_id (0-65535) identifies the block."""
+        numpy = _import_numpy()
+        data = bytearray(data)
+        assert 0 < len(data) <= self.get_block_size(), "Invalid block size %d" % len(data)
+        num_data = (len(data) + FEC_SYMBOL_SIZE - 1) // FEC_SYMBOL_SIZE
+        symbols = numpy.zeros((num_data, FEC_SYMBOL_SIZE), dtype=numpy.uint8)
+        symbols.reshape(-1)[:len(data)] = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+        indexes = numpy.arange(num_data, num_data + self.num_parity)
+        parity = _fec_multiply(_get_fec_coding_rows(indexes, num_data), symbols)
+
+        headers = numpy.zeros((num_data + self.num_parity, _FEC_HEADER.size), dtype=numpy.uint8)
+        headers[:, 0] = block_id & 0xFF
+        headers[:, 1] = block_id >> 8
+        headers[:, 2] = numpy.arange(num_data + self.num_parity)
+        headers[:, 3] = num_data
+        frames = numpy.concatenate([headers, numpy.concatenate([symbols, parity])], axis=1)
+        return frames.tolist()
+
+
+class NRF24FecDecoder(object):
+    """Collects frames from NRF24FecEncoder and rebuilds each block as soon as enough frames
+    of it have arrived. Frames of finished blocks are ignored. At most max_blocks unfinished
+    blocks are kept, the oldest is given up (counted in num_failed_blocks) when there are more.
+    Requires numpy.
+    Example:
+        decoder = NRF24FecDecoder()
+        status, frame = device.read_rx_payload(32)
+        result = decoder.add_frame(frame)
+        if result is not None:
+            block_id, data = result
+    """
+
+    def __init__(self, max_blocks=16):
+        self._max_blocks = max_blocks
+        self._blocks = collections.OrderedDict()  # block id -> {index: symbol}
+        self._finished = collections.deque(maxlen=4 * max_blocks)
+        self.num_blocks = 0
+        self.num_failed_blocks = 0
+        self.num_recovered_frames = 0
+
+    def add_frame(self, frame):
+        """Add a received 32 byte frame. Return (block_id, data) if it completed a block, where
+        data is a list of ints with all the data frames (the last one including its padding),
+        otherwise None."""
+        frame = bytearray(frame)
+        block_id, index, num_data = _FEC_HEADER.unpack_from(bytes(frame[:_FEC_HEADER.size]))
+        if block_id in self._finished or num_data == 0:
+            return None
+        symbols = self._blocks.get(block_id)
+        if symbols is None:
+            if len(self._blocks) >= self._max_blocks:
+                self._blocks.popitem(last=False)
+                self.num_failed_blocks += 1
+            symbols = self._blocks[block_id] = {}
+        symbols[index] = frame[_FEC_HEADER.size:]
+        if len(symbols) < num_data:
+            return None
+
+        del self._blocks[block_id]
+        self._finished.append(block_id)
+        self.num_blocks += 1
+        return block_id, self._decode(symbols, num_data)
+
+    def _decode(self, symbols, num_data):
+        numpy = _import_numpy()
+        if all(index in symbols for index in range(num_data)):
+            return list(bytearray().join(symbols[index] for index in range(num_data)))
+        indexes = sorted(symbols)[:num_data]
+        received = numpy.array([list(symbols[index]) for index in indexes], dtype=numpy.uint8)
+        decoding = _fec_invert(_get_fec_coding_rows(indexes, num_data))
+        self.num_recovered_frames += sum(1 for index in range(num_data) if index not in symbols)
+        return _fec_multiply(decoding, received).reshape(-1).tolist()
+
+
+# Frames in NRF24ArqSender/NRF24ArqReceiver: flags and sequence number, followed by the data.
+# The length comes from dynamic payloads. ACK payloads from the receiver are the next sequence
+# number it needs followed by a bitmap of the frames after that it has received.
+_ARQ_HEADER = struct.Struct("<BH")
+_ARQ_ACK_HEADER = struct.Struct("<H")
+_ARQ_POLL = 1
+ARQ_MAX_DATA_SIZE = 32 - _ARQ_HEADER.size
+ARQ_MAX_WINDOW = 1 + 8 * (32 - _ARQ_ACK_HEADER.size)
+
+
+def _enable_arq_features(device):
+    "Enable dynamic payloads, ACK payloads and no ACK packets, and auto ACK on pipe 0."
+    device.set(EN_DPL(1) | EN_ACK_PAY(1) | EN_DYN_ACK(1))
+    device.set(DPL_P0(1), ENAA_P0(1), ERX_P0(1))
+
+
+class _ArqFrame(object):
+    __slots__ = ("frame", "last_sent", "last_sent_poll", "num_sent")
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.last_sent = None       # Number of frames sent before it was last sent
+        self.last_sent_poll = None  # Number of polls sent before it was last sent
+        self.num_sent = 0
+
+
+class NRF24ArqSender(object):
+    """Sends bulk data reliably with selective repeat instead of the chip's stop-and-wait auto
+    retransmit. Frames are sent with write_tx_payload_no_ack() keeping the TX FIFO full, up to
+    window frames ahead of the oldest frame not yet acknowledged. After every poll_every frames
+    an empty frame is sent with ACK, and the receiver (NRF24ArqReceiver) returns which frames
+    it has in the ACK payload. Only frames that are missing are sent again: frames sent before a
+    frame which has arrived, and frames sent before the previous poll (since the ACK payload is
+    loaded before the poll arrives, it can't show frames sent just before the poll).
+    Both ends must use the same address and channel, see begin() for the other settings.
+    Example:
+        sender = NRF24ArqSender(device)
+        sender.begin()
+        sender.send(data)
+    """
+
+    def __init__(self, device, window=64, poll_every=16, timer=None):
+        assert 1 < window <= ARQ_MAX_WINDOW, "window must be 2-%d" % ARQ_MAX_WINDOW
+        self._device = device
+        self._window = window
+        self._poll_every = poll_every
+        self._timer = timer if timer is not None else _default_timer
+        self._next_sequence = 0
+        self._tx_timeout_ns = None
+        self.num_frames = 0
+        self.num_retransmissions = 0
+        self.num_polls = 0
+        self.num_failed_polls = 0
+
+    def begin(self):
+        """Enable dynamic payloads, ACK payloads and no ACK packets and auto ACK on pipe 0, and put
+        the device in TX mode with CE high. Other settings are left as they are."""
+        device = self._device
+        device.chip_enable_low()
+        _enable_arq_features(device)
+        device.set(PRIM_RX(0), PWR_UP(1))
+        device.flush_tx_fifo()
+        device.set(REG_STATUS((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+        self._tx_timeout_ns = _get_tx_timeout_ns(device)
+        device.pulse_chip_enable()
+        device.chip_enable_high()
+
+    def send(self, data, timeout=None):
+        """Send data (any number of bytes) and return True when all of it has been acknowledged,
+        or False if timeout seconds passed before that or the radio stopped sending (e.g. CE
+        low or MAX_RT set by someone else)."""
+        assert self._tx_timeout_ns is not None, "Call begin() first"
+        data = _to_bytes(data)
+        end_ns = None if timeout is None else self._timer.deadline(timeout)
+        frames = collections.OrderedDict()  # sequence -> _ArqFrame, not yet acknowledged
+        offset = 0
+        num_sent = 0
+        while offset < len(data) or frames:
+            if end_ns is not None and self._timer.now_ns() > end_ns:
+                return False
+            # Fill the window with new frames
+            while offset < len(data) and len(frames) < self._window:
+                chunk = data[offset:offset + ARQ_MAX_DATA_SIZE]
+                offset += len(chunk)
+                sequence = self._next_sequence
+                self._next_sequence = (sequence + 1) & 0xFFFF
+                frames[sequence] = _ArqFrame(list(bytearray(_ARQ_HEADER.pack(0, sequence))) + chunk)
+                self.num_frames += 1
+
+            # Send new frames and frames found to be missing, up to poll_every of them
+            burst = [frame for frame in frames.values() if frame.last_sent is None]
+            burst = burst[:self._poll_every]
+            for frame in burst:
+                if frame.num_sent:
+                    self.num_retransmissions += 1
+                frame.last_sent = num_sent
+                frame.last_sent_poll = self.num_polls
+                frame.num_sent += 1
+                num_sent += 1
+                if not self._wait_for_tx_fifo(False, end_ns):
+                    return False
+                self._device.write_tx_payload_no_ack(frame.frame)
+
+            if not self._wait_for_tx_fifo(True, end_ns):
+                return False
+            ack = self._poll()
+            if ack is not None:
+                self._process_ack(frames, ack)
+        return True
+
+    def _wait_for_tx_fifo(self, empty, end_ns):
+        """Wait until the TX FIFO is empty (or not full, if empty is False). Return False if that
+        didn't happen before end_ns, or within the time sending a full TX FIFO can take."""
+        device = self._device
+        deadline_ns = self._timer.now_ns() + 3 * self._tx_timeout_ns
+        if end_ns is not None:
+            deadline_ns = min(deadline_ns, end_ns)
+        while True:
+            if empty:
+                ready = device.get(TX_EMPTY)
+            else:
+                ready = not TX_FULL.get(device.get_status())
+            if ready:
+                return True
+            if self._timer.now_ns() > deadline_ns:
+                return False
+
+    def _poll(self):
+        "Send a poll (with the TX FIFO empty) and return the ACK payload, or None."
+        device = self._device
+        device.set(REG_STATUS((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+        self.num_polls += 1
+        device.write_tx_payload(list(bytearray(_ARQ_HEADER.pack(_ARQ_POLL, 0))))
+
+        timeout_ns = self._timer.now_ns() + self._tx_timeout_ns
+        while True:
+            status = device.get_status()
+            if (status & ((1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)) or
+                    self._timer.now_ns() > timeout_ns):
+                break
+        ack = None
+        if TX_DS.get(status):
+            result = device.read_dynamic_payload() if RX_DR.get(status) else None
+            if result is not None and len(result[1]) >= _ARQ_ACK_HEADER.size:
+                ack = result[1]
+        else:
+            device.flush_tx_fifo()
+        if ack is None:
+            self.num_failed_polls += 1
+        device.set(REG_STATUS((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+        return ack
+
+    def _process_ack(self, frames, ack):
+        base, = _ARQ_ACK_HEADER.unpack_from(bytes(bytearray(ack[:_ARQ_ACK_HEADER.size])))
+        bitmap = ack[_ARQ_ACK_HEADER.size:]
+        newest_received = None
+        for sequence in list(frames):
+            offset = _get_sequence_offset(sequence, base)
+            received = offset < 0 or (0 < offset <= 8 * len(bitmap) and
+                                      bitmap[(offset - 1) // 8] & (1 << ((offset - 1) % 8)))
+            if received:
+                frame = frames.pop(sequence)
+                if newest_received is None or frame.last_sent > newest_received:
+                    newest_received = frame.last_sent
+        # The ACK payload was loaded after the receiver got the frames before the previous poll
+        for frame in frames.values():
+            if frame.last_sent is None:
+                continue
+            if (newest_received is not None and frame.last_sent < newest_received or
+                    frame.last_sent_poll < self.num_polls - 1):
+                frame.last_sent = None
+
+    def get_stats(self):
+        "Return a dict with the number of frames, retransmissions, polls and failed polls."
+        return {"frames": self.num_frames,
+                "retransmissions": self.num_retransmissions,
+                "polls": self.num_polls,
+                "failed_polls": self.num_failed_polls}
+
+
+class NRF24ArqReceiver(object):
+    """Receives data sent by NRF24ArqSender, see that class. Call update() as often as possible,
+    it reads the received frames and loads the ACK payload which tells the sender what is missing.
+    Example:
+        receiver = NRF24ArqReceiver(device)
+        receiver.begin()
+        while True:
+            receiver.update()
+            data = receiver.receive()
+    """
+
+    def __init__(self, device, window=64):
+        assert 1 < window <= ARQ_MAX_WINDOW, "window must be 2-%d" % ARQ_MAX_WINDOW
+        self._device = device
+        self._window = window
+        self._bitmap_size = (window - 1 + 7) // 8
+        self._next_sequence = 0
+        self._pending = {}  # sequence -> data, received out of order
+        self._output = collections.deque()
+        self._ack_dirty = True
+        self.num_frames = 0
+        self.num_duplicates = 0
+        self.num_polls = 0
+
+    def begin(self):
+        """Enable dynamic payloads, ACK payloads and no ACK packets and auto ACK on pipe 0, and put
+        the device in RX mode with CE high. Other settings are left as they are."""
+        device = self._device
+        device.chip_enable_low()
+        _enable_arq_features(device)
+        device.set(PRIM_RX(1), PWR_UP(1))
+        device.flush_rx_fifo()
+        device.flush_tx_fifo()
+        device.set(REG_STATUS((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+        self._load_ack_payload()
+        device.pulse_chip_enable()
+        device.chip_enable_high()
+
+    def update(self):
+        "Read the received frames and update the ACK payload. Return the number of frames read."
+        device = self._device
+        num_read = 0
+        status = device.get_status()
+        flags = status & ((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT))
+        if flags:
+            # Clear RX_DR and TX_DS before reading, so that a frame which arrives meanwhile sets
+            # them and IRQ again
+            status = device.set(REG_STATUS(flags))
+        while RX_P_NO.get(status) <= 5:
+            result = device.read_dynamic_payload()
+            status = device.get_status()
+            if result is None or len(result[1]) < _ARQ_HEADER.size:
+                continue
+            num_read += 1
+            self._add_frame(result[1])
+        if self._ack_dirty:
+            self._load_ack_payload()
+        return num_read
+
+    def _add_frame(self, frame):
+        flags, sequence = _ARQ_HEADER.unpack_from(bytes(bytearray(frame[:_ARQ_HEADER.size])))
+        if flags & _ARQ_POLL:
+            # The poll took the ACK payload, load a new one
+            self.num_polls += 1
+            self._ack_dirty = True
+            return
+        offset = _get_sequence_offset(sequence, self._next_sequence)
+        if offset < 0 or offset >= self._window or sequence in self._pending:
+            self.num_duplicates += 1
+            return
+        self.num_frames += 1
+        self._ack_dirty = True
+        self._pending[sequence] = frame[_ARQ_HEADER.size:]
+        while self._next_sequence in self._pending:
+            self._output.append(self._pending.pop(self._next_sequence))
+            self._next_sequence = (self._next_sequence + 1) & 0xFFFF
+
+    def _load_ack_payload(self):
+        bitmap = [0] * self._bitmap_size
+        for sequence in self._pending:
+            offset = _get_sequence_offset(sequence, self._next_sequence) - 1
+            bitmap[offset // 8] |= 1 << (offset % 8)
+        # Replace the ACK payload which hasn't been sent yet, if any
+        self._device.flush_tx_fifo()
+        self._device.write_ack_payload(0, list(bytearray(_ARQ_ACK_HEADER.pack(self._next_sequence))) + bitmap)
+        self._ack_dirty = False
+
+    def receive(self):
+        "Return the data of the next frame in order, or None."
+        try:
+            return self._output.popleft()
+        except IndexError:
+            return None
+
+
+class NRF24TimeoutException(Exception):
+    """Raised by NRF24Future.result() if the result isn't ready within the timeout."""
+    pass
+
+
+class NRF24StoppedException(Exception):
+    """Raised by NRF24Future.result() for requests made to an NRF24ThreadSafeDevice after stop()."""
+    pass
+
+
+class NRF24Future(object):
+    """The result of a request to NRF24ThreadSafeDevice, which is set by its owner thread when
+    the request has been carried out."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        "Return True if the request has been carried out (or failed)."
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        "Wait at most timeout seconds for the request to be carried out. Return done()."
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the request and return what the NRF24Device method returned, or raise the
+        exception it raised. Raises NRF24TimeoutException after timeout seconds."""
+        if not self._event.wait(timeout):
+            raise NRF24TimeoutException("Request not carried out within %r s" % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+
+_REQUEST_CALL = 0       # Call a function with the device, args
+_REQUEST_STATUS = 1     # get_status(), args is max_age
+_REQUEST_PAYLOAD = 2    # W_TX_PAYLOAD, W_TX_PAYLOAD_NOACK or W_ACK_PAYLOAD, args is the transfer
+
+# Only three payloads fit in the TX FIFO, so there is no point in writing more in one batch.
+_MAX_PAYLOAD_BATCH = 3
+
+
+class _DeviceRequest(object):
+    __slots__ = ("kind", "function", "args", "future")
+
+    def __init__(self, kind, function, args):
+        self.kind = kind
+        self.function = function
+        self.args = args
+        self.future = NRF24Future()
+
+
+def _is_irq_active(device):
+    "True if a flag in STATUS is set which isn't masked in CONFIG, i.e. the IRQ pin is low."
+    config, status = device.get(REG_CONFIG, REG_STATUS)
+    # The MASK_* bits in CONFIG are in the same positions as the flags in STATUS
+    return bool(status & ~config & ((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+
+
+class NRF24ThreadSafeDevice(object):
+    """Lets several threads use one NRF24Device. Requests are put in a queue (a deque, which
+    threads can append to without locking) and carried out by an owner thread, the only one
+    using the device, so a thread never waits for another thread's SPI transfers. Every method
+    returns an NRF24Future. Requests queued at the same time are combined where possible:
+    get_status() requests in a row share one STATUS read, and payload writes in a row are done
+    in one call to xfer2_batch() if the spi object has it.
+    All NRF24Device methods except the wait_for_irq*() ones can be called, e.g. set(), get() or
+    read_dynamic_payload(), and call() runs a function of your own with the device, for things
+    that must happen together. wait_for_irq_low() waits on the calling thread.
+    Example:
+        shared = NRF24ThreadSafeDevice(device)
+        shared.start()
+        status = shared.write_tx_payload(payload).result()  # On any thread
+        shared.pulse_chip_enable()
+        rx_dr = shared.get(RX_DR).result()
+        shared.stop()
+    """
+
+    def __init__(self, device):
+        self._device = device
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._use_batch = hasattr(device._spi, "xfer2_batch")
+        self._irq_condition = threading.Condition()
+        self._num_irq_edges = 0
+        self._irq_callback_set = False
+        self.num_requests = 0
+        self.num_status_reads = 0       # STATUS reads done for get_status() requests
+        self.num_payload_batches = 0    # Calls to xfer2_batch() with more than one payload
+
+    def start(self):
+        "Start the owner thread. The device must not be used directly until stop()."
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Carry out the requests already queued, then stop the owner thread and wait for it.
+        Requests made after this fail with NRF24StoppedException. Does nothing if not started."""
+        if self._thread is None:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._fail_queued()
+
+    def _submit(self, kind, function, args):
+        request = _DeviceRequest(kind, function, args)
+        if self._stopped:
+            request.future._set_exception(NRF24StoppedException("%s is stopped" % type(self).__name__))
+            return request.future
+        self._queue.append(request)
+        self._wakeup.set()
+        if self._stopped and self._thread is None:
+            # stop() finished after the check above, so nobody will carry it out
+            self._fail_queued()
+        return request.future
+
+    def _fail_queued(self):
+        while True:
+            try:
+                request = self._queue.popleft()
+            except IndexError:
+                return
+            request.future._set_exception(NRF24StoppedException("%s is stopped" % type(self).__name__))
+
+    def call(self, function, *args):
+        """Call function(device, *args) on the owner thread, with nothing else done in between.
+        Example:
+            def send(device, payload):
+                device.write_tx_payload(payload)
+                device.pulse_chip_enable()
+            shared.call(send, payload).result()
+        """
+        return self._submit(_REQUEST_CALL, function, args)
+
+    def get_status(self, max_age=None):
+        "Read STATUS, see NRF24Device.get_status()."
+        return self._submit(_REQUEST_STATUS, None, max_age)
+
+    def _write_payload(self, command, data):
+        assert 1 <= len(data) <= 32, "Invalid length of payload %r" % (data,)
+        return self._submit(_REQUEST_PAYLOAD, None, [command] + _to_bytes(data))
+
+    def write_tx_payload(self, data):
+        "Write TX payload, 1 to 32 bytes. The result is STATUS."
+        return self._write_payload(0b10100000, data)
+
+    def write_tx_payload_no_ack(self, data):
+        "Write TX payload without AUTOACK. The result is STATUS."
+        return self._write_payload(0b10110000, data)
+
+    def write_ack_payload(self, pipe, data):
+        "Write the payload of the next ACK in pipe. The result is STATUS."
+        assert 0 <= pipe <= 5, "Invalid pipe %r" % pipe
+        return self._write_payload(0b10101000 | pipe, data)
+
+    def __getattr__(self, name):
+        method = getattr(self._device, name)
+        assert not name.startswith("_") and callable(method), "%s can't be used through %s" % (
+                name, type(self).__name__)
+        assert not name.startswith("wait_for_irq") and name != "cancel_wait_for_irq", (
+                "Use %s.wait_for_irq_low()" % type(self).__name__)
+
+        def submit(*args, **kwargs):
+            return self._submit(_REQUEST_CALL, lambda device: method(*args, **kwargs), ())
+        submit.__doc__ = method.__doc__
+        return submit
+
+    def wait_for_irq_low(self, timeout=None):
+        """Wait on the calling thread until the IRQ pin is low, i.e. an unmasked flag is set in
+        STATUS, or until timeout seconds have passed. Return True if the IRQ pin is low.
+        The gpio object must have set_falling_edge_irq()."""
+        end = None if timeout is None else time.time() + timeout
+        if not self._irq_callback_set:
+            self.call(self._set_irq_callback).result()
+        while True:
+            with self._irq_condition:
+                num_irq_edges = self._num_irq_edges
+            if self.call(_is_irq_active).result():
+                return True
+            with self._irq_condition:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                # An edge after the check above wakes us up at once
+                if self._num_irq_edges == num_irq_edges:
+                    self._irq_condition.wait(remaining)
+
+    def _set_irq_callback(self, device):
+        if not self._irq_callback_set:
+            device._gpio.set_falling_edge_irq(self._on_falling_edge_irq)
+            self._irq_callback_set = True
+
+    def _on_falling_edge_irq(self):
+        self._device.note_irq_edge()
+        with self._irq_condition:
+            self._num_irq_edges += 1
+            self._irq_condition.notify_all()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # The stop flag is read before emptying the queue, so requests queued before stop()
+            # are carried out.
+            stopped = self._stopped
+            requests = []
+            while self._queue:
+                requests.append(self._queue.popleft())
+            self.num_requests += len(requests)
+            index = 0
+            while index < len(requests):
+                index = self._carry_out(requests, index)
+            if stopped:
+                break
+        if self._irq_callback_set:
+            self._device._gpio.remove_falling_edge_irq()
+            self._irq_callback_set = False
+
+    def _carry_out(self, requests, index):
+        "Carry out requests[index] and the following ones that can be combined with it. Return the next index."
+        device = self._device
+        kind = requests[index].kind
+        end = index + 1
+        if kind == _REQUEST_STATUS:
+            while end < len(requests) and requests[end].kind == _REQUEST_STATUS:
+                end += 1
+        elif kind == _REQUEST_PAYLOAD and self._use_batch:
+            while (end < len(requests) and end - index < _MAX_PAYLOAD_BATCH and
+                    requests[end].kind == _REQUEST_PAYLOAD):
+                end += 1
+        group = requests[index:end]
+
+        try:
+            if kind == _REQUEST_STATUS:
+                max_ages = [request.args for request in group]
+                last_status_ns = device.last_status_ns
+                status = device.get_status(None if None in max_ages else min(max_ages))
+                if device.last_status_ns != last_status_ns:
+                    self.num_status_reads += 1
+                results = [status] * len(group)
+            elif kind == _REQUEST_PAYLOAD:
+                if len(group) > 1:
+                    responses = device._xfer2_batch([request.args for request in group])
+                    self.num_payload_batches += 1
+                else:
+                    responses = [device._xfer2(group[0].args)]
+                results = [response[0] for response in responses]
+            else:
+                request = group[0]
+                results = [request.function(device, *request.args)]
+        except Exception as e:
+            for request in group:
+                request.future._set_exception(e)
+        else:
+            for request, result in zip(group, results):
+                request.future._set_result(result)
+        return end
+
+
+# Packets of NRF24TimeSyncClient/NRF24TimeSyncServer: kind, sequence number and two NRF24Timer
+# times in nanoseconds (unused in beacons).
+_SYNC_PACKET = struct.Struct("<BBqq")
+_SYNC_BEACON = 1
+_SYNC_REPLY = 2
+
+
+def _get_sync_delay_ns(device, link_config):
+    """Time from CE going high to send a sync packet until the IRQ edge when it has been received:
+    Tstby2a, the time on air and the IRQ delay."""
+    if link_config is None:
+        link_config = NRF24LinkConfig.from_device(device, payload_size=_SYNC_PACKET.size)
+    return int((T_STBY2A + link_config.get_time_on_air() + _T_IRQ[link_config.data_rate]) * 1e9)
+
+
+def _begin_sync(device):
+    "Enable dynamic payloads and no ACK packets, and put the device in RX mode with CE high."
+    device.chip_enable_low()
+    device.set(EN_DPL(1) | EN_DYN_ACK(1))
+    device.set(DPL_P0(1), ERX_P0(1))
+    device.set(PRIM_RX(1), PWR_UP(1))
+    device.flush_rx_fifo()
+    device.flush_tx_fifo()
+    device.set(REG_STATUS((1 << RX_DR.START_BIT) | (1 << TX_DS.START_BIT) | (1 << MAX_RT.START_BIT)))
+    device.wait_for_mode_transition()
+    device.chip_enable_high()
+
+
+def _send_sync_packet(device, payload, start_ns=None):
+    """Send payload (without ACK) with CE going high at start_ns (or now) and go back to RX mode.
+    Return the time CE went high, or None if start_ns had already passed."""
+    timer = device._timer
+    device.chip_enable_low()
+    device.set(PRIM_RX(0))
+    device.write_tx_payload_no_ack(list(bytearray(payload)))
+    if start_ns is not None:
+        if timer.now_ns() > start_ns:
+            device.flush_tx_fifo()
+            device.set(PRIM_RX(1))
+            device.chip_enable_high()
+            return None
+        timer.sleep_until(start_ns)
+    sent_ns = timer.now_ns()
+    device.pulse_chip_enable()
+    deadline = timer.deadline(T_TX_MAX)
+    while not TX_DS.get(device.get_status()) and timer.now_ns() < deadline:
+        pass
+    device.set(REG_STATUS(1 << TX_DS.START_BIT), PRIM_RX(1))
+    device.chip_enable_high()
+    return sent_ns
+
+
+def _receive_sync_packet(device, kind, timeout):
+    """Wait at most timeout seconds for a sync packet of the given kind. Return (time of the IRQ
+    edge, sequence, time a, time b), or None."""
+    end = time.time() + timeout
+    last_irq_ns = device.last_irq_ns
+    while True:
+        if not RX_DR.get(device.get_status()):
+            remaining = end - time.time()
+            if remaining <= 0:
+                return None
+            device.wait_for_irq_low(remaining)
+            continue
+        # If there was no new edge (RX_DR was already set) the best we have is now
+        irq_ns = device.last_irq_ns if device.last_irq_ns != last_irq_ns else device._timer.now_ns()
+        device.set(REG_STATUS(1 << RX_DR.START_BIT))
+        while True:
+            result = device.read_dynamic_payload()
+            if result is None:
+                break
+            payload = bytes(bytearray(result[1]))
+            if len(payload) == _SYNC_PACKET.size:
+                packet_kind, sequence, time_a, time_b = _SYNC_PACKET.unpack(payload)
+                if packet_kind == kind:
+                    return irq_ns, sequence, time_a, time_b
+        last_irq_ns = device.last_irq_ns
+
+
+class NRF24TimeSyncServer(object):
+    """The node which has the reference time, see NRF24TimeSyncClient. Call update() in a loop,
+    it answers each beacon with the time of the IRQ edge when the beacon was received and the
+    time the reply is sent (reply_delay seconds after reading the beacon, to give the client time
+    to get to RX mode).
+    Both nodes must have the same address in RX_ADDR_P0 and TX_ADDR, and need the IRQ pin.
+    Example:
+        server = NRF24TimeSyncServer(device)
+        server.begin()
+        while True:
+            server.update()
+    """
+
+    def __init__(self, device, link_config=None, reply_delay=1e-3):
+        """link_config is an NRF24LinkConfig of the link, read from the device if None."""
+        self._device = device
+        self._link_config = link_config
+        self._reply_delay_ns = int(reply_delay * 1e9)
+        self.num_beacons = 0
+        self.num_late = 0  # Beacons not answered because the reply couldn't be sent in time
+
+    def begin(self):
+        """Enable dynamic payloads and no ACK packets on pipe 0 and put the device in RX mode with
+        CE high. Other settings are left as they are."""
+        _begin_sync(self._device)
+
+    def update(self, timeout=0.1):
+        "Wait at most timeout seconds for a beacon and answer it. Return True if one was answered."
+        beacon = _receive_sync_packet(self._device, _SYNC_BEACON, timeout)
+        if beacon is None:
+            return False
+        received_ns, sequence = beacon[:2]
+        self.num_beacons += 1
+        # Only the IRQ edge needs to be on time, the reply can be sent any time after it
+        reply_ns = self._device._timer.now_ns() + self._reply_delay_ns
+        reply = _SYNC_PACKET.pack(_SYNC_REPLY, sequence, received_ns, reply_ns)
+        if _send_sync_packet(self._device, reply, reply_ns) is None:
+            self.num_late += 1
+            return False
+        return True
+
+
+class NRF24TimeSyncClient(object):
+    """Keeps a clock in sync with the one of an NRF24TimeSyncServer. Each call to sync() sends a
+    beacon and waits for the reply, which gives four times: t1 when the beacon was sent (CE high),
+    t2 the server's IRQ edge when it was received, t3 when the reply was sent and t4 the IRQ edge
+    here. With d the time from CE high to IRQ edge (settling time, time on air and IRQ delay,
+    computed from the link configuration), the offset of the server's clock is
+    ((t2 - t1 - d) + (t3 + d - t4)) / 2, and the round trip time left over,
+    (t4 - t1) - (t3 - t2) - 2 d, is how much other delays (e.g. a thread which was slow to
+    notice the IRQ) disturbed the measurement.
+    Of the last window samples, the half with the smallest leftover round trip time are used,
+    and a line fitted to their offsets gives the offset and the drift (in seconds per second).
+    Example:
+        client = NRF24TimeSyncClient(device)
+        client.begin()
+        while True:
+            client.sync()
+            now = client.get_time_ns()  # The server's time
+            time.sleep(1)
+    """
+
+    def __init__(self, device, link_config=None, window=16, reply_timeout=0.01):
+        """link_config is an NRF24LinkConfig of the link, read from the device if None."""
+        assert window >= 1
+        self._device = device
+        self._link_config = link_config
+        self._reply_timeout = reply_timeout
+        self._samples = collections.deque(maxlen=window)  # (local time, offset, leftover round trip)
+        self._sequence = 0
+        self._delay_ns = None
+        self._reference_ns = None   # Local time where the fitted line has offset _offset_ns
+        self._offset_ns = 0.0
+        self.drift = 0.0
+        self.num_syncs = 0
+        self.num_timeouts = 0
+        self.num_outliers = 0   # Samples which weren't among the ones used when they were added
+
+    def begin(self):
+        """Enable dynamic payloads and no ACK packets on pipe 0 and put the device in RX mode with
+        CE high. Other settings are left as they are."""
+        _begin_sync(self._device)
+        self._delay_ns = _get_sync_delay_ns(self._device, self._link_config)
+
+    def sync(self):
+        "Do one exchange with the server. Return False if there was no reply."
+        device = self._device
+        self._sequence = (self._sequence + 1) & 0xFF
+        t1 = _send_sync_packet(device, _SYNC_PACKET.pack(_SYNC_BEACON, self._sequence, 0, 0))
+        while True:
+            reply = _receive_sync_packet(device, _SYNC_REPLY, self._reply_timeout)
+            if reply is None:
+                self.num_timeouts += 1
+                return False
+            t4, sequence, t2, t3 = reply
+            if sequence == self._sequence:
+                break
+        self.add_sample(t1, t2, t3, t4)
+        self.num_syncs += 1
+        return True
+
+    def add_sample(self, t1, t2, t3, t4):
+        """Add the four times of one exchange (see the class) and update the offset and drift.
+        sync() calls this, you only need it if you do the exchange some other way."""
+        delay_ns = self._delay_ns or 0
+        offset = ((t2 - t1 - delay_ns) + (t3 + delay_ns - t4)) / 2.0
+        leftover = (t4 - t1) - (t3 - t2) - 2 * delay_ns
+        sample = ((t1 + t4) // 2, offset, leftover)
+        self._samples.append(sample)
+
+        used = sorted(self._samples, key=lambda s: s[2])[:(len(self._samples) + 1) // 2]
+        if sample not in used:
+            self.num_outliers += 1
+        reference_ns = sum(s[0] for s in used) // len(used)
+        mean_offset = sum(s[1] for s in used) / len(used)
+        variance = sum((s[0] - reference_ns) ** 2 for s in used)
+        if variance > 0:
+            self.drift = sum((s[0] - reference_ns) * (s[1] - mean_offset) for s in used) / float(variance)
+        self._reference_ns = reference_ns
+        self._offset_ns = mean_offset
+
+    def is_synchronized(self):
+        "Return True once there has been a reply from the server."
+        return self._reference_ns is not None
+
+    def get_offset_ns(self, local_ns=None):
+        """The server's time minus ours at local_ns (an NRF24Timer time, now if None), in
+        nanoseconds."""
+        assert self.is_synchronized(), "No reply from the server yet"
+        if local_ns is None:
+            local_ns = self._device._timer.now_ns()
+        return int(round(self._offset_ns + self.drift * (local_ns - self._reference_ns)))
+
+    def get_time_ns(self, local_ns=None):
+        "The server's NRF24Timer time at local_ns (now if None)."
+        if local_ns is None:
+            local_ns = self._device._timer.now_ns()
+        return local_ns + self.get_offset_ns(local_ns)
+
+    def get_local_time_ns(self, server_ns):
+        "Our NRF24Timer time when the server's is server_ns, e.g. to send at a time slot."
+        assert self.is_synchronized(), "No reply from the server yet"
+        # The offset hardly changes between our time and the server's
+        return server_ns - self.get_offset_ns(server_ns - int(round(self._offset_ns)))
+
+    def get_stats(self):
+        """Return a dict with the current offset and drift, and the leftover round trip time
+        (see the class) of the last sample, all times in nanoseconds."""
+        return {"offset_ns": self.get_offset_ns() if self.is_synchronized() else None,
+                "drift_ppm": self.drift * 1e6,
+                "last_leftover_ns": self._samples[-1][2] if self._samples else None,
+                "syncs": self.num_syncs,
+                "timeouts": self.num_timeouts,
+                "outliers": self.num_outliers}
+
+
+def get_hop_sequence(seed, channels):
+    """Return the channels in the hopping order for seed. It's a Fisher-Yates shuffle driven by a
+    32 bit xorshift generator, so it's the same on all Python versions and simple to do the same
+    way on a microcontroller."""
+    sequence = sorted(channels)
+    state = (seed ^ 0x9E3779B9) & 0xFFFFFFFF or 1
+    for i in range(len(sequence) - 1, 0, -1):
+        state ^= (state << 13) & 0xFFFFFFFF
+        state ^= state >> 17
+        state ^= (state << 5) & 0xFFFFFFFF
+        j = state % (i + 1)
+        sequence[i], sequence[j] = sequence[j], sequence[i]
+    return sequence
+
+
+class NRF24FrequencyHopper(object):
+    """Makes paired radios hop between channels together, to get away from interference such as
+    Wi-Fi. Time is divided in slots of dwell_time seconds counted from epoch_ns, and the channel
+    of each slot comes from a random order of channels, get_hop_sequence(seed, channels).
+    clock must return the same time in nanoseconds on all radios, e.g. the get_time_ns() of an
+    NRF24TimeSyncClient (and the NRF24Timer of the server).
+    Call update() often, it writes RF_CH (one SPI transfer, and only if the channel changes)
+    when a new slot starts. With rx True the device is assumed to be in RX mode with CE high, and
+    CE is taken low while changing channel so the chip settles on the new one.
+    Channels with a high loss rate (from record_packet()) or which are often busy (from
+    sample_rpd(), which reads RPD) are blacklisted, and slots on blacklisted channels use one of
+    the other channels instead, like adaptive frequency hopping in Bluetooth. The radios must use
+    the same channel map, so one of them calls update_channel_map(), which returns the new map
+    and the slot where it takes effect, and sends them to the others which call set_channel_map().
+    Blacklisted channels are tried again after blacklist_time seconds. get_channel_quality()
+    returns the statistics of every channel.
+    Example:
+        hopper = NRF24FrequencyHopper(device, seed=1234, clock=sync_client.get_time_ns)
+        while True:
+            hopper.update()
+            hopper.record_packet(send_packet())
+            new_map = hopper.update_channel_map()
+            if new_map is not None:
+                send_to_peer(*new_map)  # Which calls set_channel_map(*new_map)
+    """
+
+    def __init__(self, device, seed, channels=range(2, 82), dwell_time=20e-3, clock=None,
+                 epoch_ns=0, rx=False, smoothing=0.1, loss_threshold=0.3, rpd_threshold=0.5,
+                 min_samples=10, min_channels=15, blacklist_time=30.0, map_delay=16):
+        """channels are the RF_CH values to use. smoothing is the weight of a new sample in the
+        moving averages of loss and RPD. A channel is blacklisted when its loss rate is above
+        loss_threshold or RPD is set more often than rpd_threshold, after at least min_samples
+        samples, but at least min_channels channels are always used. A new channel map takes
+        effect map_delay slots after update_channel_map(), to give time to send it to the others.
+        """
+        self._channels = sorted(set(channels))
+        assert all(0 <= channel <= 125 for channel in self._channels), "Invalid channel"
+        assert 1 <= min_channels <= len(self._channels)
+        self._device = device
+        self._clock = clock if clock is not None else device._timer.now_ns
+        self._dwell_time_ns = int(dwell_time * 1e9)
+        self._epoch_ns = epoch_ns
+        self._rx = rx
+        self._smoothing = smoothing
+        self._loss_threshold = loss_threshold
+        self._rpd_threshold = rpd_threshold
+        self._min_samples = min_samples
+        self._min_channels = min_channels
+        self._blacklist_time_ns = int(blacklist_time * 1e9)
+        self._map_delay = map_delay
+
+        self._sequence = get_hop_sequence(seed, self._channels)
+        self._channel_map = sum(1 << channel for channel in self._channels)
+        self._used_channels = self._channels
+        self._pending_map = None    # (channel map, slot)
+        self._blacklisted_ns = {}   # channel -> clock time when it was blacklisted
+        self._loss_rates = dict((channel, 0.0) for channel in self._channels)
+        self._rpd_rates = dict((channel, 0.0) for channel in self._channels)
+        self._num_packets = dict((channel, 0) for channel in self._channels)
+        self._num_rpd_samples = dict((channel, 0) for channel in self._channels)
+        self._slot = None
+        self.channel = None
+        self.num_hops = 0
+
+    def get_slot(self, time_ns=None):
+        "The slot at time_ns (from clock, now if None)."
+        if time_ns is None:
+            time_ns = self._clock()
+        return (time_ns - self._epoch_ns) // self._dwell_time_ns
+
+    def get_time_to_next_slot(self):
+        "Seconds until the next slot starts."
+        time_ns = self._clock() - self._epoch_ns
+        return (self._dwell_time_ns - time_ns % self._dwell_time_ns) / 1e9
+
+    def get_channel(self, slot):
+        "The channel of slot with the channel map in use now."
+        channel = self._sequence[slot % len(self._sequence)]
+        if self._channel_map & (1 << channel):
+            return channel
+        return self._used_channels[slot % len(self._used_channels)]
+
+    def update(self):
+        "Change channel if a new slot has started. Return True if RF_CH was written."
+        slot = self.get_slot()
+        if slot == self._slot:
+            return False
+        self._slot = slot
+        if self._pending_map is not None and slot >= self._pending_map[1]:
+            self._use_channel_map(self._pending_map[0])
+            self._pending_map = None
+        channel = self.get_channel(slot)
+        if channel == self.channel:
+            return False
+
+        device = self._device
+        if self._rx:
+            device.chip_enable_low()
+        # The whole register, which doesn't need reading first like the RF_CH field does
+        device.set(REG_RF_CH(channel))
+        if self._rx:
+            device.chip_enable_high()
+        self.channel = channel
+        self.num_hops += 1
+        return True
+
+    def record_packet(self, ok):
+        "Record whether a packet sent or expected on the current channel got through."
+        channel = self.channel
+        if channel is None:
+            return
+        self._loss_rates[channel] += self._smoothing * ((0.0 if ok else 1.0) - self._loss_rates[channel])
+        self._num_packets[channel] += 1
+
+    def sample_rpd(self):
+        """Read RPD, which is set if there was a signal above -64 dBm on the channel, and record it.
+        Call it in RX mode when no packet is expected, to measure interference. Return RPD."""
+        channel = self.channel
+        rpd = self._device.get(RPD)
+        if channel is not None:
+            self._rpd_rates[channel] += self._smoothing * (rpd - self._rpd_rates[channel])
+            self._num_rpd_samples[channel] += 1
+        return rpd
+
+    def _is_bad(self, channel):
+        return (self._num_packets[channel] >= self._min_samples and
+                self._loss_rates[channel] > self._loss_threshold or
+                self._num_rpd_samples[channel] >= self._min_samples and
+                self._rpd_rates[channel] > self._rpd_threshold)
+
+    def _reset_channel(self, channel):
+        self._loss_rates[channel] = 0.0
+        self._rpd_rates[channel] = 0.0
+        self._num_packets[channel] = 0
+        self._num_rpd_samples[channel] = 0
+
+    def update_channel_map(self):
+        """Blacklist channels which have become bad and give blacklisted channels another chance
+        after blacklist_time. Return None if the channel map is the same, otherwise (channel map,
+        slot) for set_channel_map() on the other radios. It's already set on this one."""
+        if self._pending_map is not None:
+            return None
+        now_ns = self._clock()
+        bad = set()
+        for channel in self._channels:
+            blacklisted_ns = self._blacklisted_ns.get(channel)
+            if blacklisted_ns is not None and now_ns - blacklisted_ns < self._blacklist_time_ns:
+                bad.add(channel)
+            elif blacklisted_ns is not None:
+                del self._blacklisted_ns[channel]
+                self._reset_channel(channel)
+            elif self._is_bad(channel):
+                bad.add(channel)
+        # Keep the least bad ones if too many are bad
+        num_missing = self._min_channels - (len(self._channels) - len(bad))
+        if num_missing > 0:
+            for channel in sorted(bad, key=lambda c: self._loss_rates[c] + self._rpd_rates[c])[:num_missing]:
+                bad.discard(channel)
+                self._blacklisted_ns.pop(channel, None)
+                self._reset_channel(channel)
+
+        channel_map = sum(1 << channel for channel in self._channels if channel not in bad)
+        if channel_map == self._channel_map:
+            return None
+        for channel in bad:
+            self._blacklisted_ns.setdefault(channel, now_ns)
+        slot = self.get_slot(now_ns) + self._map_delay
+        self.set_channel_map(channel_map, slot)
+        return channel_map, slot
+
+    def set_channel_map(self, channel_map, slot):
+        """Use channel_map (an int with bit n set if channel n may be used) from slot on, e.g. as
+        returned by update_channel_map() on another radio."""
+        assert channel_map & sum(1 << channel for channel in self._channels) == channel_map, "Unknown channels"
+        assert channel_map, "No channels"
+        self._pending_map = (channel_map, slot)
+
+    def _use_channel_map(self, channel_map):
+        self._channel_map = channel_map
+        self._used_channels = [channel for channel in self._channels if channel_map & (1 << channel)]
+
+    def get_channel_map(self):
+        "The channel map in use, an int with bit n set if channel n may be used."
+        return self._channel_map
+
+    def get_channel_quality(self):
+        """Return a dict with a dict for each channel, with the moving averages of the loss rate
+        and of RPD, the number of samples of each and whether the channel is blacklisted."""
+        return dict((channel, {"loss_rate": self._loss_rates[channel],
+                               "rpd_rate": self._rpd_rates[channel],
+                               "packets": self._num_packets[channel],
+                               "rpd_samples": self._num_rpd_samples[channel],
+                               "blacklisted": not self._channel_map & (1 << channel)})
+                    for channel in self._channels)
+
+
+# Field kinds of NRF24PayloadSchema: struct code -> numpy type (little endian)
+_SCHEMA_NUMPY_TYPES = {"?": "?", "b": "i1", "B": "u1", "h": "<i2", "H": "<u2", "i": "<i4", "I": "<u4",
+                       "q": "<i8", "Q": "<u8", "e": "<f2", "f": "<f4", "d": "<f8"}
+# Bit fields in a row are stored in the smallest of these which they fit in: (bits, struct code)
+_SCHEMA_BIT_GROUP_CODES = ((8, "B"), (16, "H"), (32, "I"), (64, "Q"))
+
+
+class NRF24PayloadSchema(object):
+    """Describes the layout of a binary message and encodes and decodes it. fields is a list of
+    (name, kind), where kind is a struct format character (one of ?bBhHiIqQefd, little endian
+    without padding), "Ns" for N bytes, "Nx" for N bytes of padding or an int, the number of bits
+    of an unsigned bit field. Bit fields in a row are packed from the least significant bit into
+    the smallest of 1, 2, 4 or 8 bytes they fit in, and a bit field named None is padding. The
+    message is padded with zeros to size bytes if size is given.
+    The encoders and the decoder are compiled to Python functions doing one struct call each.
+    encode() returns a bytearray for write_tx_payload(), encode_into() writes into a buffer of
+    your own and decode() returns a namedtuple (the class is in record). decode_batch() decodes
+    many payloads into a numpy structured array at once (requires numpy).
+    Example:
+        schema = NRF24PayloadSchema("Reading", [("sensor", 5), ("alarm", 1), (None, 2),
+                                                ("time_ms", "I"), ("temperature", "h")])
+        device.write_tx_payload(schema.encode(3, 0, time_ms=123456, temperature=-40))
+        reading = schema.decode(payload)    # Reading(sensor=3, alarm=0, time_ms=123456, ...)
+        readings = schema.decode_batch(payloads)
+        readings["temperature"].mean()
+    """
+
+    def __init__(self, name, fields, size=None):
+        self.names = [field_name for field_name, kind in fields
+                      if field_name is not None and not (isinstance(kind, str) and kind.endswith("x"))]
+        # Checks that the names are valid and can't clash with the names used in _compile()
+        self.record = collections.namedtuple(name, self.names)
+        self._codes = []        # struct format of each part of the message
+        self._offsets = []      # byte offset of each part
+        self._fields = []       # (name, index of part, bit offset or None, bits or None)
+        group = None            # [index of part, bits used] of the bit group being filled
+        offset = 0
+        for field_name, kind in fields:
+            if isinstance(kind, _INTEGER_TYPES):
+                assert 1 <= kind <= 64, "Invalid number of bits %r for %s" % (kind, field_name)
+                if group is None or group[1] + kind > 64:
+                    group = [len(self._codes), 0]
+                    self._codes.append(None)
+                    self._offsets.append(offset)
+                if field_name is not None:
+                    self._fields.append((field_name, group[0], group[1], kind))
+                group[1] += kind
+                bits, code = [(bits, code) for bits, code in _SCHEMA_BIT_GROUP_CODES if bits >= group[1]][0]
+                self._codes[group[0]] = code
+                offset = self._offsets[group[0]] + bits // 8
+                continue
+
+            group = None
+            assert isinstance(kind, str) and kind[-1] in "sx" + "".join(_SCHEMA_NUMPY_TYPES), (
+                    "Invalid kind %r for %s" % (kind, field_name))
+            assert len(kind) == 1 or kind[-1] in "sx" and kind[:-1].isdigit(), (
+                    "Use one field per value, not %r" % kind)
+            if not kind.endswith("x"):
+                assert field_name is not None, "Only padding may be unnamed, not %r" % kind
+                self._fields.append((field_name, len(self._codes), None, None))
+            self._codes.append(kind)
+            self._offsets.append(offset)
+            offset += struct.calcsize("<" + kind)
+
+        if size is not None:
+            assert size >= offset, "The fields need %d bytes, more than size %d" % (offset, size)
+            if size > offset:
+                self._codes.append("%dx" % (size - offset))
+                self._offsets.append(offset)
+            offset = size
+        self.size = offset
+        self._struct = struct.Struct("<" + "".join(self._codes))
+        self._compile()
+
+    def _compile(self):
+        # Field names are used as argument names and the other names start with _, which
+        # namedtuple doesn't allow in field names.
+        parts = [[] for code in self._codes]
+        checks = []
+        decoded = []
+        for name, index, bit_offset, bits in self._fields:
+            if bit_offset is None:
+                parts[index].append(name)
+                decoded.append("_%d" % index)
+            else:
+                mask = (1 << bits) - 1
+                checks.append("    assert 0 <= %s <= %d, '%s must be 0-%d, not %%r' %% (%s,)" % (
+                        name, mask, name, mask, name))
+                parts[index].append("%s << %d" % (name, bit_offset) if bit_offset else name)
+                decoded.append("_%d >> %d & %d" % (index, bit_offset, mask) if bit_offset else
+                               "_%d & %d" % (index, mask))
+        # A bit group with only padding is written as 0
+        values = ", ".join(" | ".join(part) or "0"
+                           for part, code in zip(parts, self._codes) if not code.endswith("x"))
+        unpacked = "".join("_%d, " % index for index, code in enumerate(self._codes) if not code.endswith("x"))
+        arguments = ", ".join(self.names)
+        source = "\n".join(
+                ["def encode(%s):" % arguments] + checks + [
+                 "    _buffer = _bytearray(%d)" % self.size,
+                 "    _pack_into(_buffer, 0, %s)" % values,
+                 "    return _buffer",
+                 "def encode_into(_buffer, _offset, %s):" % arguments] + checks + [
+                 "    _pack_into(_buffer, _offset, %s)" % values,
+                 "def decode(_payload, _offset=0):",
+                 "    if _isinstance(_payload, _list):",
+                 "        _payload = _bytearray(_payload)",
+                 "    %s= _unpack_from(_payload, _offset)" % unpacked,
+                 "    return _record(%s)" % ", ".join(decoded)])
+        namespace = {"_pack_into": self._struct.pack_into, "_unpack_from": self._struct.unpack_from,
+                     "_record": self.record, "_bytearray": bytearray, "_isinstance": isinstance,
+                     "_list": list}
+        exec(source, namespace)
+        self.encode = namespace["encode"]
+        self.encode.__doc__ = "Return a bytearray with the message, given the value of each field."
+        self.encode_into = namespace["encode_into"]
+        self.encode_into.__doc__ = "Write the message into buffer (e.g. a bytearray) at offset."
+        self.decode = namespace["decode"]
+        self.decode.__doc__ = ("Decode the message at offset in payload (bytes, a bytearray or a list) "
+                               "and return a record.")
+
+    def get_dtype(self):
+        "The numpy dtype of the arrays returned by decode_batch(). Requires numpy."
+        numpy = _import_numpy()
+        dtype = []
+        for name, index, bit_offset, bits in self._fields:
+            if bit_offset is None:
+                code = self._codes[index]
+                dtype.append((name, "S%d" % struct.calcsize("<" + code) if code.endswith("s")
+                              else _SCHEMA_NUMPY_TYPES[code]))
+            else:
+                dtype.append((name, [_SCHEMA_NUMPY_TYPES[code] for group_bits, code in _SCHEMA_BIT_GROUP_CODES
+                                     if group_bits >= bits][0]))
+        return numpy.dtype(dtype)
+
+    def decode_batch(self, payloads):
+        """Decode many payloads at once and return a numpy structured array with one element per
+        payload and the fields of the schema. payloads is a 2-D uint8 array with one payload per
+        row, or a sequence of bytes, bytearrays or lists, all at least size long. Requires numpy."""
+        numpy = _import_numpy()
+        if isinstance(payloads, numpy.ndarray):
+            rows = payloads
+        elif len(payloads) and isinstance(payloads[0], (bytes, bytearray)) and all(
+                len(payload) == self.size for payload in payloads):
+            rows = numpy.frombuffer(b"".join(bytes(payload) for payload in payloads), dtype=numpy.uint8)
+        else:
+            rows = numpy.array([bytearray(payload[:self.size]) for payload in payloads], dtype=numpy.uint8)
+        rows = rows.reshape(len(payloads), -1) if len(payloads) else numpy.zeros((0, self.size), numpy.uint8)
+        assert rows.shape[1] >= self.size, "Payloads must be at least %d bytes" % self.size
+        rows = numpy.ascontiguousarray(rows[:, :self.size], dtype=numpy.uint8)
+
+        # View the bytes as the parts of the message, without copying
+        # "s" alone is one byte, but "S" is a zero width numpy type
+        formats = [_SCHEMA_NUMPY_TYPES[code] if code in _SCHEMA_NUMPY_TYPES else "S%d" % struct.calcsize("<" + code)
+                   for code in self._codes if not code.endswith("x")]
+        parts = rows.view(numpy.dtype({
+                "names": ["_%d" % index for index, code in enumerate(self._codes) if not code.endswith("x")],
+                "formats": formats,
+                "offsets": [offset for offset, code in zip(self._offsets, self._codes) if not code.endswith("x")],
+                "itemsize": self.size}))[:, 0]
+
+        result = numpy.empty(len(rows), dtype=self.get_dtype())
+        for name, index, bit_offset, bits in self._fields:
+            part = parts["_%d" % index]
+            if bit_offset is None:
+                result[name] = part
+            else:
+                result[name] = (part >> bit_offset) & ((1 << bits) - 1)
+        return result
+
+
+# Settings of "python -m nrf24 send-file/recv-file". Both ends must use the same profile.
+TRANSFER_PROFILES = {
+    # Highest throughput at short range
+    "fast": {"data_rate": 2000*1000, "crc_bytes": 1, "ard": 250e-6, "arc": 3, "rf_pwr": 3,
+             "channel": 76, "fec_data": 16, "fec_parity": 4},
+    # Slower but more robust
+    "reliable": {"data_rate": 1000*1000, "crc_bytes": 2, "ard": 500e-6, "arc": 15, "rf_pwr": 3,
+                 "channel": 76, "fec_data": 16, "fec_parity": 8},
+    # Best sensitivity
+    "long-range": {"data_rate": 250*1000, "crc_bytes": 2, "ard": 1500e-6, "arc": 15, "rf_pwr": 3,
+                   "channel": 76, "fec_data": 12, "fec_parity": 8},
+}
+TRANSFER_ADDRESS = [0xE7, 0x4E, 0x52, 0x46, 0x31]
+
+# The file is sent after a header with a magic number, the size and the SHA-256 of the file.
+_FILE_HEADER = struct.Struct("<4sQ32s")
+_FILE_MAGIC = b"NRFF"
+
+
+# Valid values of the settings in a transfer profile: (types, test)
+_TRANSFER_SETTING_CHECKS = {
+    "data_rate": (_INTEGER_TYPES, lambda value: value in (250*1000, 1000*1000, 2000*1000)),
+    "crc_bytes": (_INTEGER_TYPES, lambda value: value in (1, 2)),
+    "ard": (_INTEGER_TYPES + (float,), lambda value: 250e-6 <= value <= 4000e-6),
+    "arc": (_INTEGER_TYPES, lambda value: 0 <= value <= 15),
+    "rf_pwr": (_INTEGER_TYPES, lambda value: 0 <= value <= 3),
+    "channel": (_INTEGER_TYPES, lambda value: 0 <= value <= 125),
+    "fec_data": (_INTEGER_TYPES, lambda value: 1 <= value <= 255),
+    "fec_parity": (_INTEGER_TYPES, lambda value: 0 <= value <= 254),
+}
+
+
+def _check_transfer_profile(profile, source):
+    "Raise ValueError if a setting in profile (read from source) is unknown or invalid."
+    unknown = set(profile) - set(_TRANSFER_SETTING_CHECKS)
+    if unknown:
+        raise ValueError("Unknown settings %s in %s" % (", ".join(sorted(unknown)), source))
+    for name, value in sorted(profile.items()):
+        types, test = _TRANSFER_SETTING_CHECKS[name]
+        if isinstance(value, bool) or not isinstance(value, types) or not test(value):
+            raise ValueError("Invalid %s %r in %s" % (name, value, source))
+    if profile["fec_data"] + profile["fec_parity"] > 255:
+        raise ValueError("fec_data + fec_parity must be at most 255 in %s" % source)
+
+
+def get_transfer_profile(name_or_path):
+    """Return the settings of a profile in TRANSFER_PROFILES, or from a JSON file with the same
+    keys (missing ones are taken from "fast"). Raises ValueError if the file isn't valid JSON or
+    has unknown or invalid settings."""
+    profile = dict(TRANSFER_PROFILES["fast"])
+    if name_or_path in TRANSFER_PROFILES:
+        profile.update(TRANSFER_PROFILES[name_or_path])
+    else:
+        import json
+        with open(name_or_path) as f:
+            try:
+                settings = json.load(f)
+            except ValueError as e:
+                raise ValueError("%s is not valid JSON: %s" % (name_or_path, e))
+        if not isinstance(settings, dict):
+            raise ValueError("%s must contain a JSON object" % name_or_path)
+        profile.update(settings)
+    _check_transfer_profile(profile, name_or_path)
+    return profile
+
+
+def configure_for_transfer(device, profile, address=TRANSFER_ADDRESS):
+    "Reset the device and set data rate, CRC, retransmits, power, channel and address from profile."
+    data_rate = profile["data_rate"]
+    assert data_rate in (250*1000, 1000*1000, 2000*1000), "Invalid data rate %r" % data_rate
+    device.reset_to_default()
+    device.set(EN_CRC(1) | CRCO(profile["crc_bytes"] - 1))
+    device.set(RF_DR_LOW(int(data_rate == 250*1000)) | RF_DR_HIGH(int(data_rate == 2000*1000)) |
+               RF_PWR(profile["rf_pwr"]))
+    device.set(ARD(max(0, int(round(profile["ard"] / 250e-6)) - 1)) | ARC(profile["arc"]))
+    device.set(AW(len(address) - 2), RF_CH(profile["channel"]))
+    device.set(REG_RX_ADDR_P0(address), REG_TX_ADDR(address))
+
+
+class _TransferProgress(object):
+    "Prints a status line at most every interval seconds."
+
+    def __init__(self, total_size, out, interval=0.5):
+        self._total_size = total_size
+        self._out = out
+        self._interval = interval
+        self._start = time.time()
+        self._last_print = 0.0
+
+    def update(self, num_bytes, stats, final=False):
+        now = time.time()
+        if self._out is None or not final and now - self._last_print < self._interval:
+            return
+        self._last_print = now
+        elapsed = max(now - self._start, 1e-9)
+        percent = 100.0 * num_bytes / self._total_size if self._total_size else 0.0
+        self._out.write("\r%5.1f%% %9d bytes %8.1f kB/s  %s" % (
+                percent, num_bytes, num_bytes / elapsed / 1000.0,
+                "  ".join("%s %s" % (name, value) for name, value in sorted(stats.items()))))
+        if final:
+            self._out.write("\n")
+        self._out.flush()
+
+
+def send_file(device, data, profile, no_ack=False, repeat=1, timeout=None, out=None):
+    """Send data (the contents of a file) to receive_file() on another device, after
+    configure_for_transfer(). Normally NRF24ArqSender is used. With no_ack, frames are sent
+    without ACK with forward error correction (NRF24FecEncoder), repeat times. Progress and
+    statistics are written to out (e.g. sys.stderr) if it's not None. Return True if it
+    succeeded (with no_ack, if all frames were sent)."""
+    import hashlib
+    data = bytes(data)
+    stream = _FILE_HEADER.pack(_FILE_MAGIC, len(data), hashlib.sha256(data).digest()) + data
+    progress = _TransferProgress(len(stream) * (repeat if no_ack else 1), out)
+    if not no_ack:
+        sender = NRF24ArqSender(device)
+        sender.begin()
+        # Big pieces, since the window is emptied at the end of each send()
+        piece_size = 256 * ARQ_MAX_DATA_SIZE
+        for offset in range(0, len(stream), piece_size):
+            if not sender.send(bytearray(stream[offset:offset + piece_size]), timeout):
+                progress.update(offset, sender.get_stats(), final=True)
+                return False
+            progress.update(min(offset + piece_size, len(stream)), sender.get_stats())
+        progress.update(len(stream), sender.get_stats(), final=True)
+        return True
+
+    encoder = NRF24FecEncoder(profile["fec_data"], profile["fec_parity"])
+    block_size = encoder.get_block_size()
+    assert len(stream) <= 0x10000 * block_size, "Too big to send without ACK, max %d bytes" % (
+            0x10000 * block_size - _FILE_HEADER.size)
+    device.chip_enable_low()
+    _enable_arq_features(device)
+    device.set(PRIM_RX(0), PWR_UP(1))
+    device.flush_tx_fifo()
+    device.pulse_chip_enable()
+    device.chip_enable_high()
+    num_frames = 0
+    end = None if timeout is None else time.time() + timeout
+    for repetition in range(repeat):
+        for block_id, offset in enumerate(range(0, len(stream), block_size)):
+            for frame in encoder.encode_block(block_id, stream[offset:offset + block_size]):
+                # Keep the TX FIFO full
+                while TX_FULL.get(device.get_status()):
+                    if end is not None and time.time() > end:
+                        device.chip_enable_low()
+                        return False
+                device.write_tx_payload_no_ack(frame)
+                num_frames += 1
+            progress.update(repetition * len(stream) + min(offset + block_size, len(stream)),
+                            {"frames": num_frames})
+    while not device.get(TX_EMPTY):
+        if end is not None and time.time() > end:
+            device.chip_enable_low()
+            return False
+    device.chip_enable_low()
+    progress.update(repeat * len(stream), {"frames": num_frames}, final=True)
+    return True
+
+
+def receive_file(device, profile, no_ack=False, timeout=None, idle_timeout=5.0, linger=1.0, out=None):
+    """Receive a file sent by send_file() with the same profile and no_ack, after
+    configure_for_transfer(). Wait at most timeout seconds for it to start and give up if
+    nothing arrives for idle_timeout seconds. Return the data, or None if it failed or the
+    checksum was wrong. After receiving everything with ACKs, keep answering for linger seconds
+    so the sender learns that the last frames arrived."""
+    import hashlib
+    data = bytearray()
+    blocks = {}
+    total_size = None
+    start = time.time()
+    last_frame = None
+    progress = None
+    if no_ack:
+        decoder = NRF24FecDecoder()
+        block_size = NRF24FecEncoder(profile["fec_data"], profile["fec_parity"]).get_block_size()
+        device.chip_enable_low()
+        _enable_arq_features(device)
+        device.set(PRIM_RX(1), PWR_UP(1))
+        device.flush_rx_fifo()
+        device.chip_enable_high()
+    else:
+        receiver = NRF24ArqReceiver(device)
+        receiver.begin()
+
+    while total_size is None or len(data) < total_size:
+        now = time.time()
+        if no_ack:
+            num_frames = 0
+            while True:
+                result = device.read_dynamic_payload()
+                if result is None:
+                    break
+                num_frames += 1
+                block = decoder.add_frame(result[1])
+                if block is not None:
+                    blocks[block[0]] = block[1]
+            while len(data) // block_size in blocks:
+                data.extend(bytearray(blocks.pop(len(data) // block_size)))
+            stats = {"blocks": decoder.num_blocks, "recovered": decoder.num_recovered_frames,
+                     "failed": decoder.num_failed_blocks}
+        else:
+            num_frames = receiver.update()
+            while True:
+                chunk = receiver.receive()
+                if chunk is None:
+                    break
+                data.extend(bytearray(chunk))
+            stats = {"frames": receiver.num_frames, "duplicates": receiver.num_duplicates}
+
+        if num_frames:
+            last_frame = now
+        elif last_frame is not None:
+            if now - last_frame > idle_timeout:
+                break
+        elif timeout is not None and now - start > timeout:
+            break
+        if total_size is None and len(data) >= _FILE_HEADER.size:
+            magic, size, digest = _FILE_HEADER.unpack(bytes(data[:_FILE_HEADER.size]))
+            if magic != _FILE_MAGIC:
+                break
+            total_size = _FILE_HEADER.size + size
+            progress = _TransferProgress(total_size, out)
+        if progress is not None:
+            progress.update(min(len(data), total_size), stats)
+
+    if progress is not None:
+        progress.update(min(len(data), total_size), stats, final=True)
+    if not no_ack:
+        end = time.time() + linger
+        while time.time() < end:
+            receiver.update()
+    device.chip_enable_low()
+    if total_size is None or len(data) < total_size:
+        return None
+    data = bytes(data[_FILE_HEADER.size:total_size])
+    if hashlib.sha256(data).digest() != digest:
+        return None
+    return data
+
+
+def _main(args=None):
+    """python -m nrf24 send-file/recv-file, see --help."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m nrf24",
+                                     description="Send a file between two nRF24L01+ on Raspberry Pis.")
+    subparsers = parser.add_subparsers(dest="command")
+    for command, help_text in (("send-file", "Send a file"), ("recv-file", "Receive a file")):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("path", help="File to send or to write")
+        subparser.add_argument("--profile", default="fast",
+                               help="One of %s or a JSON file (default fast)" % ", ".join(sorted(TRANSFER_PROFILES)))
+        subparser.add_argument("--channel", type=int, help="RF_CH, overrides the profile")
+        subparser.add_argument("--no-ack", action="store_true",
+                               help="Send without ACKs, with forward error correction")
+        subparser.add_argument("--spi", default="0.0", help="SPI bus and chip select (default 0.0)")
+        subparser.add_argument("--spi-speed", type=float, default=10e6, help="SPI clock in Hz")
+        subparser.add_argument("--ce", type=int, default=17, help="BCM number of the CE pin (default 17)")
+        subparser.add_argument("--timeout", type=float, help="Give up after this many seconds")
+        subparser.add_argument("--quiet", action="store_true", help="Don't print progress")
+        if command == "send-file":
+            subparser.add_argument("--repeat", type=int, default=1,
+                                   help="With --no-ack, send the file this many times")
+    options = parser.parse_args(args)
+    if options.command is None:
+        parser.print_help()
+        return 2
+
+    if options.profile not in TRANSFER_PROFILES and not os.path.isfile(options.profile):
+        parser.error("--profile must be one of %s or a JSON file, not %r" % (
+                ", ".join(sorted(TRANSFER_PROFILES)), options.profile))
+    if options.command == "send-file" and not os.path.isfile(options.path):
+        parser.error("No such file: %r" % options.path)
+    try:
+        profile = get_transfer_profile(options.profile)
+    except ValueError as e:
+        parser.error(str(e))
+    if options.channel is not None:
+        if not 0 <= options.channel <= 125:
+            parser.error("--channel must be 0-125, not %d" % options.channel)
+        profile["channel"] = options.channel
+    bus, chip_select = [int(part) for part in options.spi.split(".")]
+    out = None if options.quiet else sys.stderr
+
+    if "GPIO" not in globals():
+        sys.stderr.write("RPi.GPIO is needed to control CE\n")
+        return 1
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(options.ce, GPIO.OUT)
+    spi = NRF24SpiDev(bus, chip_select, max_speed_hz=options.spi_speed)
+    device = NRF24Device(spi, NRF24Gpio(options.ce))
+    try:
+        configure_for_transfer(device, profile)
+        if options.command == "send-file":
+            with open(options.path, "rb") as f:
+                data = f.read()
+            if not send_file(device, data, profile, options.no_ack, options.repeat, options.timeout, out):
+                sys.stderr.write("Transfer failed\n")
+                return 1
+        else:
+            data = receive_file(device, profile, options.no_ack, options.timeout, out=out)
+            if data is None:
+                sys.stderr.write("Transfer failed, nothing written\n")
+                return 1
+            with open(options.path, "wb") as f:
+                f.write(data)
+        return 0
+    finally:
+        device.chip_enable_low()
+        spi.close()
+        GPIO.cleanup(options.ce)
+
+
+if __name__ == "__main__":
+    sys.exit(_main())